@@ -9,36 +9,43 @@ AVRISP_2 programmer.
 """
 
 import wx
-import barobo
 import pystk500v2 as stk
-import os
-import random
-import time
-
-def _getSerialPorts():
-  if os.name == 'nt':
-    available = []
-    for i in range(256):
-      try:
-        s = serial.Serial(i)
-        available.append('\\\\.\\COM'+str(i+1))
-        s.close()
-      except Serial.SerialException:
-        pass
-    return available
-  else:
-    from serial.tools import list_ports
-    return [port[0] for port in list_ports.comports()]
+import portdiscovery
+import pipeline
+import linkbottest
+import productiondb
 
 class MainPanel(wx.Panel):
   def __init__(self, parent):
     wx.Panel.__init__(self, parent)
-    self.dongle = None
-    random.seed()
+    # Several boards are tested at once on the dongle while the next one is
+    # flashed
+    self.scheduler = linkbottest.TestScheduler()
+    self.serialIDs = productiondb.SerialIDAllocator()
+    # Free the IDs of boards left mid-flash when a loader last closed
+    self.serialIDs.expireReservations()
 
-    # Set up known serial ports
-    self.serialPorts = _getSerialPorts()
-    self.serialPorts.sort()
+    # Set up known serial ports. Discovery identifies the programmer (and
+    # dongle) by USB VID/PID and keeps the lists current as devices are
+    # plugged in and removed.
+    self.discovery = portdiscovery.PortDiscovery(bindingsFile='jigs.json')
+    self.discovery.autoBind()
+    # The jig of the selected programmer, which runs are logged under
+    self.progJig = None
+    # Programmers stay open and signed on between boards, and flash whichever
+    # kind of board is on the jig
+    self.programmers = stk.ProgrammerPool(stk.AutoProgrammer)
+    # Boards are tested while the next one is being flashed
+    self.pipeline = pipeline.FlashTestPipeline(self.scheduler.run,
+        testExecutor=self.scheduler.executor,
+        runLog=productiondb.RunLog())
+    self.pipeline.addListener(self.onBoardUpdate)
+    # The BoardRecord shown in each row of the board list, and the row of
+    # each. Not keyed by serial ID, as a failed board's ID is given to the
+    # next board.
+    self.boardRows = []
+    self.boardRowIndex = {}
+    self.serialPorts = self.discovery.devices()
    
     self.mainSizer = wx.BoxSizer(wx.VERTICAL)
 
@@ -59,7 +66,7 @@ class MainPanel(wx.Panel):
     hsizer.Add(wx.StaticText(self, -1, "Dongle Port:"), 0, wx.ALIGN_RIGHT)
     self.dongleComboBox = wx.ComboBox(self,
         -1,
-        value=self.serialPorts[0],
+        value=self._defaultPort(portdiscovery.LINKBOT_DONGLE),
         choices=self.serialPorts,
         style=wx.EXPAND)
     hsizer.Add(self.dongleComboBox, 0, wx.EXPAND)
@@ -78,7 +85,7 @@ class MainPanel(wx.Panel):
     hsizer.Add(wx.StaticText(self, -1, "Programmer Port:"), 0, wx.ALIGN_RIGHT)
     self.progComboBox = wx.ComboBox(self, 
                                -1, 
-                               value=self.serialPorts[0],
+                               value=self._defaultPort(portdiscovery.PGM03A),
                                choices=self.serialPorts, 
                                style=wx.EXPAND)
     hsizer.Add(self.progComboBox, 0, wx.EXPAND)
@@ -106,10 +113,29 @@ class MainPanel(wx.Panel):
     runTestButton = wx.Button(self, label="Run Test Routine")
     self.Bind(wx.EVT_BUTTON, self.onRunTestClicked, runTestButton)
     bsizer.Add(runTestButton, 0, wx.EXPAND|wx.ALL, 10)
+    # Ends the hold of the LED and buzzer step being tested, so a board
+    # which is plainly working need not wait out each indication
+    confirmButton = wx.Button(self, label="OK: LED and Buzzer Seen")
+    self.Bind(wx.EVT_BUTTON, self.onConfirmClicked, confirmButton)
+    bsizer.Add(confirmButton, 0, wx.EXPAND|wx.ALL, 10)
 
-    self.mainSizer.Add(bsizer, 0, wx.EXPAND|wx.ALL, 25)
+    # Every board in progress is shown, so the operator can load the next
+    # board while earlier ones are still being flashed and tested
+    self.boardList = wx.ListCtrl(self, -1, size=(-1, 120),
+        style=wx.LC_REPORT|wx.LC_SINGLE_SEL)
+    for column, title in enumerate(['Serial ID', 'Port', 'Status', 'Error']):
+      self.boardList.InsertColumn(column, title)
+    bsizer.Add(self.boardList, 1, wx.EXPAND|wx.ALL, 10)
+    cancelButton = wx.Button(self, label="Cancel Selected Board")
+    self.Bind(wx.EVT_BUTTON, self.onCancelClicked, cancelButton)
+    bsizer.Add(cancelButton, 0, wx.EXPAND|wx.ALL, 10)
+
+    self.mainSizer.Add(bsizer, 1, wx.EXPAND|wx.ALL, 25)
 
     self.SetSizer(self.mainSizer)
+
+    self.discovery.addListener(self.onPortsChanged)
+    self.discovery.start()
 #self.SetAutoLayout(1)
 #self.mainSizer.FitInside(self)
 
@@ -118,14 +144,39 @@ class MainPanel(wx.Panel):
     subprocess.call(["xdg-open", "docs/BaroboFirmwareJig_UserGuide.pdf"])
 
   def onRefreshClicked(self, event):
-    self.serialPorts = _getSerialPorts()
-    self.serialPorts.sort()
+    self.discovery.refresh()
+    self._updatePorts()
+
+  def onPortsChanged(self, event, port):
+    # Called from the discovery thread
+    if event == portdiscovery.PortDiscovery.REMOVED:
+      self.programmers.close(port.device)
+    wx.CallAfter(self._updatePorts)
+
+  def _defaultPort(self, kind):
+    ports = self.discovery.devices(kind) or self.serialPorts or ['']
+    return ports[0]
+
+  def _updatePorts(self):
+    self.serialPorts = self.discovery.devices()
+    progPort = self.progComboBox.GetValue()
+    if progPort not in self.serialPorts:
+      # Follow a replugged programmer to its new port name
+      progPort = self.discovery.portForJig(self.progJig) or \
+          self._defaultPort(portdiscovery.PGM03A)
+    donglePort = self.dongleComboBox.GetValue()
+    if donglePort not in self.serialPorts:
+      donglePort = self._defaultPort(portdiscovery.LINKBOT_DONGLE)
     self.dongleComboBox.SetItems(self.serialPorts)
+    self.dongleComboBox.SetValue(donglePort)
     self.progComboBox.SetItems(self.serialPorts)
+    self.progComboBox.SetValue(progPort)
 
   def onFlashButtonClicked(self, event):
     try:
-      programmer = stk.ATmega128rfa1Programmer(self.progComboBox.GetValue())
+      port = self.progComboBox.GetValue()
+      programmer = self.programmers.acquire(port)
+      self.progJig = self.discovery.jigForPort(port)
     except Exception as e:
       dlg = wx.MessageDialog(self, 
                           'Could not connect to programmer. Please ensure that '
@@ -137,131 +188,111 @@ class MainPanel(wx.Panel):
       dlg.Destroy()
       return
 
-    dlg = wx.ProgressDialog("Flashing Progress",
-                            "Loading Linkbot Firmware...",
-                            maximum=105,
-                            parent=self,
-                            style = wx.PD_APP_MODAL | wx.PD_ELAPSED_TIME
-                            )
-    # Generate a random ID
-    self.serialID = "{:04d}".format(random.randint(1000, 9999))
-    self.tempIdText.SetValue(self.serialID)
-    programmer.programAllAsync(serialID=self.serialID)
-
-    while programmer.isProgramming():
-      dlg.Update(programmer.getProgress()*100)
-      wx.MilliSleep(250)
+    # Reserve a serial ID which no other board has been given
+    jig = self.progJig or programmer.ser.port
+    serialID = self.serialIDs.reserve(jig=jig)
+    self.tempIdText.SetValue(serialID)
+    record = self.pipeline.submit(programmer, serialID,
+        test=bool(self.scheduler.dongles()), jig=jig)
+    # The flash runs on a worker thread, which reports back through
+    # wx.CallAfter, so this handler returns at once
+    lastPercent = [-1]
+    def onProgress(job):
+      percent = int(job.progress*100)
+      if percent != lastPercent[0]:
+        lastPercent[0] = percent
+        wx.CallAfter(self._showBoard, record)
+    record.flashJob.addProgressCallback(onProgress)
+    record.flashJob.addDoneCallback(
+        lambda job: wx.CallAfter(self._onFlashDone, record))
 
-    dlg.Destroy()
-
-    # See if there were any exceptions
-    e = programmer.getLastException()
-    if e:
-      dlg = wx.MessageDialog(self, 
-                             'Error programming board: {0}'.format(str(e)),
-                             'Error',
-                             wx.OK | wx.ICON_WARNING
-                             )
-      dlg.ShowModal()
-      dlg.Destroy()
+  def _onFlashDone(self, record):
+    job = record.flashJob
+    if (job.cancelled() or job.exception() is not None
+        or not pipeline.storesSerialID(job.stats)):
+      self.serialIDs.release(record.serialID)
       return
-
-    self.onRunTestClicked(None)
+    self.serialIDs.commit(record.serialID,
+        firmware=','.join(job.stats.get('images') or []))
+    if not self.scheduler.dongles():
+      self._warnNoDongle()
 
   def onSetIDClicked(self, event):
     pass
 
   def onRunTestClicked(self, event):
-    if self.dongle is None:
-      dlg = wx.MessageDialog(self, 'There is currently no dongle associated with this '
-          'utility. Please select and connect to a Linkbot dongle using the '
-          '"Dongle Management" area above and try again.',
-          'Warning',
-          wx.OK|wx.ICON_WARNING)
-      dlg.ShowModal()
-      dlg.Destroy()
+    if not self.scheduler.dongles():
+      self._warnNoDongle()
       return
-    import threading
-    testthread = threading.Thread(target=self.runTestRoutine)
-    testthread.start()
-    self.testingException = None
-    dlg = wx.ProgressDialog("Testing board...",
-        "Testing board...",
-        parent=self,
-        style=wx.PD_APP_MODAL)
-    while testthread.is_alive():
-      dlg.Pulse()
-      time.sleep(0.25)
+    self.pipeline.test(self.tempIdText.GetValue())
+
+  def onConfirmClicked(self, event):
+    # Confirm the selected board, or every board being tested
+    row = self.boardList.GetFirstSelected()
+    serialID = self.boardRows[row].serialID if row != -1 else None
+    self.scheduler.confirm(serialID)
+
+  def _warnNoDongle(self):
+    dlg = wx.MessageDialog(self, 'There is currently no dongle associated with this '
+        'utility. Please select and connect to a Linkbot dongle using the '
+        '"Dongle Management" area above and try again.',
+        'Warning',
+        wx.OK|wx.ICON_WARNING)
+    dlg.ShowModal()
     dlg.Destroy()
-    if self.testingException:
-      dlg = wx.MessageDialog(self,
-          'Testing board with ID {0} failed: {1}'.format(self.serialID, str(self.testingException)),
-          'Error',
-          wx.OK|wx.ICON_WARNING)
-      dlg.ShowModal()
-      dlg.Destroy()
 
-  def runTestRoutine(self):
-    print "Testing..."
-    mybot = barobo.Linkbot()
-    numtries = 10
-    for i in range (numtries):
-      try:
-        self.serialID = self.tempIdText.GetValue()
-        print "Connecting to {0}...".format(self.serialID)
-        mybot.connectWithSerialID(str(self.serialID))
-        break
-      except Exception as e:
-        if i == (numtries-1):
-          dlg = wx.MessageDialog(self,
-              'Could not connect wirelessly to Serial ID {0}: {1}'.format(self.serialID, str(e)),
-              'Error',
-              wx.OK|wx.ICON_WARNING)
-          dlg.ShowModal()
-          dlg.Destroy()
-          return 
-        else:
-          pass
+  def onBoardUpdate(self, record):
+    # Called from the pipeline's worker threads
+    wx.CallAfter(self._showBoard, record)
 
-    try:
-      mybot.setBuzzerFrequency(220)
-      mybot.setColorRGB(0xff, 0, 0)
-      time.sleep(.5)
-      mybot.setBuzzerFrequency(440)
-      mybot.setColorRGB(0, 0xff, 0)
-      time.sleep(.5)
-      mybot.setBuzzerFrequency(220)
-      mybot.setColorRGB(0, 0, 0xff)
-      time.sleep(.5)
-      mybot.setBuzzerFrequency(0)
-      x, y, z = mybot.getAccelerometerData()
-      if abs(x) > 0.1 or abs(y) > 0.1 or abs(1-z) > 0.1:
-        raise Exception("Error: Detected anomaly in accelerometer readings: "
-            "({0}, {1}, {2}). Should be (0, 0, 1)".format(x, y, z))
-    except Exception as e:
-      self.testingException = e
+  def _showBoard(self, record):
+    status = record.status
+    if status == record.FLASHING and record.flashJob is not None:
+      status = '{0} {1}%'.format(status, int(record.flashJob.progress*100))
+    error = '' if record.error is None else str(record.error)
+    row = self.boardRowIndex.get(record)
+    if row is None:
+      row = len(self.boardRows)
+      self.boardRows.append(record)
+      self.boardRowIndex[record] = row
+      self.boardList.Append([record.serialID or '', record.port or '', status,
+        error])
+    self.boardList.SetStringItem(row, 1, record.port or '')
+    self.boardList.SetStringItem(row, 2, status)
+    self.boardList.SetStringItem(row, 3, error)
+    if record.status == record.FAILED:
+      self.boardList.SetItemTextColour(row, wx.RED)
+    elif record.status == record.PASSED:
+      self.boardList.SetItemTextColour(row, wx.Colour(0, 128, 0))
+    else:
+      self.boardList.SetItemTextColour(row, self.boardList.GetTextColour())
+
+  def onCancelClicked(self, event):
+    row = self.boardList.GetFirstSelected()
+    if row < 0:
       return
+    record = self.boardRows[row]
+    for job in (record.flashJob, record.testJob):
+      if job is not None and not job.done():
+        job.cancel()
 
   def onConnectDongleClicked(self, event):
-    self.dongle = barobo.Linkbot()
+    port = self.dongleComboBox.GetValue()
+    if port in [d.port for d in self.scheduler.dongles()]:
+      return
     try:
-      print "Connecting to {0}...".format(self.dongleComboBox.GetValue())
-      self.dongle.connectWithTTY(str(self.dongleComboBox.GetValue()))
-      self.dongle._setDongle()
+      print "Connecting to {0}...".format(port)
+      self.scheduler.addDongle(linkbottest.openDongle(port))
       self.flashButton.Enable()
       print "Connect success"
-      event.GetEventObject().Disable()
-      event.GetEventObject().SetLabel("Connected.")
     except Exception as e:
       dlg = wx.MessageDialog(self, "Error connecting to dongle: {0}".format(str(e)),
           'Error', wx.OK | wx.ICON_WARNING )
       dlg.ShowModal()
       dlg.Destroy()
-      self.dongle = None
 
   def onSerialComboBox(self, event):
-    self.serialPorts = _getSerialPorts()
-    self.serialPorts.sort()
+    self._updatePorts()
 
 
 if __name__ == "__main__":
@@ -270,3 +301,6 @@ if __name__ == "__main__":
   panel = MainPanel(frame)
   frame.Show()
   app.MainLoop()
+  panel.discovery.stop()
+  panel.scheduler.shutdown(wait=False)
+  panel.programmers.closeAll()
@@ -9,36 +9,29 @@ AVRISP_2 programmer.
 """
 
 import wx
-import barobo
 import pystk500v2 as stk
-import os
+import portdiscovery
+import productiondb
 import random
 import time
 
-def _getSerialPorts():
-  if os.name == 'nt':
-    available = []
-    for i in range(256):
-      try:
-        s = serial.Serial(i)
-        available.append('\\\\.\\COM'+str(i+1))
-        s.close()
-      except Serial.SerialException:
-        pass
-    return available
-  else:
-    from serial.tools import list_ports
-    return [port[0] for port in list_ports.comports()]
-
 class MainPanel(wx.Panel):
   def __init__(self, parent):
     wx.Panel.__init__(self, parent)
     self.dongle = None
     random.seed()
 
-    # Set up known serial ports
-    self.serialPorts = _getSerialPorts()
-    self.serialPorts.sort()
+    # Set up known serial ports. Discovery identifies the programmer (and
+    # dongle) by USB VID/PID and keeps the lists current as devices are
+    # plugged in and removed.
+    self.discovery = portdiscovery.PortDiscovery(bindingsFile='jigs.json')
+    self.discovery.autoBind()
+    self.progSerialNumber = None
+    # Programmers stay open and signed on between boards, and flash whichever
+    # kind of board is on the jig
+    self.programmers = stk.ProgrammerPool(stk.AutoProgrammer)
+    self.runLog = productiondb.RunLog()
+    self.serialPorts = self.discovery.devices()
    
     self.mainSizer = wx.BoxSizer(wx.VERTICAL)
 
@@ -62,7 +55,7 @@ class MainPanel(wx.Panel):
     hsizer.Add(wx.StaticText(self, -1, "Programmer Port:"), 0, wx.ALIGN_RIGHT)
     self.progComboBox = wx.ComboBox(self, 
                                -1, 
-                               value=self.serialPorts[0],
+                               value=self._defaultPort(portdiscovery.PGM03A),
                                choices=self.serialPorts, 
                                style=wx.EXPAND)
     hsizer.Add(self.progComboBox, 0, wx.EXPAND)
@@ -72,9 +65,20 @@ class MainPanel(wx.Panel):
     self.Bind(wx.EVT_BUTTON, self.onFlashButtonClicked, self.flashButton)
 
     bsizer.Add(self.flashButton, 0, wx.EXPAND|wx.ALL, 10)
-    self.mainSizer.Add(bsizer, 0, wx.EXPAND|wx.ALL, 25)
+
+    # One row per board, so that several boards can be flashed at once
+    self.runList = wx.ListBox(self, -1, size=(-1, 80))
+    bsizer.Add(self.runList, 1, wx.EXPAND|wx.ALL, 10)
+    self.runJobs = []
+    button = wx.Button(self, label="Cancel Selected Board")
+    self.Bind(wx.EVT_BUTTON, self.onCancelClicked, button)
+    bsizer.Add(button, 0, wx.EXPAND|wx.ALL, 10)
+    self.mainSizer.Add(bsizer, 1, wx.EXPAND|wx.ALL, 25)
 
     self.SetSizer(self.mainSizer)
+
+    self.discovery.addListener(self.onPortsChanged)
+    self.discovery.start()
 #self.SetAutoLayout(1)
 #self.mainSizer.FitInside(self)
 
@@ -83,14 +87,35 @@ class MainPanel(wx.Panel):
     subprocess.call(["xdg-open", "docs/BaroboFirmwareJig_UserGuide.pdf"])
 
   def onRefreshClicked(self, event):
-    self.serialPorts = _getSerialPorts()
-    self.serialPorts.sort()
-    self.dongleComboBox.SetItems(self.serialPorts)
+    self.discovery.refresh()
+    self._updatePorts()
+
+  def onPortsChanged(self, event, port):
+    # Called from the discovery thread
+    if event == portdiscovery.PortDiscovery.REMOVED:
+      self.programmers.close(port.device)
+    wx.CallAfter(self._updatePorts)
+
+  def _defaultPort(self, kind):
+    ports = self.discovery.devices(kind) or self.serialPorts or ['']
+    return ports[0]
+
+  def _updatePorts(self):
+    self.serialPorts = self.discovery.devices()
+    progPort = self.progComboBox.GetValue()
+    if progPort not in self.serialPorts:
+      # Follow a replugged programmer to its new port name
+      progPort = self.discovery.portForSerial(self.progSerialNumber) or \
+          self._defaultPort(portdiscovery.PGM03A)
     self.progComboBox.SetItems(self.serialPorts)
+    self.progComboBox.SetValue(progPort)
 
   def onFlashButtonClicked(self, event):
     try:
-      programmer = stk.ATmega32U4Programmer(self.progComboBox.GetValue())
+      programmer = self.programmers.acquire(self.progComboBox.GetValue())
+      for port in self.discovery.programmers():
+        if port.device == self.progComboBox.GetValue():
+          self.progSerialNumber = port.serialNumber
     except Exception as e:
       dlg = wx.MessageDialog(self, 
                           'Could not connect to programmer. Please ensure that '
@@ -102,32 +127,61 @@ class MainPanel(wx.Panel):
       dlg.Destroy()
       return
 
-    dlg = wx.ProgressDialog("Flashing Progress",
-                            "Loading Linkbot USB Firmware...",
-                            maximum=105,
-                            parent=self,
-                            style = wx.PD_APP_MODAL | wx.PD_ELAPSED_TIME
-                            )
-    # Generate a random ID
-    programmer.programAllAsync()
-
-    while programmer.isProgramming():
-      dlg.Update(programmer.getProgress()*100)
-      wx.MilliSleep(250)
-
-    dlg.Destroy()
-
-    # See if there were any exceptions
-    e = programmer.getLastException()
-    if e:
-      dlg = wx.MessageDialog(self, 
-                             'Error programming board: {0}'.format(str(e)),
-                             'Error',
-                             wx.OK | wx.ICON_WARNING
-                             )
-      dlg.ShowModal()
-      dlg.Destroy()
-      return
+    started = time.time()
+    job = programmer.programAllAsync()
+    self.runJobs.append(job)
+    row = self.runList.Append(self._runText(job))
+    # Progress and completion arrive from the worker thread through
+    # wx.CallAfter, leaving the GUI free while the board is flashed
+    lastPercent = [-1]
+    def onProgress(job):
+      percent = int(job.progress*100)
+      if percent != lastPercent[0]:
+        lastPercent[0] = percent
+        wx.CallAfter(self._showRun, row, job)
+    job.addProgressCallback(onProgress)
+    job.addDoneCallback(lambda job: self._logRun(job, started))
+    job.addDoneCallback(lambda job: wx.CallAfter(self._showRun, row, job))
+
+  def _runText(self, job):
+    if job.done() and job.exception() is not None:
+      status = 'failed - {0}'.format(str(job.exception()))
+    elif job.running():
+      status = 'flashing {0}%'.format(int(job.progress*100))
+    else:
+      status = job.status
+    return '{0}: {1}'.format(job.name, status)
+
+  def _showRun(self, row, job):
+    self.runList.SetString(row, self._runText(job))
+
+  def onCancelClicked(self, event):
+    row = self.runList.GetSelection()
+    if row != wx.NOT_FOUND:
+      self.runJobs[row].cancel()
+
+  def _logRun(self, job, started):
+    stats = job.stats
+    phases = stats.get('phases', [])
+    if job.cancelled():
+      outcome = 'cancelled'
+    elif job.exception() is not None:
+      outcome = 'failed'
+    else:
+      outcome = 'flashed'
+    try:
+      self.runLog.record(started, time.time(), outcome,
+          jig=stats.get('port'),
+          port=stats.get('port'),
+          images=stats.get('images'),
+          imageHash=stats.get('imageHash'),
+          fuses=stats.get('fuses'),
+          phases=phases,
+          retries=stats.get('retries', 0),
+          stage=phases[-1][0] if phases else None,
+          error=job.exception())
+    except Exception as e:
+      print "Could not log run: {0}".format(str(e))
 
 if __name__ == "__main__":
   app = wx.App(False)
@@ -135,3 +189,5 @@ if __name__ == "__main__":
   panel = MainPanel(frame)
   frame.Show()
   app.MainLoop()
+  panel.discovery.stop()
+  panel.programmers.closeAll()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+"""
+Import-time benchmark for the programming core.
+
+Each module is imported in a fresh interpreter several times and the median
+import time is reported. The script also checks that the core modules do
+not pull in the GUI (wx), the Linkbot library (barobo) or pyserial, and exits
+with an error if one of them does, or if an import exceeds the budget.
+
+  python bench_imports.py [--runs 10] [--budget-ms 50]
+"""
+
+import argparse
+import subprocess
+import sys
+
+CORE_MODULES = [
+    'pystk500v2',
+    'portdiscovery',
+    'pipeline',
+    'productiondb',
+    'linkbottest',
+    'stkprofile',
+    'stktransport',
+    'firmwarecatalog',
+    ]
+
+HEAVY_MODULES = ['wx', 'barobo', 'serial']
+
+_probe = """
+import sys, time
+start = time.time()
+import {0}
+elapsed = time.time() - start
+heavy = [m for m in {1!r} if m in sys.modules]
+print elapsed, ','.join(heavy)
+"""
+
+def timeImport(module, runs):
+  times = []
+  heavy = set()
+  for i in range(runs):
+    out = subprocess.check_output(
+        [sys.executable, '-c', _probe.format(module, HEAVY_MODULES)])
+    fields = out.split()
+    times.append(float(fields[0]))
+    if len(fields) > 1:
+      heavy.update(fields[1].split(','))
+  times.sort()
+  return times[len(times)//2], sorted(heavy)
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+  parser.add_argument('--runs', type=int, default=10)
+  parser.add_argument('--budget-ms', type=float, default=50.0)
+  args = parser.parse_args(argv)
+  failed = False
+  print '{0:<16} {1:>10}  {2}'.format('Module', 'Median ms', 'Heavy imports')
+  for module in CORE_MODULES:
+    median, heavy = timeImport(module, args.runs)
+    print '{0:<16} {1:>10.2f}  {2}'.format(module, median*1000,
+        ', '.join(heavy) or '-')
+    if heavy or median*1000 > args.budget_ms:
+      failed = True
+  if failed:
+    print 'Import budget exceeded.'
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,188 @@
+"""
+Identify which known firmware image a board is running.
+
+A catalog holds a hash of every flash page of each known image. To identify
+a board, pages are read back one at a time, each time choosing the page that
+best splits the images still in the running, so only a handful of pages are
+read instead of the whole flash. A few more pages are then read to confirm
+the match.
+
+  python firmwarecatalog.py build catalog.json
+  python firmwarecatalog.py identify PORT [--catalog catalog.json]
+
+Without a catalog file, the catalog is built from the images in
+KNOWN_IMAGES.
+"""
+
+import hashlib
+import json
+import sys
+import pystk500v2 as stk
+
+# Name, device and the hex files flashed together for each known image
+KNOWN_IMAGES = [
+    ('dof', 'atmega128rfa1', ['bootloader.hex', 'dof.hex']),
+    ('dof2', 'atmega128rfa1', ['bootloader.hex', 'dof2.hex']),
+    ('full', 'atmega128rfa1', ['full.hex']),
+    ('hex2', 'atmega128rfa1', ['hex2.hex']),
+    ('outfull', 'atmega128rfa1', ['outfull.hex']),
+    ('BaroboFirmware_201304241609', 'atmega128rfa1',
+      ['BaroboFirmware_201304241609.hex']),
+    ('usb', 'atmega32u4', ['usb.hex']),
+    ]
+
+def pageHash(data):
+  return hashlib.sha1(bytes(data)).hexdigest()[:16]
+
+class FirmwareCatalog():
+  """Per-page hashes of known images, for each device.
+
+  Pages past the end of an image are expected to be blank, as left by the
+  chip erase before programming."""
+  def __init__(self):
+    self.images = {}
+
+  def add(self, name, device, hexfiles):
+    profile = stk.profileByName(device)
+    pagesize = profile.pageSize
+    h = stk.composeImages(hexfiles, profile)
+    pages = []
+    for page in range(0, len(h.data), pagesize):
+      data = h.data[page:page+pagesize]
+      data += bytearray(b'\xff'*(pagesize - len(data)))
+      pages.append(pageHash(data))
+    self.images[name] = {
+        'device' : device,
+        'hexfiles' : list(hexfiles),
+        'imageHash' : hashlib.sha1(bytes(h.data)).hexdigest(),
+        'pagesize' : pagesize,
+        'pages' : pages,
+        }
+
+  def candidates(self, device):
+    return sorted(name for name, image in self.images.items()
+        if image['device'] == device)
+
+  def expected(self, name, pageIndex):
+    image = self.images[name]
+    if pageIndex < len(image['pages']):
+      return image['pages'][pageIndex]
+    return pageHash(bytearray(b'\xff'*image['pagesize']))
+
+  def save(self, filename):
+    with open(filename, 'w') as f:
+      json.dump(self.images, f, indent=1, sort_keys=True)
+
+  @classmethod
+  def load(cls, filename):
+    catalog = cls()
+    with open(filename, 'r') as f:
+      catalog.images = json.load(f)
+    return catalog
+
+  @classmethod
+  def fromKnownImages(cls, images=KNOWN_IMAGES):
+    catalog = cls()
+    for name, device, hexfiles in images:
+      try:
+        catalog.add(name, device, hexfiles)
+      except Exception as e:
+        print "Skipping {0}: {1}".format(name, str(e))
+    return catalog
+
+  def _bestPage(self, names, numpages, tried):
+    """The unread page which leaves the fewest candidates in the worst
+    case, preferring pages which distinguish more of them."""
+    best = None
+    bestScore = None
+    for pageIndex in range(numpages):
+      if pageIndex in tried:
+        continue
+      groups = {}
+      for name in names:
+        digest = self.expected(name, pageIndex)
+        groups[digest] = groups.get(digest, 0) + 1
+      score = (max(groups.values()), -len(groups))
+      if bestScore is None or score < bestScore:
+        best, bestScore = pageIndex, score
+    return best, bestScore
+
+  def identify(self, programmer, confirmPages=2):
+    """Identify the image on a programmer's board, which must be in
+    programming mode with its signature checked. Returns a dict with the
+    image name (None if the board matches no known image) and the pages
+    read."""
+    names = self.candidates(programmer.device.name)
+    pagesize = programmer.PAGESIZE
+    numpages = programmer.FLASHSIZE // pagesize
+    read = {}
+    def readPage(pageIndex):
+      read[pageIndex] = pageHash(
+          programmer.readFlash(pagesize, startaddr=pageIndex*pagesize))
+      return read[pageIndex]
+    while len(names) > 1:
+      pageIndex, score = self._bestPage(names, numpages, read)
+      if pageIndex is None or score[1] == -1:
+        # The remaining images are identical
+        break
+      digest = readPage(pageIndex)
+      names = [n for n in names if self.expected(n, pageIndex) == digest]
+    # Check that the board really holds the remaining image, which may be
+    # several identical ones, on pages where it differs from blank flash
+    if names:
+      image = self.images[names[0]]
+      blank = pageHash(bytearray(b'\xff'*pagesize))
+      used = [i for i, digest in enumerate(image['pages'])
+          if digest != blank and i not in read]
+      step = max(len(used) // (confirmPages + 1), 1)
+      for pageIndex in used[step::step][:confirmPages]:
+        readPage(pageIndex)
+    names = [n for n in names
+        if all(self.expected(n, i) == d for i, d in read.items())]
+    return {
+        'name' : names[0] if len(names) == 1 else None,
+        'matches' : names,
+        'pagesRead' : len(read),
+        }
+
+def main(argv):
+  import argparse
+  parser = argparse.ArgumentParser(
+      description='Identify the firmware image on a board.')
+  sub = parser.add_subparsers(dest='command')
+  build = sub.add_parser('build', help='Precompute the catalog of known images.')
+  build.add_argument('output')
+  ident = sub.add_parser('identify', help='Identify the image on a board.')
+  ident.add_argument('port')
+  ident.add_argument('--catalog', default=None)
+  ident.add_argument('--device', choices=sorted(stk.DEVICES.keys()),
+      default='auto')
+  args = parser.parse_args(argv)
+  if args.command == 'build':
+    FirmwareCatalog.fromKnownImages().save(args.output)
+    return
+  if args.catalog:
+    catalog = FirmwareCatalog.load(args.catalog)
+  else:
+    catalog = FirmwareCatalog.fromKnownImages()
+  programmer = stk.DEVICES[args.device](args.port)
+  try:
+    programmer.sign_on()
+    programmer.enter_progmode_isp()
+    programmer.check_signature()
+    result = catalog.identify(programmer)
+    programmer.leave_progmode_isp()
+  finally:
+    programmer.close()
+  if result['name'] is not None:
+    print 'Board is running {0} ({1} pages read)'.format(
+        result['name'], result['pagesRead'])
+  elif result['matches']:
+    print 'Board matches {0} ({1} pages read)'.format(
+        ', '.join(result['matches']), result['pagesRead'])
+  else:
+    print 'Unknown firmware ({0} pages read)'.format(result['pagesRead'])
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,294 @@
+"""
+Discrete-event simulation of the programming line's capacity.
+
+Boards go through the line as they do on the floor. An operator loads a
+board into a free jig, the jig flashes it, possibly retrying a failed flash,
+and an operator unloads it. It then waits for a free dongle slot to be
+tested. Flash and test durations and failure rates are drawn from the runs
+in the production database's run log, so the model tracks the real line.
+Load and unload times are the operator's, and must be given.
+
+  python linesim.py [--db production.db] [--jigs 1,2,3] [--dongles 1,2]
+      [--operators 1] [--shift 8]
+
+Each combination of jigs, dongles and operators is simulated for a shift,
+reporting boards per hour, the utilisation of each resource and which one
+is the bottleneck.
+"""
+
+import heapq
+import itertools
+import random
+import sys
+import time
+
+# Used for anything not measured in the run log. Rough figures in seconds.
+DEFAULT_TIMINGS = {
+    'flash' : 30.0,
+    'test' : 5.0,
+    }
+
+# Run log phases which are not part of flashing
+TEST_PHASES = ('test', 'test_wait')
+
+class Simulation():
+  """An event queue with a simulated clock."""
+  def __init__(self):
+    self.now = 0.0
+    self._events = []
+    self._seq = itertools.count()
+
+  def schedule(self, delay, callback, *args):
+    heapq.heappush(self._events,
+        (self.now + delay, next(self._seq), callback, args))
+
+  def run(self, until):
+    while self._events and self._events[0][0] <= until:
+      self.now, seq, callback, args = heapq.heappop(self._events)
+      callback(*args)
+    self.now = until
+
+class Resource():
+  """capacity identical servers with a FIFO queue, keeping track of how
+  busy they were and how long requests waited."""
+  def __init__(self, sim, name, capacity):
+    self.sim = sim
+    self.name = name
+    self.capacity = capacity
+    self.inUse = 0
+    self.waiting = []
+    self.busyTime = 0.0
+    self.waitTime = 0.0
+    self.grants = 0
+    self._lastChange = 0.0
+
+  def _account(self):
+    self.busyTime += self.inUse * (self.sim.now - self._lastChange)
+    self._lastChange = self.sim.now
+
+  def request(self, callback):
+    """Call callback() once one of the servers is free."""
+    if self.inUse < self.capacity:
+      self._grant(callback, self.sim.now)
+    else:
+      self.waiting.append((callback, self.sim.now))
+
+  def release(self):
+    self._account()
+    self.inUse -= 1
+    if self.waiting:
+      callback, since = self.waiting.pop(0)
+      self._grant(callback, since)
+
+  def _grant(self, callback, since):
+    self._account()
+    self.inUse += 1
+    self.grants += 1
+    self.waitTime += self.sim.now - since
+    self.sim.schedule(0, callback)
+
+  def utilisation(self):
+    self._account()
+    if self.capacity == 0 or self.sim.now == 0:
+      return 0.0
+    return self.busyTime / (self.capacity * self.sim.now)
+
+  def meanWait(self):
+    return self.waitTime / self.grants if self.grants else 0.0
+
+class Timings():
+  """Samples of flash and test durations, in seconds, and the chance of
+  each failing."""
+  def __init__(self, flash=None, test=None, flashFailRate=0.0,
+      testFailRate=0.0):
+    self.flash = flash or [DEFAULT_TIMINGS['flash']]
+    self.test = test or [DEFAULT_TIMINGS['test']]
+    self.flashFailRate = flashFailRate
+    self.testFailRate = testFailRate
+
+  @classmethod
+  def fromRunLog(cls, runLog, since=0):
+    """Timings from the runs in a productiondb.RunLog. Test durations are
+    the tests' own run times, without the wait for a dongle, which the
+    simulation models itself. Runs logged before that wait was a separate
+    phase include it in their test time, so their tests are left out."""
+    flash = []
+    test = []
+    flashRuns = flashFailed = testRuns = testFailed = 0
+    for outcome, stage, phases in runLog.runPhases(since):
+      if outcome == 'cancelled':
+        continue
+      flashRuns += 1
+      flashTime = sum(d for p, d in phases.items() if p not in TEST_PHASES)
+      if outcome == 'failed' and stage != 'test':
+        flashFailed += 1
+      elif flashTime > 0:
+        flash.append(flashTime)
+      if 'test' in phases and 'test_wait' in phases:
+        testRuns += 1
+        test.append(phases['test'])
+        if outcome == 'failed':
+          testFailed += 1
+    return cls(flash, test,
+        float(flashFailed) / flashRuns if flashRuns else 0.0,
+        float(testFailed) / testRuns if testRuns else 0.0)
+
+  def scaled(self, flashScale=1.0, testScale=1.0):
+    """Timings with flashing and testing sped up or slowed down, to model
+    a change such as faster programmer communication."""
+    return Timings([d*flashScale for d in self.flash],
+        [d*testScale for d in self.test], self.flashFailRate, self.testFailRate)
+
+class LineModel():
+  """A station layout: jigs, dongles each testing up to boardsPerDongle
+  boards at once, and operators loading and unloading the jigs. A board
+  whose flash fails is reflashed up to flashRetries times before being
+  rejected."""
+  def __init__(self, timings, jigs=1, dongles=1, boardsPerDongle=4,
+      operators=1, loadTime=10.0, unloadTime=5.0, flashRetries=1, seed=None):
+    self.timings = timings
+    self.jigs = jigs
+    self.dongles = dongles
+    self.boardsPerDongle = boardsPerDongle
+    self.operators = operators
+    self.loadTime = loadTime
+    self.unloadTime = unloadTime
+    self.flashRetries = flashRetries
+    self.random = random.Random(seed)
+
+  def run(self, hours=8.0):
+    self.sim = Simulation()
+    self.jigResource = Resource(self.sim, 'jigs', self.jigs)
+    self.operatorResource = Resource(self.sim, 'operators', self.operators)
+    self.testResource = Resource(self.sim, 'dongles',
+        self.dongles * self.boardsPerDongle)
+    self.counts = {'passed' : 0, 'flashRejected' : 0, 'testFailed' : 0,
+        'flashRetries' : 0}
+    self.flashTime = 0.0
+    self.end = hours * 3600.0
+    # Boards are always waiting to be loaded, so each jig runs continuously
+    for i in range(self.jigs):
+      self.jigResource.request(self._load)
+    self.sim.run(self.end)
+    resources = [self.jigResource, self.operatorResource, self.testResource]
+    utilisation = dict((r.name, r.utilisation()) for r in resources)
+    # A jig waiting for an operator is held but not working, so count only
+    # the time it spends flashing
+    utilisation['jigs'] = self.flashTime / (self.jigs * self.sim.now)
+    return {
+        'hours' : hours,
+        'boardsPerHour' : self.counts['passed'] / hours,
+        'counts' : dict(self.counts),
+        'utilisation' : utilisation,
+        'meanWait' : dict((r.name, r.meanWait()) for r in resources),
+        'bottleneck' : max(utilisation, key=utilisation.get),
+        # Boards waiting for a test at the end of the shift
+        'testBacklog' : len(self.testResource.waiting),
+        }
+
+  def _jitter(self, seconds):
+    return seconds * self.random.uniform(0.9, 1.1)
+
+  def _load(self):
+    def loaded():
+      self.operatorResource.release()
+      self._flash(1)
+    self.operatorResource.request(
+        lambda: self.sim.schedule(self._jitter(self.loadTime), loaded))
+
+  def _flash(self, attempt):
+    duration = self.random.choice(self.timings.flash)
+    # Only the part of a flash which falls within the shift
+    self.flashTime += max(min(duration, self.end - self.sim.now), 0.0)
+    self.sim.schedule(duration, self._flashed, attempt)
+
+  def _flashed(self, attempt):
+    if self.random.random() < self.timings.flashFailRate:
+      if attempt <= self.flashRetries:
+        self.counts['flashRetries'] += 1
+        self._flash(attempt + 1)
+        return
+      self._unload(None)
+      return
+    self._unload(self._test)
+
+  def _unload(self, next):
+    def unloaded():
+      self.operatorResource.release()
+      self.jigResource.release()
+      self.jigResource.request(self._load)
+      if next is None:
+        self.counts['flashRejected'] += 1
+      else:
+        next()
+    self.operatorResource.request(
+        lambda: self.sim.schedule(self._jitter(self.unloadTime), unloaded))
+
+  def _test(self):
+    def tested():
+      self.testResource.release()
+      if self.random.random() < self.timings.testFailRate:
+        self.counts['testFailed'] += 1
+      else:
+        self.counts['passed'] += 1
+    self.testResource.request(lambda: self.sim.schedule(
+      self.random.choice(self.timings.test), tested))
+
+def formatResults(rows):
+  lines = ['{0:>4} {1:>7} {2:>9} {3:>10} {4:>6} {5:>8} {6:>9}  {7:<11} {8}'.format(
+      'Jigs', 'Dongles', 'Operators', 'Boards/hr', 'Jig %', 'Dongle %',
+      'Operator %', 'Bottleneck', 'Test backlog')]
+  for layout, result in rows:
+    u = result['utilisation']
+    lines.append('{0:>4} {1:>7} {2:>9} {3:>10.1f} {4:>6.0f} {5:>8.0f} {6:>9.0f}   {7:<11} {8}'.format(
+        layout[0], layout[1], layout[2], result['boardsPerHour'],
+        u['jigs']*100, u['dongles']*100, u['operators']*100,
+        result['bottleneck'], result['testBacklog']))
+  return '\n'.join(lines)
+
+def main(argv):
+  import argparse
+  def numbers(text):
+    return [int(n) for n in text.split(',')]
+  parser = argparse.ArgumentParser(description='Simulate the line capacity.')
+  parser.add_argument('--db', default=None,
+      help='Production database to take timings from. Without one the '
+      'defaults are used.')
+  parser.add_argument('--days', type=float, default=None,
+      help='Only use runs from the last DAYS days.')
+  parser.add_argument('--jigs', type=numbers, default=[1, 2, 3, 4])
+  parser.add_argument('--dongles', type=numbers, default=[1])
+  parser.add_argument('--operators', type=numbers, default=[1])
+  # As linkbottest.Dongle.MAX_BOARDS
+  parser.add_argument('--boards-per-dongle', type=int, default=4)
+  parser.add_argument('--load', type=float, default=10.0,
+      help='Seconds for an operator to load a board into a jig.')
+  parser.add_argument('--unload', type=float, default=5.0,
+      help='Seconds for an operator to unload a board.')
+  parser.add_argument('--flash-scale', type=float, default=1.0,
+      help='Multiply measured flash times, e.g. 0.8 for 20%% faster.')
+  parser.add_argument('--test-scale', type=float, default=1.0)
+  parser.add_argument('--shift', type=float, default=8.0,
+      help='Hours to simulate.')
+  parser.add_argument('--seed', type=int, default=1)
+  args = parser.parse_args(argv)
+  if args.db:
+    import productiondb
+    since = 0 if args.days is None else time.time() - args.days*86400
+    timings = Timings.fromRunLog(productiondb.RunLog(args.db), since)
+  else:
+    timings = Timings()
+  timings = timings.scaled(args.flash_scale, args.test_scale)
+  print 'Flash {0:.1f} s mean, {1:.1%} failing; test {2:.1f} s mean, {3:.1%} failing'.format(
+      sum(timings.flash)/len(timings.flash), timings.flashFailRate,
+      sum(timings.test)/len(timings.test), timings.testFailRate)
+  rows = []
+  for layout in itertools.product(args.jigs, args.dongles, args.operators):
+    model = LineModel(timings, jigs=layout[0], dongles=layout[1],
+        boardsPerDongle=args.boards_per_dongle, operators=layout[2],
+        loadTime=args.load, unloadTime=args.unload, seed=args.seed)
+    rows.append((layout, model.run(args.shift)))
+  print formatResults(rows)
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,398 @@
+"""
+Functional test of a freshly flashed Linkbot mainboard over the wireless
+dongle.
+
+These routines do not touch the GUI; failures are raised as LinkbotTestError
+so that they can be run from worker threads and reported by the caller.
+
+Boards are tested while the next ones are flashed, several at once. A
+TestScheduler hands each test a dongle from its pool, each dongle serving up
+to its maxBoards boards concurrently:
+
+  scheduler = TestScheduler()
+  scheduler.addDongle(openDongle('/dev/ttyACM1'))
+  pipeline.FlashTestPipeline(scheduler.run, testExecutor=scheduler.executor)
+
+The barobo library connects to boards through whichever dongle was set up
+last, so only one real Dongle can be open at a time. Like any Linkbot
+dongle it talks to several robots at once. For development without
+hardware, openDongle('fake') returns a FakeDongle whose boards respond like
+real Linkbots. Several FakeDongles can be pooled.
+
+The test itself is a plan: a list of steps, each with its own timeout, run
+in order by runTestRoutine(). See DEFAULT_PLAN.
+"""
+
+import random
+import threading
+import time
+import pystk500v2 as stk
+
+class LinkbotTestError(Exception):
+  pass
+
+def _checkCancelled():
+  job = stk.currentJob()
+  if job is not None:
+    job.checkCancelled()
+
+class Dongle():
+  """A Linkbot dongle on a serial port.
+
+  barobo.Linkbot.connectWithSerialID() always goes through the dongle last
+  set up with _setDongle(), so a second Dongle would take over the first
+  one's connections. Opening one while another is open raises
+  LinkbotTestError.
+
+  The dongle relays for up to maxBoards connected boards at once. Only the
+  connection handshakes are made one at a time."""
+  MAX_BOARDS = 4
+  _open = None
+  _openLock = threading.Lock()
+
+  def __init__(self, port, maxBoards=MAX_BOARDS):
+    import barobo
+    with Dongle._openLock:
+      if Dongle._open is not None:
+        raise LinkbotTestError('Only one dongle is supported; {0} is already '
+            'connected.'.format(Dongle._open.port))
+      self.port = port
+      self.maxBoards = maxBoards
+      self._connectLock = threading.Lock()
+      self.linkbot = barobo.Linkbot()
+      self.linkbot.connectWithTTY(str(port))
+      self.linkbot._setDongle()
+      Dongle._open = self
+
+  def connect(self, serialID):
+    import barobo
+    # Goes through this dongle, as it is the only one set up
+    with self._connectLock:
+      mybot = barobo.Linkbot()
+      mybot.connectWithSerialID(str(serialID))
+    return mybot
+
+  def close(self):
+    with Dongle._openLock:
+      if Dongle._open is self:
+        Dongle._open = None
+    self.linkbot.disconnect()
+
+class FakeLinkbot():
+  """Stands in for a barobo.Linkbot sitting level on the bench."""
+  def __init__(self, serialID, latency=0.01, noise=0.01, accel=(0, 0, 1)):
+    self.serialID = serialID
+    self.latency = latency
+    self.noise = noise
+    self.accel = accel
+    self.buzzer = 0
+    self.color = (0, 0, 0)
+
+  def _command(self):
+    time.sleep(self.latency)
+
+  def setBuzzerFrequency(self, freq):
+    self._command()
+    self.buzzer = freq
+
+  def setColorRGB(self, r, g, b):
+    self._command()
+    self.color = (r, g, b)
+
+  def getAccelerometerData(self):
+    self._command()
+    return tuple(a + random.gauss(0, self.noise) for a in self.accel)
+
+  def disconnect(self):
+    pass
+
+class FakeDongle():
+  """A dongle whose boards are FakeLinkbots. Each connection attempt fails
+  with probability failRate, to exercise the retry logic."""
+  def __init__(self, port='fake', failRate=0.0, maxBoards=Dongle.MAX_BOARDS,
+      **linkbotArgs):
+    self.port = port
+    self.failRate = failRate
+    self.maxBoards = maxBoards
+    self.linkbotArgs = linkbotArgs
+
+  def connect(self, serialID):
+    time.sleep(0.05)
+    if random.random() < self.failRate:
+      raise IOError('No response from {0}'.format(serialID))
+    return FakeLinkbot(serialID, **self.linkbotArgs)
+
+  def close(self):
+    pass
+
+def openDongle(port):
+  """Connect to the dongle on port, or a FakeDongle if port starts with
+  'fake'."""
+  if str(port).startswith('fake'):
+    return FakeDongle(port)
+  return Dongle(port)
+
+def connect(serialID, numtries=10, dongle=None, backoff=0.1, maxBackoff=2.0):
+  """Connect to a board, retrying with exponential backoff. Without a
+  dongle, the dongle last set up in the Linkbot library is used."""
+  if dongle is None:
+    import barobo
+  delay = backoff
+  for i in range (numtries):
+    _checkCancelled()
+    try:
+      print "Connecting to {0}...".format(serialID)
+      if dongle is None:
+        mybot = barobo.Linkbot()
+        mybot.connectWithSerialID(str(serialID))
+        return mybot
+      return dongle.connect(serialID)
+    except Exception as e:
+      if i == (numtries-1):
+        raise LinkbotTestError(
+            'Could not connect wirelessly to Serial ID {0}: {1}'.format(serialID, str(e)))
+    # Spread out the retries of boards which failed together
+    time.sleep(delay * random.uniform(0.5, 1.5))
+    delay = min(delay*2, maxBackoff)
+
+def _callWithTimeout(func, timeout, *args):
+  """Call func(*args), raising LinkbotTestError if it takes longer than
+  timeout. A call which hangs is abandoned on a daemon thread."""
+  if timeout is None:
+    return func(*args)
+  result = []
+  error = []
+  def call():
+    try:
+      result.append(func(*args))
+    except Exception as e:
+      error.append(e)
+  t = threading.Thread(target=call)
+  t.daemon = True
+  t.start()
+  t.join(timeout)
+  if t.is_alive():
+    raise LinkbotTestError('Timed out after {0} s'.format(timeout))
+  if error:
+    raise error[0]
+  return result[0]
+
+class Indicate():
+  """Drive the buzzer and LED, leaving the LED alone if color is None, then
+  hold them for the operator to see and hear. The hold ends early once the
+  operator confirms."""
+  def __init__(self, name, buzzer, color, hold=0.5, timeout=2.0):
+    self.name = name
+    self.buzzer = buzzer
+    self.color = color
+    self.hold = hold
+    self.timeout = timeout
+
+  def run(self, mybot, confirm=None):
+    def drive():
+      mybot.setBuzzerFrequency(self.buzzer)
+      if self.color is not None:
+        mybot.setColorRGB(*self.color)
+    _callWithTimeout(drive, self.timeout)
+    if not self.hold:
+      return
+    if confirm is None:
+      time.sleep(self.hold)
+    elif confirm.wait(self.hold):
+      confirm.clear()
+
+class AccelerometerCheck():
+  """Check that the board is level by sampling the accelerometer until the
+  mean of each axis is conclusively inside or outside tolerance of
+  expected, at sigmas standard errors, or maxSamples have been taken.
+
+  The standard deviation of a reading is taken to be at least noise, which
+  also stands in for it before there are two readings to estimate it from.
+  A board reading well within tolerance therefore passes on one sample, but
+  it is only failed early once minFailSamples readings have measured the
+  actual noise, so that one noisy reading cannot fail a level board."""
+  def __init__(self, expected=(0, 0, 1), tolerance=0.1, minSamples=1,
+      minFailSamples=3, maxSamples=20, sigmas=3.0, noise=0.01, interval=0.0,
+      timeout=5.0):
+    self.name = 'accelerometer'
+    self.expected = expected
+    self.tolerance = tolerance
+    self.minSamples = minSamples
+    self.minFailSamples = minFailSamples
+    self.maxSamples = maxSamples
+    self.sigmas = sigmas
+    self.noise = noise
+    self.interval = interval
+    self.timeout = timeout
+
+  def run(self, mybot, confirm=None):
+    n = 0
+    mean = [0.0, 0.0, 0.0]
+    m2 = [0.0, 0.0, 0.0]
+    deadline = time.time() + self.timeout
+    while True:
+      _checkCancelled()
+      sample = _callWithTimeout(mybot.getAccelerometerData,
+          max(deadline - time.time(), 0.01))
+      n += 1
+      # Welford's running mean and variance
+      for i in range(3):
+        delta = sample[i] - mean[i]
+        mean[i] += delta/n
+        m2[i] += delta*(sample[i] - mean[i])
+      if n >= self.maxSamples or time.time() > deadline:
+        break
+      if n >= self.minSamples:
+        if n > 1:
+          std = [max((m2[i]/(n-1))**0.5, self.noise) for i in range(3)]
+        else:
+          std = [self.noise]*3
+        margin = [self.sigmas*std[i]/n**0.5 for i in range(3)]
+        error = [abs(mean[i] - self.expected[i]) for i in range(3)]
+        inside = all(error[i] + margin[i] < self.tolerance for i in range(3))
+        outside = n >= self.minFailSamples and \
+            any(error[i] - margin[i] > self.tolerance for i in range(3))
+        if inside or outside:
+          break
+      if self.interval:
+        time.sleep(self.interval)
+    if any(abs(mean[i] - self.expected[i]) > self.tolerance for i in range(3)):
+      raise LinkbotTestError("Error: Detected anomaly in accelerometer readings: "
+          "({0:.3f}, {1:.3f}, {2:.3f}) over {3} samples. Should be {4}".format(
+            mean[0], mean[1], mean[2], n, self.expected))
+    return {'samples' : n, 'mean' : tuple(mean)}
+
+DEFAULT_PLAN = [
+    Indicate('red', 220, (0xff, 0, 0)),
+    Indicate('green', 440, (0, 0xff, 0)),
+    Indicate('blue', 220, (0, 0, 0xff)),
+    Indicate('quiet', 0, None, hold=0),
+    AccelerometerCheck(),
+    ]
+
+def runTestRoutine(serialID, dongle=None, plan=None, confirm=None):
+  """Connect to a board and run the steps of plan, DEFAULT_PLAN if not
+  given, in order. Each step has a run(mybot, confirm) method which raises
+  on failure. If confirm is a threading.Event, setting it ends an
+  indication step's hold early. Returns a dict of each step's duration and
+  result."""
+  if plan is None:
+    plan = DEFAULT_PLAN
+  print "Testing {0}...".format(serialID)
+  mybot = connect(serialID, dongle=dongle)
+  results = {}
+  try:
+    for step in plan:
+      _checkCancelled()
+      start = time.time()
+      try:
+        result = step.run(mybot, confirm)
+      except LinkbotTestError as e:
+        raise LinkbotTestError('{0}: {1}'.format(step.name, str(e)))
+      results[step.name] = {'time' : time.time() - start, 'result' : result}
+  finally:
+    try:
+      mybot.disconnect()
+    except Exception:
+      pass
+  return results
+
+class TestScheduler():
+  """Runs board tests concurrently over a pool of dongles.
+
+  Each test is given the least busy dongle with fewer than its maxBoards
+  tests running on it, or boardsPerDongle if given, waiting for one if all
+  are busy. executor runs up to
+  maxConcurrent tests at once and can be given to a FlashTestPipeline along
+  with run() as its test function. testFunc is called as
+  testFunc(serialID, dongle=dongle, confirm=event), and confirm() sets the
+  event so that the operator can cut short an indication's hold.
+  """
+  def __init__(self, testFunc=runTestRoutine, boardsPerDongle=None,
+      maxConcurrent=4):
+    self.testFunc = testFunc
+    self.boardsPerDongle = boardsPerDongle
+    self.executor = stk.JobExecutor(numWorkers=maxConcurrent)
+    self._active = {}
+    self._dongles = []
+    # serialID -> confirm Event of each running test
+    self._confirms = {}
+    self._cond = threading.Condition()
+
+  def addDongle(self, dongle):
+    with self._cond:
+      self._dongles.append(dongle)
+      self._active[dongle] = 0
+      self._cond.notifyAll()
+
+  def removeDongle(self, dongle):
+    """Stop handing out dongle. Tests already using it carry on."""
+    with self._cond:
+      self._dongles.remove(dongle)
+
+  def dongles(self):
+    with self._cond:
+      return list(self._dongles)
+
+  def acquire(self):
+    with self._cond:
+      while True:
+        _checkCancelled()
+        free = [d for d in self._dongles
+            if self._active[d] < self._capacity(d)]
+        if free:
+          dongle = min(free, key=lambda d: self._active[d])
+          self._active[dongle] += 1
+          return dongle
+        # Wake up periodically so that a cancelled test stops waiting
+        self._cond.wait(0.5)
+
+  def _capacity(self, dongle):
+    if self.boardsPerDongle is not None:
+      return self.boardsPerDongle
+    return dongle.maxBoards
+
+  def release(self, dongle):
+    with self._cond:
+      self._active[dongle] -= 1
+      self._cond.notifyAll()
+
+  def run(self, serialID):
+    """Test one board on the next free dongle."""
+    dongle = self.acquire()
+    job = stk.currentJob()
+    if job is not None:
+      # The test itself starts once it has a dongle
+      job.started = time.time()
+    confirm = threading.Event()
+    with self._cond:
+      self._confirms[serialID] = confirm
+    try:
+      return self.testFunc(serialID, dongle=dongle, confirm=confirm)
+    finally:
+      with self._cond:
+        if self._confirms.get(serialID) is confirm:
+          del self._confirms[serialID]
+      self.release(dongle)
+
+  def confirm(self, serialID=None):
+    """The operator has seen and heard the current indication of the test
+    of serialID, or of every running test."""
+    with self._cond:
+      events = [event for s, event in self._confirms.items()
+          if serialID is None or s == serialID]
+    for event in events:
+      event.set()
+
+  def submit(self, serialID):
+    """Queue a test of serialID on the executor, returning its job."""
+    job = stk.ProgrammingJob(self.run, args=(serialID,), name=serialID)
+    return self.executor.submit(job)
+
+  def shutdown(self, wait=True):
+    self.executor.shutdown(wait)
+    for dongle in self.dongles():
+      try:
+        dongle.close()
+      except Exception:
+        pass
@@ -0,0 +1,191 @@
+"""
+A two stage flash-and-test pipeline for the programming line.
+
+Boards are flashed on a programmer and then functionally tested over the
+dongle. The stages run on separate executors, so while board N is being
+tested wirelessly the operator can already flash board N+1, and line
+throughput is set by the slower stage rather than the sum of both. Results
+are correlated by the board's serial ID.
+"""
+
+import threading
+import time
+import pystk500v2 as stk
+
+def storesSerialID(stats):
+  """Whether a flashed board was given its serial ID, and so can be found
+  over the dongle. Boards such as the USB board store none."""
+  device = stats.get('device')
+  if device is None:
+    return True
+  return stk.profileByName(device).serialIDAddress is not None
+
+class BoardRecord():
+  FLASHING = 'flashing'
+  FLASHED = 'flashed'
+  TESTING = 'testing'
+  PASSED = 'passed'
+  FAILED = 'failed'
+  CANCELLED = 'cancelled'
+
+  def __init__(self, serialID, port=None, jig=None):
+    self.serialID = serialID
+    self.port = port
+    self.jig = jig
+    self.status = self.FLASHING
+    self.stage = 'flash'
+    self.error = None
+    self.flashJob = None
+    self.testJob = None
+    self.started = time.time()
+    self.flashed = None
+    self.testQueued = None
+    self.testStarted = None
+    self.finished = None
+
+  def done(self):
+    return self.status in (self.FLASHED, self.PASSED, self.FAILED, self.CANCELLED)
+
+  def __repr__(self):
+    return 'BoardRecord({0!r}, status={1!r})'.format(self.serialID, self.status)
+
+class FlashTestPipeline():
+  """Runs flashing and functional testing of boards as overlapping stages.
+
+  testFunc(serialID) is called on the test executor once a board has been
+  flashed successfully and should raise on failure. Listeners are called
+  with the BoardRecord from worker threads whenever a board changes state.
+  If a productiondb.RunLog is given, each finished board is logged to it,
+  under the jig given for the board, else the pipeline's jig, else the
+  programmer's port.
+  """
+  def __init__(self, testFunc, flashExecutor=None, testExecutor=None,
+      runLog=None, jig=None):
+    self.testFunc = testFunc
+    self.flashExecutor = flashExecutor
+    self.runLog = runLog
+    self.jig = jig
+    # One dongle serves one board at a time
+    if testExecutor is None:
+      testExecutor = stk.JobExecutor(numWorkers=1)
+    self.testExecutor = testExecutor
+    self.boards = {}
+    self._listeners = []
+    self._lock = threading.Lock()
+
+  def addListener(self, callback):
+    self._listeners.append(callback)
+
+  def removeListener(self, callback):
+    self._listeners.remove(callback)
+
+  def submit(self, programmer, serialID, test=True, key=None, jig=None,
+      **kwargs):
+    """Flash a board and, if test is True, queue its test once flashing
+    succeeds. Returns the board's BoardRecord, which is kept under key, by
+    default the serial ID. serialID may be None for boards which do not
+    store one, in which case a key must be given. jig names the jig the
+    board is on, which unlike the port stays the same when its programmer
+    is replugged."""
+    record = self._newRecord(serialID, programmer.ser.port, key, jig)
+    record.flashJob = programmer.programAllAsync(
+        serialID=serialID, executor=self.flashExecutor, **kwargs)
+    record.flashJob.addDoneCallback(lambda job: self._onFlashed(record, test))
+    return record
+
+  def test(self, serialID):
+    """Queue only the test stage for an already flashed board."""
+    record = self._newRecord(serialID)
+    self._startTest(record)
+    return record
+
+  def board(self, serialID):
+    return self.boards.get(serialID)
+
+  def pending(self):
+    with self._lock:
+      return [r for r in self.boards.values() if not r.done()]
+
+  def _newRecord(self, serialID, port=None, key=None, jig=None):
+    record = BoardRecord(serialID, port, jig)
+    with self._lock:
+      self.boards[serialID if key is None else key] = record
+    self._notify(record)
+    return record
+
+  def _onFlashed(self, record, test):
+    job = record.flashJob
+    record.flashed = time.time()
+    if job.cancelled():
+      self._finish(record, BoardRecord.CANCELLED)
+    elif job.exception() is not None:
+      # Report the phase of programming which failed
+      phases = job.stats.get('phases')
+      if phases:
+        record.stage = phases[-1][0]
+      self._finish(record, BoardRecord.FAILED, job.exception())
+    elif test and storesSerialID(job.stats):
+      self._startTest(record)
+    else:
+      self._finish(record, BoardRecord.FLASHED)
+
+  def _startTest(self, record):
+    record.status = BoardRecord.TESTING
+    record.stage = 'test'
+    record.testQueued = time.time()
+    record.testJob = stk.ProgrammingJob(self.testFunc, args=(record.serialID,),
+        name=record.serialID)
+    record.testJob.addDoneCallback(lambda job: self._onTested(record))
+    self._notify(record)
+    self.testExecutor.submit(record.testJob)
+
+  def _onTested(self, record):
+    job = record.testJob
+    # Not when it was queued, which may have been long before it got a dongle
+    record.testStarted = job.started
+    if job.cancelled():
+      self._finish(record, BoardRecord.CANCELLED)
+    elif job.exception() is not None:
+      self._finish(record, BoardRecord.FAILED, job.exception())
+    else:
+      self._finish(record, BoardRecord.PASSED)
+
+  def _finish(self, record, status, error=None):
+    record.status = status
+    record.error = error
+    record.finished = time.time()
+    if self.runLog is not None:
+      self._log(record)
+    self._notify(record)
+
+  def _log(self, record):
+    stats = {}
+    if record.flashJob is not None:
+      stats = record.flashJob.stats
+    phases = list(stats.get('phases', []))
+    if record.testQueued is not None:
+      started = record.testStarted or record.finished
+      phases.append(('test_wait', started - record.testQueued))
+      if record.testStarted is not None:
+        phases.append(('test', record.finished - record.testStarted))
+    try:
+      # A reserved ID given to a board which turned out not to store one
+      # was never written to it
+      serialID = record.serialID if storesSerialID(stats) else None
+      self.runLog.record(record.started, record.finished, record.status,
+          serialID=serialID,
+          jig=record.jig or self.jig or record.port,
+          port=record.port,
+          images=stats.get('images'),
+          imageHash=stats.get('imageHash'),
+          fuses=stats.get('fuses'),
+          phases=phases,
+          retries=stats.get('retries', 0),
+          stage=record.stage,
+          error=record.error)
+    except Exception as e:
+      print "Could not log run for {0}: {1}".format(record.serialID, str(e))
+
+  def _notify(self, record):
+    for callback in list(self._listeners):
+      callback(record)
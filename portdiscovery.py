@@ -0,0 +1,257 @@
+"""
+Discovery of the programmers and Linkbot dongles attached to a programming
+station.
+
+The USB serial ports are enumerated once and identified by their USB
+VID/PID. A background thread then watches for ports being added or removed
+by re-listing the USB devices, which unlike opening each port is cheap on
+every platform. Jigs are bound to programmers by USB serial number, so a
+replugged programmer is found again even if the OS gives it a new port name.
+"""
+
+import json
+import os
+import re
+import threading
+
+PGM03A = 'pgm03a'
+PGM03A_TTL = 'pgm03a-ttl'
+LINKBOT_DONGLE = 'dongle'
+UNKNOWN = 'unknown'
+
+# (VID, PID) -> kind of device
+KNOWN_DEVICES = {
+    (0x1ffb, 0x0081) : PGM03A,         # Pololu USB AVR Programmer
+    (0x03eb, 0x204b) : LINKBOT_DONGLE, # Linkbot (LUFA CDC) used as a dongle
+    }
+
+def registerDevice(vid, pid, kind):
+  """Teach discovery about another USB device."""
+  KNOWN_DEVICES[(vid, pid)] = kind
+
+class PortInfo():
+  def __init__(self, device, vid=None, pid=None, serialNumber=None,
+      location=None, description=''):
+    self.device = device
+    self.vid = vid
+    self.pid = pid
+    self.serialNumber = serialNumber
+    self.location = location
+    self.description = description or ''
+    self.kind = KNOWN_DEVICES.get((vid, pid), UNKNOWN)
+
+  def key(self):
+    return (self.device, self.vid, self.pid, self.serialNumber)
+
+  def label(self):
+    if self.kind == UNKNOWN:
+      return self.device
+    return '{0} ({1} {2})'.format(self.device, self.kind, self.serialNumber or '')
+
+  def __repr__(self):
+    return 'PortInfo({0!r}, kind={1!r}, serial={2!r})'.format(
+        self.device, self.kind, self.serialNumber)
+
+_hwidRe = re.compile(r'VID:PID=([0-9a-fA-F]{4}):([0-9a-fA-F]{4})(?:\s+(?:SER|SNR)=(\S+))?')
+
+def _portInfoFromComport(port):
+  # pyserial >= 2.7 returns ListPortInfo objects; older versions return
+  # (device, description, hwid) tuples.
+  device = getattr(port, 'device', None) or port[0]
+  vid = getattr(port, 'vid', None)
+  pid = getattr(port, 'pid', None)
+  serialNumber = getattr(port, 'serial_number', None)
+  if vid is None:
+    m = _hwidRe.search(port[2])
+    if m:
+      vid = int(m.group(1), 16)
+      pid = int(m.group(2), 16)
+      serialNumber = m.group(3)
+  return PortInfo(device,
+                  vid=vid,
+                  pid=pid,
+                  serialNumber=serialNumber,
+                  location=getattr(port, 'location', None),
+                  description=getattr(port, 'interface', None) or port[1])
+
+def enumeratePorts():
+  """List the serial ports currently attached, identified by VID/PID."""
+  from serial.tools import list_ports
+  ports = [_portInfoFromComport(p) for p in list_ports.comports()]
+  _classifyPGM03A(ports)
+  return ports
+
+def _classifyPGM03A(ports):
+  # The PGM03A exposes two CDC ports with the same serial number: the
+  # programming port (USB interface 0) and a TTL serial port.
+  bySerial = {}
+  for p in ports:
+    if p.kind == PGM03A:
+      bySerial.setdefault(p.serialNumber, []).append(p)
+  for group in bySerial.values():
+    if len(group) < 2:
+      continue
+    def isProgrammingPort(p):
+      if 'programming' in p.description.lower():
+        return True
+      return p.location is not None and p.location.endswith(':1.0')
+    progports = [p for p in group if isProgrammingPort(p)]
+    if not progports:
+      progports = sorted(group, key=lambda p: p.device)[:1]
+    for p in group:
+      if p not in progports:
+        p.kind = PGM03A_TTL
+
+class PortDiscovery():
+  """A cached, hotplug-aware index of the station's serial devices."""
+  ADDED = 'added'
+  REMOVED = 'removed'
+
+  def __init__(self, bindingsFile=None, interval=1.0, enumerator=enumeratePorts):
+    self.bindingsFile = bindingsFile
+    self.interval = interval
+    self._enumerate = enumerator
+    self._ports = {}
+    self._listeners = []
+    self._lock = threading.RLock()
+    self._stopEvent = threading.Event()
+    self._thread = None
+    self._bindings = {}
+    if bindingsFile is not None and os.path.exists(bindingsFile):
+      with open(bindingsFile, 'r') as f:
+        self._bindings = json.load(f)
+    self.refresh()
+
+  def addListener(self, callback):
+    """callback(event, portinfo) is called from the watcher thread."""
+    self._listeners.append(callback)
+
+  def removeListener(self, callback):
+    self._listeners.remove(callback)
+
+  def refresh(self):
+    """Re-list the attached ports and fire events for any changes."""
+    current = dict((p.key(), p) for p in self._enumerate())
+    with self._lock:
+      added = [p for k, p in current.items() if k not in self._ports]
+      removed = [p for k, p in self._ports.items() if k not in current]
+      self._ports = current
+    for p in removed:
+      self._notify(self.REMOVED, p)
+    for p in added:
+      self._notify(self.ADDED, p)
+    return added, removed
+
+  def start(self):
+    """Start watching for hotplug events in a background thread."""
+    if self._thread is not None:
+      return
+    self._stopEvent.clear()
+    self._thread = threading.Thread(target=self._watch, name='port-discovery')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self):
+    if self._thread is None:
+      return
+    self._stopEvent.set()
+    self._thread.join()
+    self._thread = None
+
+  def ports(self, kind=None):
+    with self._lock:
+      ports = list(self._ports.values())
+    if kind is not None:
+      ports = [p for p in ports if p.kind == kind]
+    return sorted(ports, key=lambda p: p.device)
+
+  def devices(self, kind=None):
+    return [p.device for p in self.ports(kind)]
+
+  def programmers(self):
+    return self.ports(PGM03A)
+
+  def dongles(self):
+    return self.ports(LINKBOT_DONGLE)
+
+  def portForSerial(self, serialNumber, kind=PGM03A):
+    """Return the device name currently used by the USB device with the
+    given serial number, or None if it is not attached."""
+    for p in self.ports(kind):
+      if p.serialNumber == serialNumber:
+        return p.device
+    return None
+
+  def bindJig(self, jigName, serialNumber):
+    with self._lock:
+      self._bindings[jigName] = serialNumber
+      self._saveBindings()
+
+  def unbindJig(self, jigName):
+    with self._lock:
+      self._bindings.pop(jigName, None)
+      self._saveBindings()
+
+  def autoBind(self, prefix='Jig '):
+    """Bind any programmer not yet associated with a jig to a new jig name.
+    Returns the names of the newly bound jigs."""
+    newJigs = []
+    with self._lock:
+      bound = set(self._bindings.values())
+      n = len(self._bindings)
+      for p in self.programmers():
+        if p.serialNumber is None or p.serialNumber in bound:
+          continue
+        n += 1
+        while prefix + str(n) in self._bindings:
+          n += 1
+        self._bindings[prefix + str(n)] = p.serialNumber
+        bound.add(p.serialNumber)
+        newJigs.append(prefix + str(n))
+      if newJigs:
+        self._saveBindings()
+    return newJigs
+
+  def jigs(self):
+    """Return a dict mapping jig names to their current programmer port,
+    or None for jigs whose programmer is unplugged."""
+    with self._lock:
+      bindings = dict(self._bindings)
+    return dict((name, self.portForSerial(serial))
+        for name, serial in bindings.items())
+
+  def portForJig(self, jigName):
+    with self._lock:
+      serialNumber = self._bindings.get(jigName)
+    if serialNumber is None:
+      return None
+    return self.portForSerial(serialNumber)
+
+  def jigForPort(self, device):
+    """Return the name of the jig whose programmer is currently on device,
+    or None if it is not bound to one."""
+    for p in self.programmers():
+      if p.device != device or p.serialNumber is None:
+        continue
+      with self._lock:
+        for name, serialNumber in self._bindings.items():
+          if serialNumber == p.serialNumber:
+            return name
+    return None
+
+  def _saveBindings(self):
+    if self.bindingsFile is None:
+      return
+    with open(self.bindingsFile, 'w') as f:
+      json.dump(self._bindings, f, indent=2, sort_keys=True)
+
+  def _notify(self, event, port):
+    for callback in list(self._listeners):
+      callback(event, port)
+
+  def _watch(self):
+    while not self._stopEvent.wait(self.interval):
+      try:
+        self.refresh()
+      except Exception as e:
+        print "Port discovery failed: {0}".format(str(e))
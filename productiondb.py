@@ -0,0 +1,394 @@
+"""
+The programming station's local production database.
+
+The database is a single SQLite file shared by every jig and process on the
+station. SQLite's locking makes allocations atomic across processes, so
+several programs may hand out serial IDs from the same file concurrently.
+
+Every programming and test run is also logged here. To summarise the line's
+throughput, phase timings and failure rates, run:
+
+  python productiondb.py report [--db production.db] [--hours 24]
+
+Serial IDs given to boards before the allocator was used must be imported,
+one per line, so that they are never handed out again:
+
+  python productiondb.py import-ids ids.txt [--db production.db]
+"""
+
+import json
+import sqlite3
+import sys
+import threading
+import time
+
+DEFAULT_DATABASE = 'production.db'
+
+def openDatabase(path=DEFAULT_DATABASE):
+  """Open (creating if needed) the production database at path."""
+  conn = sqlite3.connect(path, timeout=30, isolation_level=None,
+      check_same_thread=False)
+  # Readers do not block the writer, and vice versa
+  conn.execute('PRAGMA journal_mode=WAL')
+  return conn
+
+class SerialIDAllocator():
+  """Hands out unique 4 character Linkbot serial IDs.
+
+  IDs are generated from a persistent sequence number, scattered over the ID
+  space by a fixed stride so that consecutive boards get visibly different
+  IDs. Each ID is first reserved for a jig, and then either committed to the
+  board and firmware it was flashed onto, or released again if programming
+  failed. Released IDs are handed out again before new ones.
+  """
+  ALPHABET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+  LENGTH = 4
+  STRIDE = 7919 # Prime, and so coprime to the size of the ID space
+
+  RESERVED = 'reserved'
+  ASSIGNED = 'assigned'
+  RELEASED = 'released'
+
+  def __init__(self, path=DEFAULT_DATABASE, conn=None):
+    self.conn = conn if conn is not None else openDatabase(path)
+    self.size = len(self.ALPHABET) ** self.LENGTH
+    self._lock = threading.Lock()
+    with self._lock:
+      self.conn.executescript("""
+        CREATE TABLE IF NOT EXISTS serial_ids (
+          serial_id TEXT PRIMARY KEY,
+          state TEXT NOT NULL,
+          jig TEXT,
+          board TEXT,
+          firmware TEXT,
+          reserved_at REAL,
+          assigned_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS serial_ids_state ON serial_ids(state);
+        CREATE TABLE IF NOT EXISTS allocator_state (
+          name TEXT PRIMARY KEY,
+          value INTEGER NOT NULL
+        );
+        """)
+
+  def encode(self, index):
+    chars = []
+    for i in range(self.LENGTH):
+      index, digit = divmod(index, len(self.ALPHABET))
+      chars.append(self.ALPHABET[digit])
+    return ''.join(reversed(chars))
+
+  def reserve(self, jig=None):
+    """Reserve and return a serial ID which has never been assigned."""
+    with self._lock:
+      cur = self.conn.cursor()
+      cur.execute('BEGIN IMMEDIATE')
+      try:
+        row = cur.execute(
+            'SELECT serial_id FROM serial_ids WHERE state = ? LIMIT 1',
+            (self.RELEASED,)).fetchone()
+        if row is not None:
+          serialID = str(row[0])
+        else:
+          serialID = self._nextUnused(cur)
+        cur.execute('INSERT OR REPLACE INTO serial_ids '
+            '(serial_id, state, jig, reserved_at) VALUES (?, ?, ?, ?)',
+            (serialID, self.RESERVED, jig, time.time()))
+        cur.execute('COMMIT')
+      except:
+        cur.execute('ROLLBACK')
+        raise
+    return serialID
+
+  def commit(self, serialID, board=None, firmware=None):
+    """Record that serialID was written to board with the given firmware."""
+    self._execute('UPDATE serial_ids SET state = ?, board = ?, firmware = ?, '
+        'assigned_at = ? WHERE serial_id = ?',
+        (self.ASSIGNED, board, firmware, time.time(), serialID))
+
+  def release(self, serialID):
+    """Return a reserved but unused serial ID to the pool."""
+    self._execute('UPDATE serial_ids SET state = ? '
+        'WHERE serial_id = ? AND state = ?',
+        (self.RELEASED, serialID, self.RESERVED))
+
+  def recordExisting(self, serialID, board=None, firmware=None):
+    """Mark a serial ID that was assigned outside of the allocator as used."""
+    self._execute('INSERT OR REPLACE INTO serial_ids '
+        '(serial_id, state, board, firmware, assigned_at) VALUES (?, ?, ?, ?, ?)',
+        (serialID, self.ASSIGNED, board, firmware, time.time()))
+
+  def importExisting(self, serialIDs):
+    """Mark many serial IDs already in the field as used, in one
+    transaction. IDs the allocator has assigned keep their records, and
+    released ones become assigned. Returns the number of IDs newly marked
+    as used."""
+    serialIDs = [str(s).strip().upper() for s in serialIDs]
+    for serialID in serialIDs:
+      if len(serialID) != self.LENGTH or \
+          any(c not in self.ALPHABET for c in serialID):
+        raise ValueError('Invalid serial ID: {0!r}'.format(serialID))
+    now = time.time()
+    with self._lock:
+      cur = self.conn.cursor()
+      cur.execute('BEGIN IMMEDIATE')
+      try:
+        count = 0
+        for serialID in serialIDs:
+          cur.execute('INSERT OR IGNORE INTO serial_ids '
+              '(serial_id, state, assigned_at) VALUES (?, ?, ?)',
+              (serialID, self.ASSIGNED, now))
+          count += cur.rowcount
+          cur.execute('UPDATE serial_ids SET state = ?, assigned_at = ? '
+              'WHERE serial_id = ? AND state = ?',
+              (self.ASSIGNED, now, serialID, self.RELEASED))
+          count += cur.rowcount
+        cur.execute('COMMIT')
+      except:
+        cur.execute('ROLLBACK')
+        raise
+    return count
+
+  def expireReservations(self, maxAge=3600):
+    """Release reservations left behind by jigs that crashed or were closed."""
+    self._execute('UPDATE serial_ids SET state = ? '
+        'WHERE state = ? AND reserved_at < ?',
+        (self.RELEASED, self.RESERVED, time.time() - maxAge))
+
+  def lookup(self, serialID):
+    with self._lock:
+      row = self.conn.execute('SELECT serial_id, state, jig, board, firmware, '
+          'reserved_at, assigned_at FROM serial_ids WHERE serial_id = ?',
+          (serialID,)).fetchone()
+    if row is None:
+      return None
+    return dict(zip(('serialID', 'state', 'jig', 'board', 'firmware',
+        'reservedAt', 'assignedAt'), row))
+
+  def _nextUnused(self, cur):
+    row = cur.execute('SELECT value FROM allocator_state WHERE name = ?',
+        ('sequence',)).fetchone()
+    seq = row[0] if row is not None else 1
+    # Skips only imported or recordExisting() IDs, so this is O(1) amortised
+    tries = 0
+    while True:
+      serialID = self.encode((seq * self.STRIDE) % self.size)
+      seq += 1
+      if cur.execute('SELECT 1 FROM serial_ids WHERE serial_id = ?',
+          (serialID,)).fetchone() is None:
+        break
+      tries += 1
+      if tries >= self.size:
+        raise Exception('All serial IDs have been allocated.')
+    cur.execute('INSERT OR REPLACE INTO allocator_state (name, value) '
+        'VALUES (?, ?)', ('sequence', seq))
+    return serialID
+
+  def _execute(self, sql, args):
+    with self._lock:
+      self.conn.execute(sql, args)
+
+class RunLog():
+  """An append-only log of board programming and test runs."""
+  def __init__(self, path=DEFAULT_DATABASE, conn=None):
+    self.conn = conn if conn is not None else openDatabase(path)
+    self._lock = threading.Lock()
+    with self._lock:
+      self.conn.executescript("""
+        CREATE TABLE IF NOT EXISTS runs (
+          id INTEGER PRIMARY KEY,
+          started REAL NOT NULL,
+          finished REAL NOT NULL,
+          serial_id TEXT,
+          jig TEXT,
+          port TEXT,
+          images TEXT,
+          image_hash TEXT,
+          hfuse INTEGER,
+          lfuse INTEGER,
+          efuse INTEGER,
+          retries INTEGER NOT NULL DEFAULT 0,
+          outcome TEXT NOT NULL,
+          stage TEXT,
+          error TEXT
+        );
+        CREATE INDEX IF NOT EXISTS runs_started ON runs(started);
+        CREATE INDEX IF NOT EXISTS runs_serial_id ON runs(serial_id);
+        CREATE INDEX IF NOT EXISTS runs_jig ON runs(jig, started);
+        CREATE TABLE IF NOT EXISTS phases (
+          run_id INTEGER NOT NULL REFERENCES runs(id),
+          phase TEXT NOT NULL,
+          duration REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS phases_run_id ON phases(run_id);
+        CREATE INDEX IF NOT EXISTS phases_phase ON phases(phase);
+        """)
+
+  def record(self, started, finished, outcome, serialID=None, jig=None,
+      port=None, images=None, imageHash=None, fuses=None, phases=(),
+      retries=0, stage=None, error=None):
+    """Append a run. phases is a sequence of (name, seconds) pairs. Returns
+    the new run's id."""
+    fuses = fuses or {}
+    if images is not None and not isinstance(images, basestring):
+      images = ','.join(images)
+    with self._lock:
+      cur = self.conn.cursor()
+      cur.execute('BEGIN IMMEDIATE')
+      try:
+        cur.execute('INSERT INTO runs (started, finished, serial_id, jig, '
+            'port, images, image_hash, hfuse, lfuse, efuse, retries, outcome, '
+            'stage, error) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (started, finished, serialID, jig, port, images, imageHash,
+              fuses.get('hfuse'), fuses.get('lfuse'), fuses.get('efuse'),
+              retries, outcome, stage, None if error is None else str(error)))
+        runID = cur.lastrowid
+        cur.executemany('INSERT INTO phases (run_id, phase, duration) '
+            'VALUES (?, ?, ?)', [(runID, name, d) for name, d in phases])
+        cur.execute('COMMIT')
+      except:
+        cur.execute('ROLLBACK')
+        raise
+    return runID
+
+  def history(self, limit=50, serialID=None):
+    """Return the most recent runs, newest first, as dicts."""
+    sql = ('SELECT id, started, finished, serial_id, jig, port, images, '
+        'image_hash, retries, outcome, stage, error FROM runs')
+    args = ()
+    if serialID is not None:
+      sql += ' WHERE serial_id = ?'
+      args = (serialID,)
+    sql += ' ORDER BY started DESC LIMIT ?'
+    with self._lock:
+      rows = self.conn.execute(sql, args + (limit,)).fetchall()
+    keys = ('id', 'started', 'finished', 'serialID', 'jig', 'port', 'images',
+        'imageHash', 'retries', 'outcome', 'stage', 'error')
+    return [dict(zip(keys, row)) for row in rows]
+
+  def phaseDurations(self, since=0):
+    """Return a dict mapping phase names to lists of their durations, for
+    runs started since the given time."""
+    with self._lock:
+      rows = self.conn.execute('SELECT phases.phase, phases.duration '
+          'FROM phases JOIN runs ON phases.run_id = runs.id '
+          'WHERE runs.started >= ?', (since,)).fetchall()
+    durations = {}
+    for phase, duration in rows:
+      durations.setdefault(phase, []).append(duration)
+    return durations
+
+  def runPhases(self, since=0):
+    """Return (outcome, stage, {phase: seconds}) for each run started since
+    the given time, oldest first."""
+    with self._lock:
+      rows = self.conn.execute('SELECT runs.id, runs.outcome, runs.stage, '
+          'phases.phase, phases.duration FROM runs '
+          'LEFT JOIN phases ON phases.run_id = runs.id '
+          'WHERE runs.started >= ? ORDER BY runs.started, runs.id',
+          (since,)).fetchall()
+    runs = []
+    lastID = None
+    for runID, outcome, stage, phase, duration in rows:
+      if runID != lastID:
+        runs.append((outcome, stage, {}))
+        lastID = runID
+      if phase is not None:
+        runs[-1][2][phase] = runs[-1][2].get(phase, 0.0) + duration
+    return runs
+
+  def report(self, since=0):
+    """Summarise throughput, phase timings and failure rates per jig.
+
+    Boards which were flashed but not tested, such as USB boards or boards
+    flashed without a dongle, count towards boardsPerHour along with those
+    which passed their test."""
+    with self._lock:
+      rows = self.conn.execute('SELECT jig, COUNT(*), '
+          'SUM(outcome = \'passed\'), SUM(outcome = \'flashed\'), '
+          'SUM(outcome = \'failed\'), '
+          'MIN(started), MAX(finished), SUM(retries) '
+          'FROM runs WHERE started >= ? GROUP BY jig', (since,)).fetchall()
+      failures = self.conn.execute('SELECT jig, stage, COUNT(*) FROM runs '
+          'WHERE started >= ? AND outcome = \'failed\' GROUP BY jig, stage',
+          (since,)).fetchall()
+    jigs = {}
+    for jig, runs, passed, flashed, failed, first, last, retries in rows:
+      hours = max(last - first, 1.0) / 3600.0
+      jigs[jig] = {
+          'runs' : runs,
+          'passed' : passed,
+          'flashed' : flashed,
+          'failed' : failed,
+          'failureRate' : float(failed) / runs,
+          'boardsPerHour' : (passed + flashed) / hours,
+          'retries' : retries,
+          'failedStages' : {},
+          }
+    for jig, stage, count in failures:
+      jigs[jig]['failedStages'][stage] = count
+    phases = {}
+    for phase, durations in self.phaseDurations(since).items():
+      durations.sort()
+      phases[phase] = {
+          'count' : len(durations),
+          'mean' : sum(durations) / len(durations),
+          'p50' : _percentile(durations, 50),
+          'p90' : _percentile(durations, 90),
+          'p99' : _percentile(durations, 99),
+          }
+    return {'jigs' : jigs, 'phases' : phases}
+
+def _percentile(sortedValues, percent):
+  index = int(round((len(sortedValues) - 1) * percent / 100.0))
+  return sortedValues[index]
+
+def formatReport(report):
+  lines = ['{0:<20} {1:>6} {2:>6} {3:>8} {4:>8} {5:>10} {6:>8}'.format(
+      'Jig', 'Runs', 'Passed', 'Flashed', 'Fail %', 'Boards/hr', 'Retries')]
+  for jig in sorted(report['jigs'], key=str):
+    r = report['jigs'][jig]
+    lines.append('{0:<20} {1:>6} {2:>6} {3:>8} {4:>8.1f} {5:>10.1f} {6:>8}'.format(
+        str(jig), r['runs'], r['passed'], r['flashed'], r['failureRate']*100,
+        r['boardsPerHour'], r['retries']))
+    for stage in sorted(r['failedStages'], key=str):
+      lines.append('    failed in {0}: {1}'.format(stage, r['failedStages'][stage]))
+  lines.append('')
+  lines.append('{0:<20} {1:>6} {2:>8} {3:>8} {4:>8} {5:>8}'.format(
+      'Phase', 'Count', 'Mean s', 'p50 s', 'p90 s', 'p99 s'))
+  # Slowest phases first: these are where the line's time goes
+  for phase, p in sorted(report['phases'].items(), key=lambda i: -i[1]['mean']):
+    lines.append('{0:<20} {1:>6} {2:>8.3f} {3:>8.3f} {4:>8.3f} {5:>8.3f}'.format(
+        phase, p['count'], p['mean'], p['p50'], p['p90'], p['p99']))
+  return '\n'.join(lines)
+
+def main(argv):
+  import argparse
+  parser = argparse.ArgumentParser(description='Production database tools.')
+  parser.add_argument('command', choices=['report', 'import-ids'])
+  parser.add_argument('file', nargs='?',
+      help='For import-ids, a file of serial IDs, one per line.')
+  parser.add_argument('--db', default=DEFAULT_DATABASE)
+  parser.add_argument('--hours', type=float, default=None,
+      help='Only include runs from the last HOURS hours.')
+  parser.add_argument('--json', action='store_true',
+      help='Print the report as JSON.')
+  args = parser.parse_args(argv)
+  if args.command == 'import-ids':
+    if args.file is None:
+      parser.error('import-ids needs a file of serial IDs')
+    with open(args.file, 'r') as f:
+      serialIDs = [line.strip() for line in f
+          if line.strip() and not line.startswith('#')]
+    count = SerialIDAllocator(args.db).importExisting(serialIDs)
+    print 'Imported {0} serial IDs, {1} new.'.format(len(serialIDs), count)
+    return
+  since = 0 if args.hours is None else time.time() - args.hours*3600
+  report = RunLog(args.db).report(since)
+  if args.json:
+    print json.dumps(report, indent=2, sort_keys=True)
+  else:
+    print formatReport(report)
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
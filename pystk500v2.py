@@ -1,11 +1,30 @@
 """
 A Python module for communicating with stk500v2 programmers, such as the Pololu
 PGM03A for programming AVR chips.
+
+pyserial is only imported once a programmer is opened, so that the hex file
+and job handling can be used, and this module imported, without it. A
+programmer can also be given another transport from stktransport, such as a
+recording or a replay of a session. It can also be used from the command
+line:
+
+  python pystk500v2.py PORT [--device atmega32u4] [--serial-id ABCD] [HEXFILE...]
+  python pystk500v2.py PORT --dump-flash backup.hex --dump-eeprom eeprom.hex
+  python pystk500v2.py PORT --record session.stk
+
+The device is detected from the chip's signature unless --device is given,
+and its images, fuses and EEPROM contents come from its DeviceProfile.
 """
 
-import serial
+import array
+import binascii
+import bisect
+import heapq
 import threading
 import time
+import contextlib
+import hashlib
+import os
 
 class STK500():
   MESSAGE_START                       = 0x1B        
@@ -109,11 +128,29 @@ class STK500():
 
   ANSWER_CKSUM_ERROR                  = 0xB0
 
-  def __init__(self, serialport):
-    self.ser = serial.Serial(serialport, baudrate=115200)
+  def __init__(self, serialport, transport=None):
+    if transport is None:
+      import stktransport
+      transport = stktransport.SerialTransport(serialport)
+    self.ser = transport
     self.comms = _CommsEngine(self.ser)
+    self.signedOn = False
+    # The programmer's address pointer, as last loaded and then advanced by
+    # reads and writes. None when unknown.
+    self.address = None
+    self.commandsSaved = 0
+
+  def close(self):
+    self.signedOn = False
+    self.address = None
+    self.ser.close()
+
+  def _advanceAddress(self, address, count):
+    if address is not None:
+      self.address = address + count
 
   def sign_on(self):
+    self.address = None
     resp = self.comms.sendrecv([self.CMD_SIGN_ON], 0.2)
     if resp[3:] == 'AVRISP_2':
       self.programmertype = 'avrisp2'
@@ -121,6 +158,18 @@ class STK500():
       self.programmertype = 'stk500_2'
     else:
       raise Exception("Unkown programmer type: {0}".format(resp[3:]))
+    self.signedOn = True
+
+  def is_alive(self, timeout=0.2):
+    """Cheaply check that a signed on programmer still responds."""
+    if not self.signedOn:
+      return False
+    try:
+      self.get_parameter(self.PARAM_SW_MAJOR, timeout)
+      return True
+    except Exception:
+      self.signedOn = False
+      return False
 
   def set_parameter(self, param, value):
     resp = self.comms.sendrecv(
@@ -128,9 +177,9 @@ class STK500():
     if resp[0] != self.CMD_SET_PARAMETER or resp[1] != self.STATUS_CMD_OK:
       raise IOError("Error setting parameter {0} to value {0}.".format(param, value))
 
-  def get_parameter(self, param):
+  def get_parameter(self, param, timeout=1):
     resp = self.comms.sendrecv(
-        [self.CMD_GET_PARAMETER, param])
+        [self.CMD_GET_PARAMETER, param], timeout)
     if resp[0] != self.CMD_GET_PARAMETER or resp[1] != self.STATUS_CMD_OK:
       raise IOError("Error getting parameter: {0}.".format(param))
     else:
@@ -141,6 +190,12 @@ class STK500():
     return resp[1]
 
   def load_address(self, address):
+    # Flash and EEPROM accesses advance the address, so contiguous accesses
+    # need not load it again.
+    if address == self.address:
+      self.commandsSaved += 1
+      return
+    self.address = None
     addrbytes = bytearray(4)
     addrbytes[0] = (address >> 24) & 0x00ff
     addrbytes[1] = (address >> 16) & 0x00ff
@@ -150,6 +205,7 @@ class STK500():
         bytearray([self.CMD_LOAD_ADDRESS]) + addrbytes)
     if resp[0] != self.CMD_LOAD_ADDRESS or resp[1] != self.STATUS_CMD_OK:
       raise IOError("Error loading address.")
+    self.address = address
 
   def enter_progmode_isp(
       self, 
@@ -163,6 +219,7 @@ class STK500():
       cmdbytes):
     if len(cmdbytes) != 4:
       raise Exception("Expected 4 command bytes. Got {0}.".format(len(cmdbytes)))
+    self.address = None
     resp = self.comms.sendrecv(
         bytearray(
           [
@@ -181,6 +238,13 @@ class STK500():
           "board is receiving power and is correctly loaded into the programming "
           "jig.")
 
+  def leave_progmode_isp(self, preDelay=1, postDelay=1):
+    self.address = None
+    resp = self.comms.sendrecv(
+        bytearray([self.CMD_LEAVE_PROGMODE_ISP, preDelay, postDelay]))
+    if resp[0] != self.CMD_LEAVE_PROGMODE_ISP or resp[1] != self.STATUS_CMD_OK:
+      raise IOError("Error leaving programming mode.")
+
   def spi_multi(self, numRX, data, rxStartAddr):
     resp = self.comms.sendrecv(
         bytearray([self.CMD_SPI_MULTI, len(data), numRX, rxStartAddr]) + bytearray(data))
@@ -191,12 +255,14 @@ class STK500():
   def chip_erase_isp(self, eraseDelay, pollMethod, cmdbytes):
     if len(cmdbytes) != 4:
       raise Exception("Expected 4 command bytes. Got {0}.".format(len(cmdbytes)))
+    self.address = None
     resp = self.comms.sendrecv(
         bytearray([self.CMD_CHIP_ERASE_ISP, eraseDelay, pollMethod])+bytearray(cmdbytes))
     if resp[0] != self.CMD_CHIP_ERASE_ISP or resp[1] != self.STATUS_CMD_OK:
       raise IOError("Error erasing chip.")
 
   def program_flash_isp(self, numbytes, mode, delay, cmd1, cmd2, cmd3, poll1, poll2, data):
+    address, self.address = self.address, None
     buf = bytearray([self.CMD_PROGRAM_FLASH_ISP])
     buf += bytearray([ (numbytes >> 8) & 0x00ff ])
     buf += bytearray([ numbytes & 0x00ff ])
@@ -205,16 +271,20 @@ class STK500():
     resp = self.comms.sendrecv(buf, timeout=5)
     if resp[0] != self.CMD_PROGRAM_FLASH_ISP or resp[1] != self.STATUS_CMD_OK:
       raise IOError("Error programming flash.")
+    self._advanceAddress(address, numbytes//2)
 
   def read_flash_isp(self, numbytes, cmd1=0x20):
+    address, self.address = self.address, None
     buf = bytearray([self.CMD_READ_FLASH_ISP])
     buf += bytearray( [(numbytes >> 8) & 0x00ff, numbytes & 0x00ff, cmd1] )
     resp = self.comms.sendrecv(buf)
     if resp[0] != self.CMD_READ_FLASH_ISP or resp[1] != self.STATUS_CMD_OK:
       raise IOError("Error reading page from flash memory")
+    self._advanceAddress(address, numbytes//2)
     return resp[2:-1]
 
   def program_eeprom_isp(self, numbytes, mode, delay, cmd1, cmd2, cmd3, poll1, poll2, data):
+    address, self.address = self.address, None
     buf = bytearray([self.CMD_PROGRAM_EEPROM_ISP])
     buf += bytearray([ (numbytes >> 8) & 0x00ff ])
     buf += bytearray([ numbytes & 0x00ff ])
@@ -223,24 +293,373 @@ class STK500():
     resp = self.comms.sendrecv(buf, timeout=5)
     if resp[0] != self.CMD_PROGRAM_EEPROM_ISP or resp[1] != self.STATUS_CMD_OK:
       raise IOError("Error programming eeprom.")
+    self._advanceAddress(address, numbytes)
 
   def read_eeprom_isp(self, numbytes, cmd1=0xA0):
+    address, self.address = self.address, None
     buf = bytearray([self.CMD_READ_EEPROM_ISP])
     buf += bytearray( [(numbytes >> 8) & 0x00ff, numbytes & 0x00ff, cmd1] )
     resp = self.comms.sendrecv(buf)
     if resp[0] != self.CMD_READ_EEPROM_ISP or resp[1] != self.STATUS_CMD_OK:
       raise IOError("Error reading page from eeprom memory")
+    self._advanceAddress(address, numbytes)
     return resp[2:-1]
 
 
-class ATmega128rfa1Programmer(STK500):
-  HWREV_MAJ = 2
-  HWREV_MIN = 0
-  HWREV_MIC = 0
+class VerifyError(Exception):
+  """Raised when flash does not read back as programmed. pages lists the
+  byte addresses of mismatched pages, and ranges the mismatched byte
+  ranges as (start, end) pairs, end exclusive."""
+  def __init__(self, pages, ranges, actual=None):
+    self.pages = pages
+    self.ranges = ranges
+    self.actual = actual
+    numbytes = sum(end - start for start, end in ranges)
+    shown = ', '.join('0x{:05X}-0x{:05X}'.format(start, end-1)
+        for start, end in ranges[:8])
+    if len(ranges) > 8:
+      shown += ', ...'
+    Exception.__init__(self,
+        'Flash verification failed: {0} bytes differ in {1} pages ({2})'.format(
+          numbytes, len(pages), shown))
+
+def diffPages(expected, actual, pagesize):
+  """Compare two images a page at a time, returning the addresses of the
+  pages which differ and the differing byte ranges within them. Whole pages
+  are compared as slices, so only mismatched pages are examined byte by
+  byte."""
+  size = max(len(expected), len(actual))
+  pages = []
+  ranges = []
+  for page in range(0, size, pagesize):
+    want = expected[page:page+pagesize]
+    have = actual[page:page+pagesize]
+    if want == have:
+      continue
+    pages.append(page)
+    start = None
+    for i in range(max(len(want), len(have))):
+      same = i < len(want) and i < len(have) and want[i] == have[i]
+      if not same and start is None:
+        start = page + i
+      elif same and start is not None:
+        ranges.append((start, page + i))
+        start = None
+    if start is not None:
+      ranges.append((start, page + max(len(want), len(have))))
+  # Join ranges which continue across a page boundary
+  joined = []
+  for r in ranges:
+    if joined and joined[-1][1] == r[0]:
+      joined[-1] = (joined[-1][0], r[1])
+    else:
+      joined.append(r)
+  return pages, joined
+
+class JobCancelled(Exception):
+  pass
+
+class JobTimeout(Exception):
+  pass
+
+class ProgrammerBusy(Exception):
+  pass
+
+_jobContext = threading.local()
+
+def currentJob():
+  """Return the ProgrammingJob being run by the calling thread, if any."""
+  return getattr(_jobContext, 'job', None)
+
+class ProgrammingJob():
+  """A handle on a unit of work submitted to a JobExecutor.
+
+  The job may be polled (status, progress, done()), waited on with an
+  optional timeout, and cancelled. Cancellation of a running job is
+  cooperative: the programmer checks for it between pages and phases.
+
+  started is when the job began running. A job which first has to wait for
+  something, such as a dongle, sets it again once it has it, so that it
+  times only the job's own work."""
+  PENDING = 'pending'
+  RUNNING = 'running'
+  FINISHED = 'finished'
+  FAILED = 'failed'
+  CANCELLED = 'cancelled'
+
+  def __init__(self, target, args=(), kwargs=None, name=None):
+    self.target = target
+    self.args = args
+    self.kwargs = kwargs or {}
+    self.name = name
+    self.status = self.PENDING
+    self.progress = 0.0
+    self.stats = {}
+    self.started = None
+    self._result = None
+    self._exception = None
+    self._cancelRequested = False
+    self._callbacks = []
+    self._progressCallbacks = []
+    self._cond = threading.Condition()
+
+  def done(self):
+    return self.status in (self.FINISHED, self.FAILED, self.CANCELLED)
+
+  def running(self):
+    return self.status == self.RUNNING
+
+  def cancelled(self):
+    return self.status == self.CANCELLED
+
+  def cancel(self):
+    """Request cancellation. Returns False if the job has already completed."""
+    with self._cond:
+      if self.done():
+        return self.cancelled()
+      self._cancelRequested = True
+      if self.status != self.PENDING:
+        return True
+      self._finish(self.CANCELLED)
+    self._fireCallbacks()
+    return True
+
+  def cancelRequested(self):
+    return self._cancelRequested
+
+  def checkCancelled(self):
+    if self._cancelRequested:
+      raise JobCancelled("Job cancelled.")
+
+  def wait(self, timeout=None):
+    """Block until the job completes or the timeout expires. Returns done()."""
+    with self._cond:
+      if timeout is None:
+        while not self.done():
+          self._cond.wait()
+      else:
+        deadline = time.time() + timeout
+        while not self.done():
+          remaining = deadline - time.time()
+          if remaining <= 0:
+            break
+          self._cond.wait(remaining)
+      return self.done()
+
+  def result(self, timeout=None):
+    if not self.wait(timeout):
+      raise JobTimeout("Timed out waiting for job.")
+    if self.status == self.CANCELLED:
+      raise JobCancelled("Job cancelled.")
+    if self._exception is not None:
+      raise self._exception
+    return self._result
+
+  def exception(self, timeout=None):
+    if not self.wait(timeout):
+      raise JobTimeout("Timed out waiting for job.")
+    return self._exception
+
+  def setProgress(self, progress):
+    self.progress = progress
+    for callback in self._progressCallbacks:
+      callback(self)
+
+  def addProgressCallback(self, callback):
+    """Call callback(job) from the worker thread whenever the job's
+    progress changes."""
+    self._progressCallbacks.append(callback)
+
+  def addDoneCallback(self, callback):
+    """Call callback(job) from the worker thread once the job completes."""
+    with self._cond:
+      if not self.done():
+        self._callbacks.append(callback)
+        return
+    callback(self)
+
+  def _run(self):
+    with self._cond:
+      if self.status != self.PENDING:
+        return
+      self.status = self.RUNNING
+      self.started = time.time()
+    _jobContext.job = self
+    try:
+      result = self.target(*self.args, **self.kwargs)
+    except JobCancelled:
+      status = self.CANCELLED
+    except Exception as e:
+      self._exception = e
+      status = self.FAILED
+    else:
+      self._result = result
+      status = self.FINISHED
+    finally:
+      _jobContext.job = None
+    with self._cond:
+      self._finish(status)
+    self._fireCallbacks()
+
+  def _finish(self, status):
+    # Must be called with self._cond held
+    self.status = status
+    self._cond.notifyAll()
+
+  def _fireCallbacks(self):
+    if not self._callbacks:
+      return
+    with self._cond:
+      callbacks, self._callbacks = self._callbacks, []
+    for callback in callbacks:
+      callback(self)
+
+class JobExecutor():
+  """A fixed pool of worker threads that run ProgrammingJobs in submission
+  order."""
+  def __init__(self, numWorkers=4):
+    import Queue
+    self.queue = Queue.Queue()
+    self.workers = []
+    for i in range(numWorkers):
+      t = threading.Thread(target=self._work, name='stk-worker-{0}'.format(i))
+      t.daemon = True
+      t.start()
+      self.workers.append(t)
+
+  def submit(self, job):
+    self.queue.put(job)
+    return job
+
+  def shutdown(self, wait=True):
+    for t in self.workers:
+      self.queue.put(None)
+    if wait:
+      for t in self.workers:
+        t.join()
+
+  def _work(self):
+    while True:
+      job = self.queue.get()
+      if job is None:
+        return
+      job._run()
+
+_defaultExecutor = None
+_defaultExecutorLock = threading.Lock()
+
+def getDefaultExecutor():
+  """Return the process-wide JobExecutor, creating it on first use."""
+  global _defaultExecutor
+  with _defaultExecutorLock:
+    if _defaultExecutor is None:
+      _defaultExecutor = JobExecutor()
+    return _defaultExecutor
+
+def _profiled(programAll):
+  """Wrap a programAll() implementation so that runs are profiled when the
+  programmer has profiling enabled."""
+  def wrapper(self, *args, **kwargs):
+    profile = self.profile
+    if profile is None:
+      return programAll(self, *args, **kwargs)
+    profile.startRun(self)
+    error = None
+    try:
+      return programAll(self, *args, **kwargs)
+    except Exception as e:
+      error = e
+      raise
+    finally:
+      profile.finishRun(self, error)
+  wrapper.__name__ = programAll.__name__
+  wrapper.__doc__ = programAll.__doc__
+  return wrapper
+
+class DeviceProfile():
+  """Everything the programmer needs to know about one kind of board: its
+  chip's memories, page write delay and fuses, the images flashed onto it
+  and what goes in its EEPROM.
+
+  serialIDAddress is where the board's serial ID is written, or None if it
+  does not store one. eeprom is a list of (address, bytes) written after
+  the serial ID. bootSize is the size in bytes of the boot section at the
+  top of flash, as selected by the BOOTSZ fuses."""
+  def __init__(self, name, signature, flashSize, eepromSize, pageSize,
+      pageDelay, hfuse, lfuse, efuse=None, hexfiles=(),
+      serialIDAddress=None, eeprom=(), bootSize=None):
+    self.name = name
+    self.signature = signature
+    self.flashSize = flashSize
+    self.eepromSize = eepromSize
+    self.pageSize = pageSize
+    self.pageDelay = pageDelay
+    self.hfuse = hfuse
+    self.lfuse = lfuse
+    self.efuse = efuse
+    self.hexfiles = list(hexfiles)
+    self.serialIDAddress = serialIDAddress
+    self.eeprom = list(eeprom)
+    self.bootSize = bootSize
+
+  def __repr__(self):
+    return 'DeviceProfile({0}, {1:06X})'.format(self.name, self.signature)
+
+# Signature -> DeviceProfile
+DEVICE_PROFILES = {}
+
+def registerProfile(profile):
+  """Teach the programmers about another kind of board."""
+  DEVICE_PROFILES[profile.signature] = profile
+  return profile
+
+def profileByName(name):
+  for profile in DEVICE_PROFILES.values():
+    if profile.name == name:
+      return profile
+  raise KeyError('Unknown device: {0}'.format(name))
+
+# The Linkbot mainboard, hardware revision 2.0.0
+ATMEGA128RFA1 = registerProfile(DeviceProfile('atmega128rfa1',
+    signature=0x1ea701, flashSize=0x20000, eepromSize=0x1000,
+    pageSize=0x0100, pageDelay=0x14, hfuse=0xd8, lfuse=0xef, efuse=0xff,
+    hexfiles=['bootloader.hex', 'dof.hex'], bootSize=0x2000,
+    serialIDAddress=0x412, eeprom=[(0x420, [2, 0, 0])]))
+
+# The Linkbot USB board
+ATMEGA32U4 = registerProfile(DeviceProfile('atmega32u4',
+    signature=0x1e9587, flashSize=0x8000, eepromSize=0x0400,
+    pageSize=0x0080, pageDelay=0x06, hfuse=0xd9, lfuse=0xff,
+    hexfiles=['usb.hex'], bootSize=0x1000))
+
+class AVRProgrammer(STK500):
+  """An ISP programmer driven by a DeviceProfile. Without one, the device is
+  detected from each board's signature."""
   WORDSIZE = 2 # Word size in bytes, for addressing
-  def __init__(self, serialport):
-    STK500.__init__(self, serialport)
+  PAGESIZE = 0x0100
+  MAX_REPAIR_PAGES = 8
+  DEVICE = None
+
+  def __init__(self, serialport, transport=None, device=None):
+    STK500.__init__(self, serialport, transport)
+    if device is None:
+      device = self.DEVICE
+    self.autoDetect = device is None
+    self.device = None
+    if device is not None:
+      self.setDevice(device)
     self.progress = 0.0
+    self.serialID = None
+    self.lastJob = None
+    # Jobs submitted and not yet done
+    self._jobs = set()
+    self._jobsLock = threading.Lock()
+    # Serialises jobs which share this programmer's serial port
+    self.lock = threading.RLock()
+    self.profile = None
+    # An ImageCache shared between programmers, if any
+    self.imageCache = None
+    self._resetStats()
 
   def enter_progmode_isp(
       self, 
@@ -268,36 +687,59 @@ class ATmega128rfa1Programmer(STK500):
     data = self.spi_multi(4, [0x30, 0, byte, 0], 0)
     return data[3]
 
-  def check_signature(self):
+  def setDevice(self, device):
+    self.device = device
+    self.SIGNATURE = device.signature
+    self.PAGESIZE = device.pageSize
+    self.FLASHSIZE = device.flashSize
+    self.EEPROMSIZE = device.eepromSize
+    self.HFUSE = device.hfuse
+    self.LFUSE = device.lfuse
+    self.EFUSE = device.efuse
+
+  def read_signature(self):
     sig = 0
     for i in range(0, 3):
       sig |= self.get_signature_byte(i) << ((2-i)*8)
-    #print "{:06X}".format(sig)
-    if sig != 0x1ea701:
-      raise IOError("Wrong signature. Expected {:06X}, got {:06X}".format(0x1ea701, sig))
+    return sig
+
+  def check_signature(self):
+    """Check the chip against the device profile or, when auto-detecting,
+    switch to the profile for its signature."""
+    sig = self.read_signature()
+    if self.autoDetect:
+      device = DEVICE_PROFILES.get(sig)
+      if device is None:
+        raise IOError("Unknown signature {:06X}".format(sig))
+      if device is not self.device:
+        self.setDevice(device)
+      return device
+    if sig != self.SIGNATURE:
+      raise IOError("Wrong signature. Expected {:06X}, got {:06X}".format(self.SIGNATURE, sig))
+    return self.device
 
   def chip_erase_isp(self):
     STK500.chip_erase_isp(self, 0x37,0x00, [0xac,0x80,0,0])
 
-  def load_page(self, data):
-    self.program_flash_isp(
-        len(data), 
-        mode = 0xc1,
-        delay = 0x14,
-        cmd1 = 0x40,
-        cmd2 = 0x4c,
-        cmd3 = 0x20,
-        poll1 = 0,
-        poll2 = 0,
-        data=data)
-
   def load_address(self, byteaddr):
     STK500.load_address(self, byteaddr/self.WORDSIZE)
 
-  def load_data(self, data, blocksize = 0x0100):
+  def load_data(self, data, blocksize = None):
+    if blocksize is None:
+      blocksize = self.PAGESIZE
+    pages = getattr(data, 'pages', None)
+    if pages is not None and data.pagesize == blocksize:
+      # A FlashImage already lists the pages to program
+      for i, (address, page) in enumerate(pages):
+        self._checkCancelled()
+        self.load_address(address)
+        self.load_page(page)
+        self._setProgress((float(i+1)/len(pages)) * 0.5)
+      return
     size = len(data)
     currentByteAddr = 0
     while currentByteAddr < size:
+      self._checkCancelled()
       # Check to see if the page is a whole page of 0xff. If it is, no need to program it
       isblank = reduce(
           lambda x, y: True if x and y == 0xff else False,
@@ -307,34 +749,163 @@ class ATmega128rfa1Programmer(STK500):
         self.load_address(currentByteAddr)
         self.load_page(data[currentByteAddr:currentByteAddr+blocksize])
       currentByteAddr += blocksize
-      self.progress = (float(currentByteAddr)/size) * 0.5
+      self._setProgress((float(currentByteAddr)/size) * 0.5)
 
-  def check_data(self, hexdata, blocksize = 0x0100):
+  def check_data(self, hexdata, blocksize = None):
     size = len(hexdata)
-    self.load_address(0)
-    self.mydata = bytearray()
-    while len(self.mydata) < size:
-      if size - len(self.mydata) >= blocksize:
-        self.mydata += bytearray(self.read_flash_isp(blocksize))
+    def progress(done, total):
+      self._setProgress((float(done)/total)*0.5 + 0.5)
+    readback = self.readFlash(size, blocksize=blocksize, progress=progress)
+    expected = getattr(hexdata, 'data', hexdata)
+    if readback != expected:
+      pages, ranges = diffPages(expected, readback, self.PAGESIZE)
+      raise VerifyError(pages, ranges, readback)
+
+  def verify(self, hexdata, repair=True):
+    """Verify the flash against hexdata. If it does not match and repair is
+    True, try to repair the mismatched pages, re-flashing the whole image if
+    that is not possible. The check and the repair are timed as separate
+    'verify' and 'repair' phases, so that neither includes the other."""
+    with self.phase('verify'):
+      try:
+        self.check_data(hexdata)
+        return
+      except VerifyError as e:
+        if not repair:
+          raise
+        error = e
+    print "{0}. Repairing...".format(str(error))
+    with self.phase('repair'):
+      self.repair(hexdata, error)
+
+  def repair(self, hexdata, error):
+    """Re-program just the pages listed in a VerifyError where possible.
+
+    ISP programming can only clear bits and there is no page erase, so a
+    page can be repaired in place only if every bit that should be 1 still
+    reads as 1. Otherwise, or if more than MAX_REPAIR_PAGES pages differ,
+    the chip is erased and the whole image programmed again."""
+    expected = getattr(hexdata, 'data', hexdata)
+    pagesize = self.PAGESIZE
+    inPlace = len(error.pages) <= self.MAX_REPAIR_PAGES
+    for page in error.pages:
+      if not inPlace:
+        break
+      want = expected[page:page+pagesize]
+      have = error.actual[page:page+pagesize]
+      for w, h in zip(want, have):
+        if h & w != w:
+          inPlace = False
+          break
+    self.repairs += 1
+    if inPlace:
+      for page in error.pages:
+        self._checkCancelled()
+        self.load_address(page)
+        self.load_page(expected[page:page+pagesize])
+      stillBad = []
+      for page in error.pages:
+        want = expected[page:page+pagesize]
+        if self.readFlash(len(want), startaddr=page) != want:
+          stillBad.append(page)
+      if not stillBad:
+        return
+      print "In place repair failed for {0} pages.".format(len(stillBad))
+    self.chip_erase_isp()
+    self.load_data(hexdata)
+    self.check_data(hexdata)
+
+  def read_memory(self, memory, sink, size, startaddr=0, blocksize=None,
+      progress=None):
+    """Read size bytes of 'flash' or 'eeprom' starting at byte address
+    startaddr, passing each chunk to sink(address, data) as it arrives and
+    reporting progress(bytesRead, size). The programmer must be in
+    programming mode."""
+    if blocksize is None:
+      blocksize = self.PAGESIZE
+    if memory == 'flash':
+      self.load_address(startaddr)
+      read = self.read_flash_isp
+    elif memory == 'eeprom':
+      # EEPROM is byte addressed
+      STK500.load_address(self, startaddr)
+      read = self.read_eeprom_isp
+    else:
+      raise ValueError("Unknown memory type: {0}".format(memory))
+    done = 0
+    while done < size:
+      self._checkCancelled()
+      chunk = read(min(blocksize, size - done))
+      if len(chunk) == 0:
+        raise IOError("Programmer returned no data at address 0x{:05X}".format(
+          startaddr + done))
+      sink(startaddr + done, chunk)
+      done += len(chunk)
+      if progress is not None:
+        progress(done, size)
+
+  def _readInto(self, memory, size, startaddr, out, blocksize, progress):
+    if size is None:
+      size = self.FLASHSIZE if memory == 'flash' else self.EEPROMSIZE
+      size -= startaddr
+    if out is None:
+      out = bytearray(size)
+    elif len(out) < size:
+      raise ValueError("Buffer too small: need {0} bytes".format(size))
+    view = memoryview(out)
+    def store(address, data):
+      offset = address - startaddr
+      view[offset:offset+len(data)] = data
+    self.read_memory(memory, store, size, startaddr, blocksize, progress)
+    return out
+
+  def readFlash(self, size=None, startaddr=0, out=None, blocksize=None,
+      progress=None):
+    """Read flash into a preallocated buffer, which is returned. size
+    defaults to the rest of the device's flash."""
+    return self._readInto('flash', size, startaddr, out, blocksize, progress)
+
+  def readEEPROM(self, size=None, startaddr=0, out=None, blocksize=None,
+      progress=None):
+    return self._readInto('eeprom', size, startaddr, out, blocksize, progress)
+
+  def _dump(self, memory, filename, size, progress):
+    if size is None:
+      size = self.FLASHSIZE if memory == 'flash' else self.EEPROMSIZE
+    with open(filename, 'wb') as f:
+      if filename.lower().endswith('.hex'):
+        writer = IHexWriter(f)
+        self.read_memory(memory, writer.write, size, progress=progress)
+        writer.close()
       else:
-        self.mydata += bytearray(self.read_flash_isp(size-len(self.mydata)))
-      self.progress = (float(len(self.mydata))/size)*0.5 + 0.5
-    if self.mydata != bytearray(hexdata):
-      """
-      for i in range(0, len(hexdata)):
-        if self.mydata[i] != hexdata[i]:
-          print "Mismatch at byte 0x{:04X}: 0x{:02X} - 0x{:02X}".format(i, self.mydata[i], hexdata[i])
-      """
-      raise Exception("Flash verification failed.")
-
-  def write_hfuse(self, byte=0xd8):
+        self.read_memory(memory, lambda address, data: f.write(data), size,
+            progress=progress)
+
+  def dumpFlash(self, filename, size=None, progress=None):
+    """Stream the device's flash to an Intel hex (.hex) or raw binary file
+    without holding the whole image in memory."""
+    self._dump('flash', filename, size, progress)
+
+  def dumpEEPROM(self, filename, size=None, progress=None):
+    self._dump('eeprom', filename, size, progress)
+
+  def write_hfuse(self, byte=None):
+    if byte is None:
+      byte = self.HFUSE
     self.spi_multi(4, [0xac, 0xA8, 0x00, byte], 0)
+    self.fuses['hfuse'] = byte
 
-  def write_lfuse(self, byte=0xef):
+  def write_lfuse(self, byte=None):
+    if byte is None:
+      byte = self.LFUSE
     self.spi_multi(4, [0xac, 0xA0, 0x00, byte], 0)
+    self.fuses['lfuse'] = byte
 
-  def write_efuse(self, byte=0xff):
+  def write_efuse(self, byte=None):
+    if byte is None:
+      byte = self.EFUSE
     self.spi_multi(4, [0xac, 0xA4, 0x00, byte], 0)
+    self.fuses['efuse'] = byte
 
   def read_hfuse(self):
     resp = self.spi_multi(4, [0x58, 0x08, 0x00, 0x00], 0)
@@ -348,47 +919,125 @@ class ATmega128rfa1Programmer(STK500):
     resp = self.spi_multi(4, [0x50, 0x08, 0x00, 0x00], 0)
     return resp[3]
 
-  def programAll(self, hexfiles=['bootloader.hex','dof.hex']):
-    self.sign_on()
-    self.enter_progmode_isp()
-    self.check_signature()
-    h = HexFile()
-    for f in hexfiles:
-      h.fromIHexFile(f)
-    self.chip_erase_isp()
-    self.load_data(h)
-    self.check_data(h)
-    self.write_hfuse()
-    self.write_lfuse()
-    self.write_efuse()
-    if self.serialID is not None:
-      self.writeEEPROM(0x412, self.serialID)
-    self.writeEEPROM(0x420, self.HWREV_MAJ)
-    self.writeEEPROM(0x421, self.HWREV_MIN)
-    self.writeEEPROM(0x422, self.HWREV_MIC)
-
-  def _tryProgramAll(self, hexfiles=['bootloader.hex', 'dof.hex']):
-    self.threadException = None
+  def _setProgress(self, progress):
+    self.progress = progress
+    job = currentJob()
+    if job is not None:
+      job.setProgress(progress)
+
+  def _checkCancelled(self):
+    job = currentJob()
+    if job is not None:
+      job.checkCancelled()
+
+  def enableProfiling(self, outputDir='profiles', cprofile=False, label=None):
+    """Write a stkprofile report of every following programAll() run to
+    outputDir, including cProfile statistics if cprofile is True."""
+    import stkprofile
+    self.profile = stkprofile.ProgrammingProfile(outputDir, cprofile, label)
+    return self.profile
+
+  def disableProfiling(self):
+    self.profile = None
+
+  @contextlib.contextmanager
+  def phase(self, name):
+    """Time a phase of programming, recording it in phaseTimes."""
+    start = time.time()
+    if self.profile is not None:
+      self.profile.beginPhase(name, self.comms)
     try:
-      self.programAll(hexfiles=hexfiles)
-    except Exception as e:
-      self.threadException = e
+      yield
+    finally:
+      self.phaseTimes.append((name, time.time() - start))
+      if self.profile is not None:
+        self.profile.endPhase(name, self.comms)
+
+  def _resetStats(self):
+    self.phaseTimes = []
+    self.fuses = {}
+    self.images = None
+    self.imageHash = None
+    self.repairs = 0
+    self.commandsSaved = 0
+    self.comms.retries = 0
+    self.wireLogDump = None
+
+  def runStats(self):
+    """Summarise the last programAll() run for logging."""
+    return {
+        'port' : self.ser.port,
+        'phases' : list(self.phaseTimes),
+        'fuses' : dict(self.fuses),
+        'images' : self.images,
+        'imageHash' : self.imageHash,
+        'retries' : self.comms.retries,
+        'repairs' : self.repairs,
+        'commandsSaved' : self.commandsSaved,
+        'device' : self.device.name if self.device is not None else None,
+        # The last frames on the wire, if the run failed
+        'wireLog' : self.wireLogDump,
+        }
+
+  def _parseImages(self, hexfiles):
+    self.images = list(hexfiles)
+    if self.imageCache is not None:
+      h, self.imageHash = self.imageCache.get(hexfiles, self.device)
+      return h
+    h, self.imageHash = parseImages(hexfiles, self.device)
+    return h
+
+  def _runJob(self, kwargs):
+    job = currentJob()
+    with self.lock:
+      self._setProgress(0.0)
+      try:
+        return self.programAll(**kwargs)
+      except JobCancelled:
+        raise
+      except Exception as e:
+        self._dumpWireLog(e)
+        raise
+      finally:
+        job.stats = self.runStats()
+
+  def _dumpWireLog(self, error):
+    self.wireLogDump = self.comms.wireLog.format()
+    print "{0}: {1}\n{2}".format(self.ser.port, str(error), self.wireLogDump)
 
   def getProgress(self):
     return self.progress
 
-  def programAllAsync(self, serialID="1234"):
-    if serialID != None and len(serialID) != 4:
+  def submitProgramAll(self, executor=None, **kwargs):
+    """Queue programAll(**kwargs) on an executor and return its ProgrammingJob."""
+    if executor is None:
+      executor = getDefaultExecutor()
+    job = ProgrammingJob(self._runJob, args=(kwargs,), name=self.ser.port)
+    self.lastJob = job
+    with self._jobsLock:
+      self._jobs.add(job)
+    job.addDoneCallback(self._jobDone)
+    return executor.submit(job)
+
+  def _jobDone(self, job):
+    with self._jobsLock:
+      self._jobs.discard(job)
+
+  def programAllAsync(self, **kwargs):
+    serialID = kwargs.get('serialID')
+    if serialID is not None and len(serialID) != 4:
       raise Exception('The Serial ID must be a 4 digit alphanumeric string.')
-    self.serialID=serialID
-    self.thread = threading.Thread(target=self._tryProgramAll)
-    self.thread.start()
+    return self.submitProgramAll(**kwargs)
 
   def isProgramming(self):
-    return self.thread.isAlive()
+    """Whether a job is running or queued on this programmer."""
+    with self._jobsLock:
+      return bool(self._jobs)
 
   def getLastException(self):
-    return self.threadException
+    if self.lastJob is None or not self.lastJob.done():
+      return None
+    return self.lastJob.exception()
 
   def writeEEPROMbyte(self, address, byte):
     self.spi_multi(4, bytearray([0xc0, (address >> 8)&0x000f, address&0x00ff, byte]), 0)
@@ -396,57 +1045,15 @@ class ATmega128rfa1Programmer(STK500):
   def writeEEPROM(self, startaddress, bytes):
     time.sleep(0.02)
     for offset, byte in enumerate(bytes):
+      self._checkCancelled()
       self.writeEEPROMbyte(startaddress+offset, byte)
       time.sleep(0.02)
 
-class ATmega32U4Programmer(STK500):
-  WORDSIZE = 2 # Word size in bytes, for addressing
-  def __init__(self, serialport):
-    STK500.__init__(self, serialport)
-    self.progress = 0.0
-
-  def enter_progmode_isp(
-      self, 
-      timeout = 0xc8, 
-      stabDelay = 0x64, 
-      cmdexeDelay = 0x19, 
-      synchLoops = 0x20, 
-      byteDelay = 0x00, 
-      pollValue = 0x53, 
-      pollIndex = 0x03, 
-      cmdbytes = bytearray([0xac, 0x53, 0, 0])
-      ):
-    return STK500.enter_progmode_isp(
-        self,
-        timeout,
-        stabDelay,
-        cmdexeDelay,
-        synchLoops,
-        byteDelay,
-        pollValue,
-        pollIndex,
-        cmdbytes)
-
-  def get_signature_byte(self, byte):
-    data = self.spi_multi(4, [0x30, 0, byte, 0], 0)
-    return data[3]
-
-  def check_signature(self):
-    sig = 0
-    for i in range(0, 3):
-      sig |= self.get_signature_byte(i) << ((2-i)*8)
-    #print "{:06X}".format(sig)
-    if sig != 0x1e9587:
-      raise IOError("Wrong signature. Expected {:06X}, got {:06X}".format(0x1e9587, sig))
-
-  def chip_erase_isp(self):
-    STK500.chip_erase_isp(self, 0x37,0x00, [0xac,0x80,0,0])
-
   def load_page(self, data):
     self.program_flash_isp(
         len(data), 
         mode = 0xc1,
-        delay = 0x06,
+        delay = self.device.pageDelay,
         cmd1 = 0x40,
         cmd2 = 0x4c,
         cmd3 = 0x20,
@@ -454,110 +1061,391 @@ class ATmega32U4Programmer(STK500):
         poll2 = 0,
         data=data)
 
-  def load_address(self, byteaddr):
-    STK500.load_address(self, byteaddr/self.WORDSIZE)
-
-  def load_data(self, data, blocksize = 0x0080):
-    size = len(data)
-    currentByteAddr = 0
-    while currentByteAddr < size:
-      # Check to see if the page is a whole page of 0xff. If it is, no need to program it
-      isblank = reduce(
-          lambda x, y: True if x and y == 0xff else False,
-          data[currentByteAddr:currentByteAddr+blocksize], 
-          True )
-      if not isblank:
-        self.load_address(currentByteAddr)
-        self.load_page(data[currentByteAddr:currentByteAddr+blocksize])
-      currentByteAddr += blocksize
-      self.progress = (float(currentByteAddr)/size) * 0.5
-
-  def check_data(self, hexdata, blocksize = 0x0080):
-    size = len(hexdata)
-    self.load_address(0)
-    self.mydata = bytearray()
-    while len(self.mydata) < size:
-      if size - len(self.mydata) >= blocksize:
-        self.mydata += bytearray(self.read_flash_isp(blocksize))
-      else:
-        self.mydata += bytearray(self.read_flash_isp(size-len(self.mydata)))
-      self.progress = (float(len(self.mydata))/size)*0.5 + 0.5
-    if self.mydata != bytearray(hexdata):
-      """
-      for i in range(0, len(hexdata)):
-        if self.mydata[i] != hexdata[i]:
-          print "Mismatch at byte 0x{:04X}: 0x{:02X} - 0x{:02X}".format(i, self.mydata[i], hexdata[i])
-      """
-      raise Exception("Flash verification failed.")
-
-  def write_hfuse(self, byte=0xd9):
-    self.spi_multi(4, [0xac, 0xA8, 0x00, byte], 0)
-
-  def write_lfuse(self, byte=0xff):
-    self.spi_multi(4, [0xac, 0xA0, 0x00, byte], 0)
-
-  def write_efuse(self, byte=0xff):
-    self.spi_multi(4, [0xac, 0xA4, 0x00, byte], 0)
-
-  def read_hfuse(self):
-    resp = self.spi_multi(4, [0x58, 0x08, 0x00, 0x00], 0)
-    return resp[3]
-
-  def read_lfuse(self):
-    resp = self.spi_multi(4, [0x50, 0x00, 0x00, 0x00], 0)
-    return resp[3]
-
-  def read_efuse(self):
-    resp = self.spi_multi(4, [0x50, 0x08, 0x00, 0x00], 0)
-    return resp[3]
-
-  def programAll(self, hexfiles=['usb.hex']):
-    self.sign_on()
-    self.enter_progmode_isp()
-    self.check_signature()
-    h = HexFile()
-    for f in hexfiles:
-      h.fromIHexFile(f)
-    self.chip_erase_isp()
-    self.load_data(h)
-    self.check_data(h)
-    self.write_hfuse()
-    self.write_lfuse()
-
-  def _tryProgramAll(self, hexfiles=['usb.hex']):
-    self.threadException = None
+  @_profiled
+  def programAll(self, hexfiles=None, serialID=None):
+    """Flash the board with hexfiles, by default its device's images, and
+    set its fuses and EEPROM. serialID is ignored by boards which do not
+    store one."""
+    if serialID is None:
+      serialID = self.serialID
+    self._resetStats()
+    with self.phase('sign_on'):
+      if not self.signedOn:
+        self.sign_on()
+    with self.phase('enter_progmode'):
+      self.enter_progmode_isp()
+      device = self.check_signature()
+    if hexfiles is None:
+      hexfiles = device.hexfiles
+    with self.phase('parse'):
+      h = self._parseImages(hexfiles)
+    self._checkCancelled()
+    with self.phase('erase'):
+      self.chip_erase_isp()
+    with self.phase('write'):
+      self.load_data(h)
+    self.verify(h)
+    with self.phase('fuses'):
+      self.write_hfuse()
+      self.write_lfuse()
+      if device.efuse is not None:
+        self.write_efuse()
+    if device.serialIDAddress is not None or device.eeprom:
+      with self.phase('eeprom'):
+        if serialID is not None and device.serialIDAddress is not None:
+          self.writeEEPROM(device.serialIDAddress, serialID)
+        for address, data in device.eeprom:
+          self.writeEEPROM(address, data)
+    with self.phase('leave_progmode'):
+      self.leave_progmode_isp()
+
+class AutoProgrammer(AVRProgrammer):
+  """Programs any board with a registered DeviceProfile, detected from its
+  signature."""
+  DEVICE = None
+
+class ATmega128rfa1Programmer(AVRProgrammer):
+  DEVICE = ATMEGA128RFA1
+
+  def programAllAsync(self, serialID="1234", **kwargs):
+    self.serialID=serialID
+    return AVRProgrammer.programAllAsync(self, serialID=serialID, **kwargs)
+
+class ATmega32U4Programmer(AVRProgrammer):
+  DEVICE = ATMEGA32U4
+
+class ImageError(Exception):
+  """Raised when hex files cannot be composed into one flash image."""
+  pass
+
+def hexSegments(string):
+  """Parse an Intel hex string into a list of (address, bytearray) segments
+  in address order, joining contiguous data records. Only data records are
+  loaded; extended address records set the base address of those after
+  them."""
+  segments = []
+  base = 0
+  start = end = None
+  data = None
+  for line in string.splitlines():
+    line = line.strip()
+    if not line:
+      continue
+    if line[0] != ':':
+      raise BytesWarning("Parse error: Expected ':'")
     try:
-      self.programAll(hexfiles=hexfiles)
-    except Exception as e:
-      self.threadException = e
-
-  def getProgress(self):
-    return self.progress
-
-  def programAllAsync(self):
-    self.thread = threading.Thread(target=self._tryProgramAll)
-    self.thread.start()
+      record = bytearray(binascii.unhexlify(line[1:]))
+    except (TypeError, binascii.Error):
+      raise BytesWarning("Parse error: " + line)
+    if len(record) < 5 or len(record) != record[0] + 5:
+      raise BytesWarning("Parse error: Wrong record length. " + line)
+    if sum(record) & 0xff != 0:
+      raise BytesWarning("Checksum failed." + line)
+    rectype = record[3]
+    payload = record[4:-1]
+    if rectype == 0:
+      address = base + (record[1] << 8 | record[2])
+      if address == end:
+        data += payload
+      else:
+        if data:
+          segments.append((start, data))
+        start, data = address, payload
+      end = address + len(payload)
+    elif rectype == 1:
+      break
+    elif rectype == 2:
+      base = (payload[0] << 8 | payload[1]) << 4
+    elif rectype == 4:
+      base = (payload[0] << 8 | payload[1]) << 16
+  if data:
+    segments.append((start, data))
+  # Already in order for the usual hex file, which costs one pass
+  segments.sort(key=lambda s: s[0])
+  return segments
+
+class FlashImage():
+  """Hex files composed into one image. data is the whole image with gaps
+  filled with 0xFF, pages the (address, data) of each page to program,
+  leaving out blank pages, and segments the (start, end, filename) of each
+  run of data."""
+  def __init__(self, data, pages, pagesize, segments):
+    self.data = data
+    self.pages = pages
+    self.pagesize = pagesize
+    self.segments = segments
 
-  def isProgramming(self):
-    return self.thread.isAlive()
+  def __getitem__(self, index):
+    return self.data[index]
 
-  def getLastException(self):
-    return self.threadException
+  def __len__(self):
+    return len(self.data)
 
-  def writeEEPROMbyte(self, address, byte):
-    self.spi_multi(4, bytearray([0xc0, (address >> 8)&0x000f, address&0x00ff, byte]), 0)
-  
-  def writeEEPROM(self, startaddress, bytes):
-    time.sleep(0.02)
-    for offset, byte in enumerate(bytes):
-      self.writeEEPROMbyte(startaddress+offset, byte)
-      time.sleep(0.02)
+def composeImages(hexfiles, device=None):
+  """Compose hex files, such as a bootloader, an application and data, into
+  a FlashImage by merging their segments in address order in one pass.
+
+  Files may only overlap where they write the same bytes. Given a
+  DeviceProfile, the image must fit in the device's flash, and when there
+  are several files only one may write the boot section, and nothing
+  outside it. Raises ImageError otherwise."""
+  pagesize = device.pageSize if device is not None else AVRProgrammer.PAGESIZE
+  sources = []
+  for index, filename in enumerate(hexfiles):
+    with open(filename, 'r') as f:
+      sources.append([(start, index, data)
+          for start, data in hexSegments(f.read())])
+  size = max([start + len(data) for source in sources
+      for start, index, data in source] or [0])
+  if device is not None and size > device.flashSize:
+    raise ImageError(
+        'The image ends at 0x{0:05X}, past the end of the {1} flash at 0x{2:05X}'.format(
+          size, device.name, device.flashSize))
+  data = bytearray(b'\xff') * size
+  # The kept segments are disjoint and in order. Everything from the start
+  # of the last segment merged up to coveredEnd has been written, so an
+  # overlap can be checked against the composed bytes.
+  segments = []
+  starts = []
+  coveredEnd = 0
+  for start, index, segment in heapq.merge(*sources):
+    end = start + len(segment)
+    if start < coveredEnd:
+      overlap = min(end, coveredEnd) - start
+      if data[start:start+overlap] != segment[:overlap]:
+        first = start + [i for i in range(overlap)
+            if data[start+i] != segment[i]][0]
+        owner = segments[bisect.bisect_right(starts, first) - 1][1]
+        raise ImageError('{0} and {1} write different data at 0x{2:05X}'.format(
+            hexfiles[owner], hexfiles[index], first))
+      segment = segment[overlap:]
+      start += overlap
+      if not segment:
+        continue
+    data[start:end] = segment
+    segments.append((start, index, segment))
+    starts.append(start)
+    coveredEnd = max(coveredEnd, end)
+  if device is not None and device.bootSize and len(hexfiles) > 1:
+    bootStart = device.flashSize - device.bootSize
+    writers = sorted(set(index for start, index, segment in segments
+        if start + len(segment) > bootStart))
+    if len(writers) > 1:
+      raise ImageError('{0} all write the boot section'.format(
+          ', '.join(hexfiles[i] for i in writers)))
+    for start, index, segment in segments:
+      if index in writers and start < bootStart:
+        raise ImageError(
+            '{0} writes the boot section and 0x{1:05X}, outside it'.format(
+              hexfiles[index], start))
+  blank = bytearray(b'\xff') * pagesize
+  pages = []
+  nextPage = 0
+  for start, index, segment in segments:
+    for page in range(max(start - start % pagesize, nextPage),
+        start + len(segment), pagesize):
+      pageData = data[page:page+pagesize]
+      if pageData != blank[:len(pageData)]:
+        pages.append((page, pageData))
+      nextPage = page + pagesize
+  return FlashImage(data, pages, pagesize,
+      [(start, start + len(segment), hexfiles[index])
+        for start, index, segment in segments])
+
+def parseImages(hexfiles, device=None):
+  """Compose hex files into a FlashImage, returning it and its hash."""
+  image = composeImages(hexfiles, device)
+  return image, hashlib.sha1(bytes(image.data)).hexdigest()
+
+class ImageCache():
+  """Composed firmware images, shared by programmers so that each board
+  does not parse its hex files again. An image is composed again if one of
+  its files has changed. The returned FlashImages must not be modified."""
+  def __init__(self):
+    self._images = {}
+    self._lock = threading.Lock()
+
+  def get(self, hexfiles, device=None):
+    key = (tuple(hexfiles), device.name if device is not None else None)
+    stamp = [(os.path.getmtime(f), os.path.getsize(f)) for f in hexfiles]
+    with self._lock:
+      cached = self._images.get(key)
+      if cached is not None and cached[0] == stamp:
+        return cached[1]
+    image = parseImages(hexfiles, device)
+    with self._lock:
+      self._images[key] = (stamp, image)
+    return image
+
+  def clear(self):
+    with self._lock:
+      self._images.clear()
+
+class ProgrammerPool():
+  """Keeps programmers open and signed on between boards, keyed by port.
+
+  acquire() hands out the pooled programmer for a port after a cheap health
+  check, reconnecting if the programmer stopped responding. Ports are only
+  closed by close()/closeAll(), or when a programmer is released as broken.
+  The pool's lock is never held while talking to a programmer or waiting
+  for one to finish a job, so a slow port does not hold up the others.
+  """
+  def __init__(self, programmerClass=AutoProgrammer):
+    self.programmerClass = programmerClass
+    self._programmers = {}
+    self._portLocks = {}
+    self._lock = threading.Lock()
+
+  def acquire(self, port, programmerClass=None):
+    """Return the programmer for port, opening it if needed. Raises
+    ProgrammerBusy if a programmer of another class has jobs running or
+    queued on the port."""
+    if programmerClass is None:
+      programmerClass = self.programmerClass
+    with self._portLock(port):
+      with self._lock:
+        programmer = self._programmers.get(port)
+      if programmer is not None:
+        if programmer.__class__ is not programmerClass:
+          if programmer.isProgramming():
+            raise ProgrammerBusy('{0} is still programming with {1}'.format(
+              port, programmer.__class__.__name__))
+          self._discard(port, programmer)
+          programmer = None
+        # A programmer which is busy programming is known to be alive, and
+        # must not be sent a health check in the middle of its job
+        elif not programmer.isProgramming() and not programmer.is_alive():
+          self._discard(port, programmer)
+          programmer = None
+      if programmer is None:
+        programmer = programmerClass(port)
+        try:
+          programmer.sign_on()
+        except Exception:
+          programmer.close()
+          raise
+        with self._lock:
+          self._programmers[port] = programmer
+      return programmer
+
+  def release(self, programmer, discard=False):
+    """Return a programmer to the pool. Pass discard=True if the link to the
+    programmer is known to be broken, closing its port immediately."""
+    if discard:
+      self._discard(programmer.ser.port, programmer)
+
+  def close(self, port):
+    with self._lock:
+      programmer = self._programmers.pop(port, None)
+    self._close(programmer)
+
+  def closeAll(self):
+    with self._lock:
+      programmers = list(self._programmers.values())
+      self._programmers.clear()
+    for programmer in programmers:
+      self._close(programmer)
+
+  def ports(self):
+    with self._lock:
+      return sorted(self._programmers.keys())
+
+  def _portLock(self, port):
+    # Serialises acquire() of one port without holding up other ports
+    with self._lock:
+      return self._portLocks.setdefault(port, threading.Lock())
+
+  def _discard(self, port, programmer):
+    with self._lock:
+      if self._programmers.get(port) is not programmer:
+        return
+      del self._programmers[port]
+    self._close(programmer)
+
+  def _close(self, programmer):
+    if programmer is None:
+      return
+    # Waits for a running job to finish with the port
+    with programmer.lock:
+      try:
+        programmer.close()
+      except Exception:
+        pass
+
+class WireLog():
+  """The last frames sent to and received from a programmer, for working
+  out why a board failed. Each direction is a ring of preallocated slots,
+  so logging a frame is a slice copy. Frames longer than frameSize are
+  truncated. Everything received in answer to a command, including noise
+  and partial frames, is logged as one frame."""
+  SENT = 0
+  RECEIVED = 1
+
+  def __init__(self, numFrames=32, frameSize=288):
+    self.numFrames = numFrames
+    self.frameSize = frameSize
+    self._data = [bytearray(numFrames*frameSize) for i in range(2)]
+    self._times = [array.array('d', [0.0]) * numFrames for i in range(2)]
+    self._lengths = [array.array('l', [0]) * numFrames for i in range(2)]
+    self._counts = [0, 0]
+
+  def add(self, direction, data):
+    count = self._counts[direction]
+    slot = count % self.numFrames
+    n = min(len(data), self.frameSize)
+    offset = slot*self.frameSize
+    self._data[direction][offset:offset+n] = data[:n]
+    self._times[direction][slot] = time.time()
+    self._lengths[direction][slot] = len(data)
+    self._counts[direction] = count + 1
+
+  def entries(self):
+    """The logged frames as (time, direction, length, data) tuples, oldest
+    first. data may be shorter than length if the frame was truncated."""
+    entries = []
+    for direction in (self.SENT, self.RECEIVED):
+      count = self._counts[direction]
+      for i in range(max(count - self.numFrames, 0), count):
+        slot = i % self.numFrames
+        length = self._lengths[direction][slot]
+        offset = slot*self.frameSize
+        entries.append((self._times[direction][slot], direction, length,
+          self._data[direction][offset:offset+min(length, self.frameSize)]))
+    entries.sort(key=lambda e: e[0])
+    return entries
+
+  def format(self):
+    entries = self.entries()
+    if not entries:
+      return 'Wire log is empty.'
+    last = entries[-1][0]
+    lines = ['Wire log, seconds before the last frame (> sent, < received):']
+    for timestamp, direction, length, data in entries:
+      line = '{0:9.4f} {1} {2}'.format(timestamp - last,
+          '>' if direction == self.SENT else '<',
+          ' '.join('{:02X}'.format(b) for b in data) or '(nothing)')
+      if len(data) < length:
+        line += ' ... ({0} bytes)'.format(length)
+      lines.append(line)
+    return '\n'.join(lines)
+
+  def clear(self):
+    self._counts = [0, 0]
 
 class _CommsEngine():
   def __init__(self, ser): 
     self.ser = ser
     self.bytes = bytearray()
     self.seqNum = 0 
+    self.retries = 0
+    # Time spent blocked on the serial port, for profiling
+    self.ioTime = 0.0
+    self.frames = 0
+    self.bytesOut = 0
+    self.bytesIn = 0
+    self.wireLog = WireLog()
+    # Everything read in answer to the current command
+    self.received = bytearray()
 
   def sendrecv(self, data, timeout = 1):
     self.seqNum += 1
@@ -574,25 +1462,49 @@ class _CommsEngine():
     bytes += bytearray(data)
     checksum = reduce( lambda x, y: x^y, bytes )
     bytes += bytearray([checksum])
-    self.ser.write(bytes)
-    return self.start()
+    self.frames += 1
+    self.received = bytearray()
+    self._write(bytes)
+    self.wireLog.add(WireLog.SENT, bytes)
+    try:
+      return self.start()
+    finally:
+      self.wireLog.add(WireLog.RECEIVED, self.received)
+
+  def _write(self, data):
+    start = time.time()
+    self.ser.write(data)
+    self.ioTime += time.time() - start
+    self.bytesOut += len(data)
+
+  def _read(self, size=1):
+    start = time.time()
+    data = self.ser.read(size)
+    self.ioTime += time.time() - start
+    self.bytesIn += len(data)
+    self.received += data
+    return data
 
   def start(self):
     self.numerrs += 1
+    if self.numerrs > 1:
+      self.retries += 1
     if self.numerrs > 10:
       raise IOError("Too many errors. Aborting.")
-    bytes = bytearray(self.ser.read())
+    # Resynchronising discards any partial frame
+    self.bytes = bytearray()
+    bytes = bytearray(self._read())
     if len(bytes) < 1:
       raise IOError("Message timed out.")
     if bytes[0] != 0x1b:
-      self.start()
+      return self.start()
     else:
       self.bytes += bytes
       self.getSeqNumber()
       return self.data
 
   def getSeqNumber(self):
-    bytes = bytearray(self.ser.read())
+    bytes = bytearray(self._read())
     if len(bytes) < 1:
       raise IOError("Message timed out.")
     if bytes[0] != (self.seqNum & 0xff):
@@ -602,7 +1514,7 @@ class _CommsEngine():
       self.getMessageSize()
 
   def getMessageSize(self):
-    bytes = bytearray(self.ser.read(2))
+    bytes = bytearray(self._read(2))
     if len(bytes) < 2:
       raise IOError("Message timed out.")
     else:
@@ -611,7 +1523,7 @@ class _CommsEngine():
       self.getToken()
 
   def getToken(self):
-    bytes = bytearray(self.ser.read())
+    bytes = bytearray(self._read())
     if len(bytes) < 1:
       raise IOError("Message timed out.")
     if bytes[0] != 14:
@@ -621,7 +1533,7 @@ class _CommsEngine():
       self.getData()
 
   def getData(self):
-    self.data = bytearray(self.ser.read(self.size))
+    self.data = bytearray(self._read(self.size))
     if len(self.data) < self.size:
       raise IOError("Message timed out.")
     else:
@@ -629,7 +1541,7 @@ class _CommsEngine():
       self.getChecksum()
 
   def getChecksum(self):
-    bytes = bytearray(self.ser.read())
+    bytes = bytearray(self._read())
     if len(bytes) < 1:
       raise IOError("Message timed out.")
     else:
@@ -638,6 +1550,41 @@ class _CommsEngine():
         print "Checksum mismatch: expected {:02X}, got {:02X}".format(sum, bytes[0])
         self.start()
 
+class IHexWriter():
+  """Writes Intel hex records to a file object as data arrives. Records which
+  are entirely 0xFF are skipped unless skipBlank is False, as unprogrammed
+  memory reads back as 0xFF anyway."""
+  def __init__(self, f, recordsize=0x10, skipBlank=True):
+    self.f = f
+    self.recordsize = recordsize
+    self.skipBlank = skipBlank
+    self.extaddr = 0
+
+  def write(self, address, data):
+    data = bytearray(data)
+    offset = 0
+    while offset < len(data):
+      recaddr = address + offset
+      # Records may not cross a 64k boundary
+      n = min(self.recordsize, len(data) - offset, 0x10000 - (recaddr & 0xffff))
+      record = data[offset:offset+n]
+      offset += n
+      if self.skipBlank and record.count(b'\xff') == n:
+        continue
+      if (recaddr >> 16) != self.extaddr:
+        self.extaddr = recaddr >> 16
+        self._writeRecord(0, 4, bytearray([self.extaddr >> 8, self.extaddr & 0xff]))
+      self._writeRecord(recaddr & 0xffff, 0, record)
+
+  def close(self):
+    self._writeRecord(0, 1, bytearray())
+
+  def _writeRecord(self, address, rectype, data):
+    record = bytearray([len(data), address >> 8, address & 0xff, rectype]) + data
+    checksum = (-sum(record)) & 0xff
+    self.f.write(':' + ''.join('{:02X}'.format(b) for b in record) +
+        '{:02X}\n'.format(checksum))
+
 class HexFile():
   def __init__(self):
     self.data = bytearray(0)
@@ -737,24 +1684,76 @@ class HexFile():
   def __len__(self):
     return len(self.data)
 
+# Programmer classes by device name. 'auto' detects the device from the
+# signature.
+DEVICES = {
+    'auto' : AutoProgrammer,
+    'atmega128rfa1' : ATmega128rfa1Programmer,
+    'atmega32u4' : ATmega32U4Programmer,
+    }
+
+def main(argv):
+  import argparse
+  import sys
+  parser = argparse.ArgumentParser(
+      description='Program an AVR through an STK500v2 programmer.')
+  parser.add_argument('port')
+  parser.add_argument('hexfiles', nargs='*',
+      help='Intel hex files to program. Defaults to the device\'s images.')
+  parser.add_argument('--device', choices=sorted(DEVICES.keys()),
+      default='auto')
+  parser.add_argument('--serial-id', default=None,
+      help='Serial ID to write to the EEPROM, on boards which store one.')
+  parser.add_argument('--profile', action='store_true',
+      help='Write a profiling report to profiles/.')
+  parser.add_argument('--dump-flash', metavar='FILE', default=None,
+      help='Back up the flash to FILE (.hex or raw binary) instead of programming.')
+  parser.add_argument('--dump-eeprom', metavar='FILE', default=None,
+      help='Back up the EEPROM to FILE (.hex or raw binary) instead of programming.')
+  parser.add_argument('--record', metavar='FILE', default=None,
+      help='Record the serial traffic to FILE for stktransport.py replay.')
+  args = parser.parse_args(argv)
+  transport = None
+  if args.record:
+    import stktransport
+    transport = stktransport.RecordingTransport(
+        stktransport.SerialTransport(args.port), args.record)
+  programmer = DEVICES[args.device](args.port, transport)
+  if args.dump_flash or args.dump_eeprom:
+    def progress(done, total):
+      sys.stdout.write('\r{0}/{1} bytes'.format(done, total))
+      sys.stdout.flush()
+    try:
+      programmer.sign_on()
+      programmer.enter_progmode_isp()
+      programmer.check_signature()
+      if args.dump_flash:
+        programmer.dumpFlash(args.dump_flash, progress=progress)
+        print
+      if args.dump_eeprom:
+        programmer.dumpEEPROM(args.dump_eeprom, progress=progress)
+        print
+      programmer.leave_progmode_isp()
+    finally:
+      programmer.close()
+    return
+  kwargs = {}
+  if args.hexfiles:
+    kwargs['hexfiles'] = args.hexfiles
+  if args.serial_id is not None:
+    kwargs['serialID'] = args.serial_id
+  if args.profile:
+    programmer.enableProfiling()
+  try:
+    programmer.programAll(**kwargs)
+  except Exception as e:
+    programmer._dumpWireLog(e)
+    raise
+  finally:
+    programmer.close()
+  for name, seconds in programmer.phaseTimes:
+    print "{0:<16} {1:.3f} s".format(name, seconds)
+
 if __name__ == '__main__':
-  s = ATmega128rfa1Programmer("/dev/ttyACM0")
-  s.sign_on()
-  s.enter_progmode_isp()
-  s.check_signature()
-  s.writeEEPROM(0x412, "abcd")
-  """
-  h = HexFile()
-#h.fromIHexFile('dof.hex')
-  h.fromIHexFile('bootloader.hex')
-  s.chip_erase_isp()
-  s.load_data(h)
-#s.check_data(h)
-  s.write_hfuse()
-  s.write_lfuse()
-  s.write_efuse()
-  print "{:02X}".format(s.read_hfuse())
-  print "{:02X}".format(s.read_lfuse())
-  print "{:02X}".format(s.read_efuse())
-#print h.toIHexString(blocksize=0x20)
-  """
+  import sys
+  main(sys.argv[1:])
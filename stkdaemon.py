@@ -0,0 +1,414 @@
+"""
+A long running programming service for the station.
+
+The daemon owns the programmers, the parsed firmware images, the serial ID
+allocator and the run log, so that every board after the first starts
+with its programmer open and signed on and its images already parsed. GUIs
+and scripts talk to it over a local socket with JSON-RPC 2.0, one JSON
+object per line:
+
+  python stkdaemon.py serve [--dongle /dev/ttyACM1]
+  python stkdaemon.py submit /dev/ttyACM0 [--test]
+  python stkdaemon.py jobs
+  python stkdaemon.py history [--serial-id ABCD]
+
+The methods are listed in ProgrammingDaemon. While a watch request is
+running, the daemon sends "progress" notifications for its job on the
+same connection. The socket is only bound to the loopback interface and
+has no authentication.
+"""
+
+import json
+import socket
+import SocketServer
+import sys
+import threading
+import time
+import pystk500v2 as stk
+import pipeline
+import productiondb
+
+DEFAULT_ADDRESS = ('127.0.0.1', 5150)
+
+class DaemonError(Exception):
+  pass
+
+class ProgrammingDaemon():
+  """The daemon's state and RPC methods. Each rpc_<name> method is callable
+  as <name> with keyword parameters:
+
+    ping()                          -> 'pong'
+    submit(port, device, hexfiles, serialID, test) -> job
+    status(jobId)                   -> job
+    watch(jobId)                    -> job, once finished
+    cancel(jobId)                   -> job
+    confirm(jobId)                  -> job, ending the test's current hold
+    jobs()                          -> [job, ...]
+    programmers()                   -> [port, ...]
+    history(limit, serialID)        -> [run, ...]
+    report(hours)                   -> productiondb report
+  """
+  MAX_JOBS = 1000
+
+  def __init__(self, database=productiondb.DEFAULT_DATABASE, dongles=()):
+    # Each has its own connection: their locks only serialise their own
+    # transactions, which must not be interleaved on one connection
+    self.serialIDs = productiondb.SerialIDAllocator(database)
+    self.runLog = productiondb.RunLog(database)
+    # Free the IDs of boards left mid-flash when a daemon or GUI last exited
+    self.serialIDs.expireReservations()
+    self.programmers = stk.ProgrammerPool()
+    self.imageCache = stk.ImageCache()
+    self.scheduler = None
+    testFunc = None
+    testExecutor = None
+    if dongles:
+      import linkbottest
+      self.scheduler = linkbottest.TestScheduler()
+      for port in dongles:
+        self.scheduler.addDongle(linkbottest.openDongle(port))
+      testFunc = self.scheduler.run
+      testExecutor = self.scheduler.executor
+    self.pipeline = pipeline.FlashTestPipeline(testFunc,
+        testExecutor=testExecutor, runLog=self.runLog)
+    self.pipeline.addListener(self._onBoardUpdate)
+    self.jobs = {}
+    self._nextJobId = 1
+    self._watchers = {}
+    self._lock = threading.Lock()
+
+  def close(self):
+    if self.scheduler is not None:
+      self.scheduler.shutdown(wait=False)
+    self.programmers.closeAll()
+
+  def dispatch(self, method, params, notify):
+    func = getattr(self, 'rpc_' + str(method), None)
+    if func is None:
+      raise DaemonError('Unknown method: {0}'.format(method))
+    if method == 'watch':
+      params = dict(params, notify=notify)
+    return func(**dict((str(k), v) for k, v in params.items()))
+
+  def rpc_ping(self):
+    return 'pong'
+
+  def rpc_submit(self, port, device='auto', hexfiles=None,
+      serialID=None, test=False):
+    """Flash, and if test is true then test, a board on the programmer at
+    port. A serial ID is reserved for the board unless one is given, and
+    released again if the board turns out not to store one."""
+    programmerClass = stk.DEVICES.get(device)
+    if programmerClass is None:
+      raise DaemonError('Unknown device: {0}'.format(device))
+    if test and self.scheduler is None:
+      raise DaemonError('No dongles are connected for testing.')
+    port = str(port)
+    programmer = self.programmers.acquire(port, programmerClass)
+    programmer.imageCache = self.imageCache
+    reserved = False
+    profile = programmerClass.DEVICE
+    if serialID is None and \
+        (profile is None or profile.serialIDAddress is not None):
+      serialID = self.serialIDs.reserve(jig=port)
+      reserved = True
+    kwargs = {}
+    if hexfiles:
+      kwargs['hexfiles'] = [str(f) for f in hexfiles]
+    serialID = None if serialID is None else str(serialID)
+    with self._lock:
+      jobId = self._nextJobId
+      self._nextJobId += 1
+    record = self.pipeline.submit(programmer, serialID, test=test,
+        key='job{0}'.format(jobId), **kwargs)
+    record.jobId = jobId
+    record.device = device
+    with self._lock:
+      self.jobs[jobId] = record
+      self._pruneJobs()
+    lastPercent = [-1]
+    def onProgress(job):
+      percent = int(job.progress*100)
+      if percent != lastPercent[0]:
+        lastPercent[0] = percent
+        self._publish(record)
+    record.flashJob.addProgressCallback(onProgress)
+    record.flashJob.addDoneCallback(
+        lambda job: self._onFlashed(record, reserved))
+    return self._jobInfo(record)
+
+  def rpc_status(self, jobId):
+    return self._jobInfo(self._record(jobId))
+
+  def rpc_watch(self, jobId, notify):
+    """Send a progress notification whenever the job changes, returning
+    once it has finished."""
+    import Queue
+    record = self._record(jobId)
+    updates = Queue.Queue()
+    with self._lock:
+      self._watchers.setdefault(jobId, []).append(updates)
+    try:
+      info = self._jobInfo(record)
+      while not info['done']:
+        notify('progress', info)
+        info = updates.get()
+      return info
+    finally:
+      with self._lock:
+        self._watchers[jobId].remove(updates)
+        if not self._watchers[jobId]:
+          del self._watchers[jobId]
+
+  def rpc_cancel(self, jobId):
+    record = self._record(jobId)
+    for job in (record.flashJob, record.testJob):
+      if job is not None and not job.done():
+        job.cancel()
+    return self._jobInfo(record)
+
+  def rpc_confirm(self, jobId):
+    """The operator has seen and heard the board's current indication."""
+    record = self._record(jobId)
+    if self.scheduler is not None and record.serialID is not None:
+      self.scheduler.confirm(record.serialID)
+    return self._jobInfo(record)
+
+  def rpc_jobs(self):
+    with self._lock:
+      records = [self.jobs[jobId] for jobId in sorted(self.jobs)]
+    return [self._jobInfo(r) for r in records]
+
+  def rpc_programmers(self):
+    return self.programmers.ports()
+
+  def rpc_history(self, limit=50, serialID=None):
+    return self.runLog.history(limit, serialID)
+
+  def rpc_report(self, hours=None):
+    since = 0 if hours is None else time.time() - hours*3600
+    return self.runLog.report(since)
+
+  def _record(self, jobId):
+    with self._lock:
+      record = self.jobs.get(jobId)
+    if record is None:
+      raise DaemonError('Unknown job: {0}'.format(jobId))
+    return record
+
+  def _pruneJobs(self):
+    # Must be called with self._lock held
+    finished = sorted(jobId for jobId, r in self.jobs.items() if r.done())
+    for jobId in finished[:max(len(self.jobs) - self.MAX_JOBS, 0)]:
+      del self.jobs[jobId]
+
+  def _onFlashed(self, record, reserved):
+    job = record.flashJob
+    if not reserved:
+      return
+    if job.cancelled() or job.exception() is not None or \
+        not pipeline.storesSerialID(job.stats):
+      self.serialIDs.release(record.serialID)
+    else:
+      self.serialIDs.commit(record.serialID,
+          firmware=','.join(job.stats.get('images') or []))
+
+  def _onBoardUpdate(self, record):
+    if getattr(record, 'jobId', None) is not None:
+      self._publish(record)
+
+  def _publish(self, record):
+    with self._lock:
+      watchers = list(self._watchers.get(record.jobId, []))
+    if watchers:
+      info = self._jobInfo(record)
+      for updates in watchers:
+        updates.put(info)
+
+  def _jobInfo(self, record):
+    progress = 0.0
+    device = getattr(record, 'device', None)
+    wireLog = None
+    if record.flashJob is not None:
+      progress = record.flashJob.progress
+      wireLog = record.flashJob.stats.get('wireLog')
+      # The device detected on the board, once known
+      device = record.flashJob.stats.get('device') or device
+    return {
+        'jobId' : getattr(record, 'jobId', None),
+        'device' : device,
+        'serialID' : record.serialID,
+        'port' : record.port,
+        'status' : record.status,
+        'stage' : record.stage,
+        'progress' : progress,
+        'error' : None if record.error is None else str(record.error),
+        'started' : record.started,
+        'finished' : record.finished,
+        'done' : record.done(),
+        # The programmer's last frames, if flashing failed
+        'wireLog' : wireLog,
+        }
+
+class _RPCHandler(SocketServer.StreamRequestHandler):
+  def handle(self):
+    daemon = self.server.daemon
+    writeLock = threading.Lock()
+    def send(message):
+      with writeLock:
+        self.wfile.write(json.dumps(message) + '\n')
+        self.wfile.flush()
+    def notify(method, params):
+      send({'jsonrpc' : '2.0', 'method' : method, 'params' : params})
+    while True:
+      line = self.rfile.readline()
+      if not line:
+        return
+      requestId = None
+      try:
+        request = json.loads(line)
+        requestId = request.get('id')
+        result = daemon.dispatch(request['method'],
+            request.get('params') or {}, notify)
+        response = {'jsonrpc' : '2.0', 'id' : requestId, 'result' : result}
+      except Exception as e:
+        response = {'jsonrpc' : '2.0', 'id' : requestId, 'error' : {
+          'code' : -32000,
+          'message' : str(e),
+          'type' : e.__class__.__name__,
+          }}
+      try:
+        send(response)
+      except socket.error:
+        return
+
+class DaemonServer(SocketServer.ThreadingTCPServer):
+  allow_reuse_address = True
+  daemon_threads = True
+
+  def __init__(self, daemon, address=DEFAULT_ADDRESS):
+    self.daemon = daemon
+    SocketServer.ThreadingTCPServer.__init__(self, address, _RPCHandler)
+
+class DaemonClient():
+  """A connection to a running daemon."""
+  def __init__(self, address=DEFAULT_ADDRESS, timeout=None):
+    self.sock = socket.create_connection(address, timeout)
+    self.rfile = self.sock.makefile('rb')
+    self._nextId = 1
+
+  def call(self, method, onNotify=None, **params):
+    requestId = self._nextId
+    self._nextId += 1
+    self.sock.sendall(json.dumps({'jsonrpc' : '2.0', 'id' : requestId,
+      'method' : method, 'params' : params}) + '\n')
+    while True:
+      line = self.rfile.readline()
+      if not line:
+        raise DaemonError('Connection to daemon closed.')
+      message = json.loads(line)
+      if 'id' not in message:
+        if onNotify is not None:
+          onNotify(message['method'], message['params'])
+        continue
+      if message['id'] != requestId:
+        continue
+      if 'error' in message:
+        raise DaemonError(message['error']['message'])
+      return message['result']
+
+  def watch(self, jobId, callback):
+    """Call callback(job) with each update until the job finishes, then
+    return its final state."""
+    return self.call('watch', lambda method, job: callback(job), jobId=jobId)
+
+  def close(self):
+    self.rfile.close()
+    self.sock.close()
+
+def _formatJob(job):
+  text = '{0:>4} {1:<8} {2:<14} {3:<10} {4:>3}%'.format(job['jobId'],
+      job['serialID'] or '-', job['port'], job['status'], int(job['progress']*100))
+  if job['error']:
+    text += '  {0}'.format(job['error'])
+  return text
+
+def main(argv):
+  import argparse
+  parser = argparse.ArgumentParser(description='Programming station daemon.')
+  parser.add_argument('--host', default=DEFAULT_ADDRESS[0])
+  parser.add_argument('--port', type=int, default=DEFAULT_ADDRESS[1])
+  sub = parser.add_subparsers(dest='command')
+  serve = sub.add_parser('serve', help='Run the daemon.')
+  serve.add_argument('--db', default=productiondb.DEFAULT_DATABASE)
+  serve.add_argument('--dongle', action='append', default=[],
+      help='Test boards through the dongle on this port. Only one real dongle '
+      'is supported; fake ones may be repeated.')
+  submit = sub.add_parser('submit', help='Program a board.')
+  submit.add_argument('programmerPort')
+  submit.add_argument('hexfiles', nargs='*')
+  submit.add_argument('--device', choices=sorted(stk.DEVICES.keys()),
+      default='auto')
+  submit.add_argument('--serial-id', default=None)
+  submit.add_argument('--test', action='store_true')
+  submit.add_argument('--no-wait', action='store_true')
+  sub.add_parser('jobs', help='List jobs.')
+  cancel = sub.add_parser('cancel', help='Cancel a job.')
+  cancel.add_argument('jobId', type=int)
+  confirm = sub.add_parser('confirm',
+      help='Confirm the LED and buzzer of a board being tested.')
+  confirm.add_argument('jobId', type=int)
+  history = sub.add_parser('history', help='Show logged runs.')
+  history.add_argument('--limit', type=int, default=20)
+  history.add_argument('--serial-id', default=None)
+  args = parser.parse_args(argv)
+  address = (args.host, args.port)
+
+  if args.command == 'serve':
+    daemon = ProgrammingDaemon(args.db, args.dongle)
+    server = DaemonServer(daemon, address)
+    print 'Listening on {0}:{1}'.format(*address)
+    try:
+      server.serve_forever()
+    except KeyboardInterrupt:
+      pass
+    finally:
+      server.server_close()
+      daemon.close()
+    return
+
+  client = DaemonClient(address)
+  try:
+    if args.command == 'submit':
+      job = client.call('submit', port=args.programmerPort, device=args.device,
+          hexfiles=args.hexfiles or None, serialID=args.serial_id,
+          test=args.test)
+      if not args.no_wait:
+        def progress(job):
+          sys.stdout.write('\r' + _formatJob(job))
+          sys.stdout.flush()
+        job = client.watch(job['jobId'], progress)
+        sys.stdout.write('\r')
+      print _formatJob(job)
+      if job['status'] == pipeline.BoardRecord.FAILED:
+        if job.get('wireLog'):
+          print job['wireLog']
+        sys.exit(1)
+    elif args.command == 'jobs':
+      for job in client.call('jobs'):
+        print _formatJob(job)
+    elif args.command == 'cancel':
+      print _formatJob(client.call('cancel', jobId=args.jobId))
+    elif args.command == 'confirm':
+      print _formatJob(client.call('confirm', jobId=args.jobId))
+    elif args.command == 'history':
+      for run in client.call('history', limit=args.limit,
+          serialID=args.serial_id):
+        print '{0:>5} {1} {2:<8} {3:<14} {4:<10} {5}'.format(run['id'],
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(run['started'])),
+            run['serialID'], run['jig'], run['outcome'], run['error'] or '')
+  finally:
+    client.close()
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
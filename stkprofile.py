@@ -0,0 +1,164 @@
+"""
+Profiling of programming runs.
+
+When profiling is enabled on a programmer, each phase of programAll() is
+timed and split into the time spent waiting on the serial port and the time
+spent in Python (hex parsing, frame building, page comparisons, and any
+deliberate delays such as the EEPROM write settling time). The result
+of each run is written as a JSON report, optionally with cProfile statistics
+for the programming thread, so that runs can be compared:
+
+  python stkprofile.py show profiles/run.json
+  python stkprofile.py compare profiles/before.json profiles/after.json
+
+CPU time is measured for the whole process, so it is only meaningful when a
+single jig is programming.
+"""
+
+import cProfile
+import json
+import os
+import pstats
+import StringIO
+import sys
+import time
+
+def _cpuTime():
+  t = os.times()
+  return t[0] + t[1]
+
+class ProgrammingProfile():
+  def __init__(self, outputDir='profiles', cprofile=False, label=None):
+    self.outputDir = outputDir
+    self.cprofile = cprofile
+    self.label = label
+    self.lastReport = None
+    self.lastReportFile = None
+    self._profiler = None
+    self._open = {}
+
+  def startRun(self, programmer):
+    self.run = {
+        'label' : self.label,
+        'programmer' : programmer.__class__.__name__,
+        'port' : programmer.ser.port,
+        'started' : time.time(),
+        'phases' : [],
+        }
+    self._runStart = self._snapshot(programmer.comms)
+    if self.cprofile:
+      self._profiler = cProfile.Profile()
+      self._profiler.enable()
+
+  def beginPhase(self, name, comms):
+    self._open[name] = self._snapshot(comms)
+
+  def endPhase(self, name, comms):
+    start = self._open.pop(name, None)
+    if start is None:
+      return
+    sample = self._delta(start, self._snapshot(comms))
+    sample['name'] = name
+    self.run['phases'].append(sample)
+
+  def finishRun(self, programmer, error=None):
+    if self._profiler is not None:
+      self._profiler.disable()
+    self.run['total'] = self._delta(self._runStart, self._snapshot(programmer.comms))
+    self.run['error'] = None if error is None else str(error)
+    report = self.run
+    basename = '{0}-{1}'.format(
+        os.path.basename(str(report['port'])) or 'programmer',
+        time.strftime('%Y%m%d-%H%M%S', time.localtime(report['started'])))
+    if not os.path.isdir(self.outputDir):
+      os.makedirs(self.outputDir)
+    path = os.path.join(self.outputDir, basename)
+    if self._profiler is not None:
+      self._profiler.dump_stats(path + '.prof')
+      report['cprofile'] = path + '.prof'
+      report['hotspots'] = self._hotspots(self._profiler)
+      self._profiler = None
+    with open(path + '.json', 'w') as f:
+      json.dump(report, f, indent=2, sort_keys=True)
+    self.lastReport = report
+    self.lastReportFile = path + '.json'
+    return report
+
+  def _snapshot(self, comms):
+    return (time.time(), _cpuTime(), comms.ioTime, comms.frames,
+        comms.bytesOut, comms.bytesIn)
+
+  def _delta(self, start, end):
+    wall = end[0] - start[0]
+    serialWait = end[2] - start[2]
+    return {
+        'wall' : wall,
+        'cpu' : end[1] - start[1],
+        'serialWait' : serialWait,
+        'python' : max(wall - serialWait, 0.0),
+        'frames' : end[3] - start[3],
+        'bytesOut' : end[4] - start[4],
+        'bytesIn' : end[5] - start[5],
+        }
+
+  def _hotspots(self, profiler, count=15):
+    out = StringIO.StringIO()
+    stats = pstats.Stats(profiler, stream=out)
+    stats.sort_stats('cumulative').print_stats(count)
+    return out.getvalue()
+
+def load(filename):
+  with open(filename, 'r') as f:
+    return json.load(f)
+
+def formatProfile(report):
+  lines = ['{0} on {1}'.format(report['programmer'], report['port'])]
+  lines.append('{0:<16} {1:>8} {2:>8} {3:>8} {4:>8} {5:>7}'.format(
+      'Phase', 'Wall s', 'Serial s', 'Python s', 'CPU s', 'Frames'))
+  for p in report['phases'] + [dict(report['total'], name='total')]:
+    lines.append('{0:<16} {1:>8.3f} {2:>8.3f} {3:>8.3f} {4:>8.3f} {5:>7}'.format(
+        p['name'], p['wall'], p['serialWait'], p['python'], p['cpu'], p['frames']))
+  return '\n'.join(lines)
+
+def formatComparison(before, after):
+  """Show the per-phase change in wall, serial and Python time."""
+  def phases(report):
+    d = dict((p['name'], p) for p in report['phases'])
+    d['total'] = report['total']
+    return d
+  a = phases(before)
+  b = phases(after)
+  names = [p['name'] for p in before['phases']]
+  names += [p['name'] for p in after['phases'] if p['name'] not in a]
+  names.append('total')
+  lines = ['{0:<16} {1:>9} {2:>9} {3:>9} {4:>9}'.format(
+      'Phase', 'Before s', 'After s', 'Serial d', 'Python d')]
+  for name in names:
+    pa = a.get(name)
+    pb = b.get(name)
+    if pa is None or pb is None:
+      lines.append('{0:<16} {1:>9} {2:>9}'.format(name,
+          '-' if pa is None else '{0:.3f}'.format(pa['wall']),
+          '-' if pb is None else '{0:.3f}'.format(pb['wall'])))
+      continue
+    lines.append('{0:<16} {1:>9.3f} {2:>9.3f} {3:>+9.3f} {4:>+9.3f}'.format(
+        name, pa['wall'], pb['wall'], pb['serialWait'] - pa['serialWait'],
+        pb['python'] - pa['python']))
+  return '\n'.join(lines)
+
+def main(argv):
+  if len(argv) == 2 and argv[0] == 'show':
+    report = load(argv[1])
+    print formatProfile(report)
+    if report.get('hotspots'):
+      print
+      print report['hotspots']
+  elif len(argv) == 3 and argv[0] == 'compare':
+    print formatComparison(load(argv[1]), load(argv[2]))
+  else:
+    print 'Usage: stkprofile.py show REPORT'
+    print '       stkprofile.py compare BEFORE AFTER'
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
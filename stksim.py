@@ -0,0 +1,163 @@
+"""
+A simulated AVRISP mkII programmer with a board attached, for exercising the
+programmers without a jig.
+
+SimulatedTransport has the same interface as the transports in stktransport,
+so it can be handed to any programmer:
+
+  board = stksim.SimulatedBoard(pystk500v2.ATMEGA128RFA1)
+  programmer = pystk500v2.AutoProgrammer('sim', stksim.SimulatedTransport(board))
+
+The board answers the commands the programmers send with the chip's
+signature, flash, EEPROM and fuses. As on a real chip, programming flash can
+only clear bits and only a chip erase sets them again. Faults can be
+injected: flash bytes which fail to program once or always, and a programmer
+which stops answering after a number of frames.
+"""
+
+import pystk500v2 as stk
+
+S = stk.STK500
+
+class SimulatedBoard():
+  """A chip's memories and fuses, as described by its DeviceProfile."""
+  def __init__(self, device):
+    self.device = device
+    self.signature = device.signature
+    self.flash = bytearray(b'\xff'*device.flashSize)
+    self.eeprom = bytearray(b'\xff'*device.eepromSize)
+    self.fuses = {'hfuse' : 0xff, 'lfuse' : 0xff, 'efuse' : 0xff}
+    self.progmode = False
+    # Flash byte addresses which fail to program, every time or just once
+    self.stuck = set()
+    self.flaky = set()
+
+  def load(self, data, startaddr=0):
+    """Put data straight into flash, as if it had been programmed."""
+    self.flash[startaddr:startaddr+len(data)] = data
+
+class SimulatedTransport():
+  """Answers each frame written with the programmer's response frame.
+
+  commands counts the frames received of each command, so tests can check
+  how many exchanges an operation took. If silentAfter is set, frames past
+  that many are ignored, as if the programmer had been unplugged."""
+  def __init__(self, board, port='sim', silentAfter=None):
+    self.board = board
+    self.port = port
+    self.silentAfter = silentAfter
+    self.timeout = None
+    self.frames = 0
+    self.commands = {}
+    self.closed = False
+    self._address = 0
+    self._buffer = bytearray()
+
+  def count(self, command):
+    return self.commands.get(command, 0)
+
+  def setTimeout(self, timeout):
+    self.timeout = timeout
+
+  def write(self, data):
+    frame = bytearray(data)
+    size = frame[2] << 8 | frame[3]
+    if (len(frame) != size + 6 or frame[0] != S.MESSAGE_START or
+        frame[4] != S.TOKEN or reduce(lambda x, y: x^y, frame) != 0):
+      raise ValueError("Malformed frame: {0}".format(repr(bytes(frame))))
+    self.frames += 1
+    if self.silentAfter is not None and self.frames > self.silentAfter:
+      return len(data)
+    body = frame[5:5+size]
+    self.commands[body[0]] = self.count(body[0]) + 1
+    resp = self._answer(body)
+    out = bytearray([S.MESSAGE_START, frame[1], len(resp) >> 8,
+      len(resp) & 0xff, S.TOKEN]) + resp
+    out.append(reduce(lambda x, y: x^y, out))
+    self._buffer += out
+    return len(data)
+
+  def read(self, size=1):
+    # Nothing more is coming, so a read times out straight away
+    data = bytes(self._buffer[:size])
+    del self._buffer[:size]
+    return data
+
+  def close(self):
+    self.closed = True
+
+  def _answer(self, body):
+    board = self.board
+    cmd = body[0]
+    ok = bytearray([cmd, S.STATUS_CMD_OK])
+    if cmd == S.CMD_SIGN_ON:
+      return ok + bytearray([8]) + bytearray(b'AVRISP_2')
+    if cmd == S.CMD_SET_PARAMETER:
+      return ok
+    if cmd == S.CMD_GET_PARAMETER:
+      return ok + bytearray([1])
+    if cmd == S.CMD_LOAD_ADDRESS:
+      self._address = (body[1] << 24 | body[2] << 16 | body[3] << 8 |
+          body[4]) & 0x7fffffff
+      return ok
+    if cmd == S.CMD_ENTER_PROGMODE_ISP:
+      board.progmode = True
+      return ok
+    if cmd == S.CMD_LEAVE_PROGMODE_ISP:
+      board.progmode = False
+      return ok
+    if not board.progmode:
+      return bytearray([cmd, S.STATUS_CMD_FAILED])
+    if cmd == S.CMD_CHIP_ERASE_ISP:
+      board.flash[:] = b'\xff'*len(board.flash)
+      board.eeprom[:] = b'\xff'*len(board.eeprom)
+      return ok
+    size = body[1] << 8 | body[2]
+    if cmd == S.CMD_PROGRAM_FLASH_ISP:
+      data = body[10:10+size]
+      start = self._address*2
+      for i in range(size):
+        address = start + i
+        if address in board.stuck:
+          continue
+        if address in board.flaky:
+          board.flaky.discard(address)
+          continue
+        board.flash[address] &= data[i]
+      self._address += size//2
+      return ok
+    if cmd == S.CMD_READ_FLASH_ISP:
+      start = self._address*2
+      self._address += size//2
+      return ok + board.flash[start:start+size] + bytearray([S.STATUS_CMD_OK])
+    if cmd == S.CMD_READ_EEPROM_ISP:
+      start = self._address
+      self._address += size
+      return ok + board.eeprom[start:start+size] + bytearray([S.STATUS_CMD_OK])
+    if cmd == S.CMD_SPI_MULTI:
+      return ok + self._spi(body[4:4+body[1]]) + bytearray([S.STATUS_CMD_OK])
+    return bytearray([cmd, S.STATUS_CMD_UNKNOWN])
+
+  def _spi(self, spi):
+    """The bytes clocked back for one ISP instruction."""
+    board = self.board
+    rx = bytearray(4)
+    if spi[0] == 0x30:
+      rx[3] = (board.signature >> ((2 - spi[2])*8)) & 0xff
+    elif spi[0] == 0xac and spi[1] == 0xa8:
+      board.fuses['hfuse'] = spi[3]
+    elif spi[0] == 0xac and spi[1] == 0xa0:
+      board.fuses['lfuse'] = spi[3]
+    elif spi[0] == 0xac and spi[1] == 0xa4:
+      board.fuses['efuse'] = spi[3]
+    elif spi[0] == 0x58 and spi[1] == 0x08:
+      rx[3] = board.fuses['hfuse']
+    elif spi[0] == 0x50 and spi[1] == 0x00:
+      rx[3] = board.fuses['lfuse']
+    elif spi[0] == 0x50 and spi[1] == 0x08:
+      rx[3] = board.fuses['efuse']
+    elif spi[0] == 0xc0:
+      board.eeprom[(spi[1] << 8 | spi[2]) % len(board.eeprom)] = spi[3]
+    elif spi[0] == 0xa0:
+      rx[3] = board.eeprom[(spi[1] << 8 | spi[2]) % len(board.eeprom)]
+    return rx
@@ -0,0 +1,214 @@
+"""
+Byte transports for the STK500v2 programmers.
+
+A programmer talks to its port through a transport with the small part of the
+pyserial interface it needs: port, setTimeout(), write(), read() and close().
+SerialTransport is the real serial port. RecordingTransport wraps another
+transport and captures the traffic with timestamps, and ReplayTransport plays
+a recording back with the original or scaled timing, so that changes to the
+protocol handling can be benchmarked against real programmer behaviour
+without a jig:
+
+  python pystk500v2.py PORT --record session.stk
+  python stktransport.py replay session.stk [--timescale 0] [--runs 5]
+
+Recordings are a short header followed by one record per write or completed
+read: a kind byte ('W' or 'R'), the time in seconds since the recording
+started as a double, and the length of the data which follows. Files ending
+in .gz are compressed.
+"""
+
+import gzip
+import struct
+import sys
+import time
+
+MAGIC = b'STKREC1\n'
+_record = struct.Struct('<cdI')
+
+class ReplayError(Exception):
+  pass
+
+def _open(filename, mode):
+  if filename.endswith('.gz'):
+    return gzip.open(filename, mode)
+  return open(filename, mode)
+
+class SerialTransport():
+  def __init__(self, port, baudrate=115200):
+    import serial
+    self.ser = serial.Serial(port, baudrate=baudrate)
+    self.port = port
+
+  def setTimeout(self, timeout):
+    self.ser.timeout = timeout
+
+  def write(self, data):
+    return self.ser.write(data)
+
+  def read(self, size=1):
+    return self.ser.read(size)
+
+  def close(self):
+    self.ser.close()
+
+class RecordingTransport():
+  """Passes traffic through to transport, writing it to filename."""
+  def __init__(self, transport, filename):
+    self.transport = transport
+    self.port = transport.port
+    self.f = _open(filename, 'wb')
+    self.f.write(MAGIC)
+    self.started = time.time()
+
+  def _record(self, kind, data):
+    data = bytes(data)
+    self.f.write(_record.pack(kind, time.time() - self.started, len(data)))
+    self.f.write(data)
+
+  def setTimeout(self, timeout):
+    self.transport.setTimeout(timeout)
+
+  def write(self, data):
+    self._record(b'W', data)
+    return self.transport.write(data)
+
+  def read(self, size=1):
+    data = self.transport.read(size)
+    if data:
+      self._record(b'R', data)
+    return data
+
+  def close(self):
+    try:
+      self.transport.close()
+    finally:
+      self.f.close()
+
+def load(filename):
+  """Read a recording as a list of (kind, seconds, data) tuples."""
+  with _open(filename, 'rb') as f:
+    if f.read(len(MAGIC)) != MAGIC:
+      raise ReplayError("{0} is not a transport recording".format(filename))
+    records = []
+    while True:
+      header = f.read(_record.size)
+      if not header:
+        break
+      if len(header) < _record.size:
+        raise ReplayError("Truncated recording: {0}".format(filename))
+      kind, seconds, length = _record.unpack(header)
+      data = f.read(length)
+      if len(data) < length:
+        raise ReplayError("Truncated recording: {0}".format(filename))
+      records.append((kind, seconds, data))
+  return records
+
+class ReplayTransport():
+  """Plays back a recording. Each write must match the next recorded write,
+  after which the recorded response becomes readable, each chunk arriving as
+  long after the write as it did originally, multiplied by timescale. A
+  timescale of 0 replays as fast as possible. Reads may be split differently
+  from the recording, so the reader is free to change."""
+  def __init__(self, recording, timescale=1.0, port='replay'):
+    if isinstance(recording, basestring):
+      recording = load(recording)
+    self.port = port
+    self.timescale = timescale
+    self.timeout = None
+    self._exchanges = []
+    for kind, seconds, data in recording:
+      if kind == b'W':
+        self._exchanges.append((seconds, bytearray(data), []))
+      elif self._exchanges:
+        written = self._exchanges[-1][0]
+        self._exchanges[-1][2].append((seconds - written, bytearray(data)))
+    self._next = 0
+    self._pending = []
+    self._buffer = bytearray()
+    self._written = time.time()
+
+  def remaining(self):
+    return len(self._exchanges) - self._next
+
+  def setTimeout(self, timeout):
+    self.timeout = timeout
+
+  def write(self, data):
+    if self._next >= len(self._exchanges):
+      raise ReplayError("Write past the end of the recording")
+    seconds, expected, responses = self._exchanges[self._next]
+    if bytearray(data) != expected:
+      raise ReplayError("Write {0} differs from the recording".format(self._next))
+    self._next += 1
+    self._pending = list(responses)
+    self._buffer = bytearray()
+    self._written = time.time()
+    return len(data)
+
+  def read(self, size=1):
+    while len(self._buffer) < size and self._pending:
+      delay, data = self._pending.pop(0)
+      self._sleepUntil(self._written + delay*self.timescale)
+      self._buffer += data
+    if len(self._buffer) < size and self.timeout:
+      # The original read would have timed out waiting for more
+      self._sleepUntil(time.time() + self.timeout*self.timescale)
+    data = bytes(self._buffer[:size])
+    del self._buffer[:size]
+    return data
+
+  def _sleepUntil(self, when):
+    delay = when - time.time()
+    if delay > 0:
+      time.sleep(delay)
+
+  def close(self):
+    pass
+
+def replayFrames(recording):
+  """Yield (seqNum, body) for each frame written in a recording."""
+  for kind, seconds, data in recording:
+    if kind != b'W':
+      continue
+    frame = bytearray(data)
+    size = frame[2] << 8 | frame[3]
+    yield frame[1], frame[5:5+size]
+
+def benchmark(filename, timescale=0, runs=1):
+  """Replay every frame of a recording through the comms engine, returning
+  a list of (wall, ioTime, frames) tuples, one per run."""
+  import pystk500v2
+  recording = load(filename)
+  frames = list(replayFrames(recording))
+  results = []
+  for i in range(runs):
+    transport = ReplayTransport(recording, timescale)
+    comms = pystk500v2._CommsEngine(transport)
+    start = time.time()
+    for seqNum, body in frames:
+      comms.seqNum = (seqNum - 1) & 0xff
+      comms.sendrecv(body)
+    results.append((time.time() - start, comms.ioTime, comms.frames))
+  return results
+
+def main(argv):
+  import argparse
+  parser = argparse.ArgumentParser(
+      description='Replay a recorded programmer session.')
+  parser.add_argument('command', choices=['replay'])
+  parser.add_argument('recording')
+  parser.add_argument('--timescale', type=float, default=1.0,
+      help='Multiply the recorded timing by this. 0 replays at full speed.')
+  parser.add_argument('--runs', type=int, default=1)
+  args = parser.parse_args(argv)
+  results = benchmark(args.recording, args.timescale, args.runs)
+  print '{0:>4} {1:>8} {2:>9} {3:>9} {4:>10}'.format(
+      'Run', 'Frames', 'Wall s', 'Python s', 'us/frame')
+  for i, (wall, ioTime, frames) in enumerate(results):
+    python = max(wall - ioTime, 0.0)
+    print '{0:>4} {1:>8} {2:>9.3f} {3:>9.3f} {4:>10.1f}'.format(
+        i+1, frames, wall, python, python*1e6/max(frames, 1))
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
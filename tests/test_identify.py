@@ -0,0 +1,102 @@
+"""
+Tests for identifying a board's firmware, run against the simulated
+programmer in stksim.
+
+  python -m unittest discover
+"""
+
+import os
+import unittest
+import firmwarecatalog
+import pystk500v2 as stk
+import stksim
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def repoFiles(names):
+  return [os.path.join(REPO, name) for name in names]
+
+# dof2.hex in the tree is truncated, so it cannot be catalogued
+IMAGES = [(name, device, repoFiles(hexfiles))
+    for name, device, hexfiles in firmwarecatalog.KNOWN_IMAGES
+    if name != 'dof2']
+
+class IdentifyTest(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    cls.catalog = firmwarecatalog.FirmwareCatalog.fromKnownImages(IMAGES)
+
+  def identify(self, name):
+    """Identify a simulated board holding the named image, returning the
+    result and the number of frames it took."""
+    device = stk.profileByName(self.catalog.images[name]['device']
+        if name else 'atmega128rfa1')
+    board = stksim.SimulatedBoard(device)
+    if name:
+      hexfiles = self.catalog.images[name]['hexfiles']
+      board.load(stk.composeImages(hexfiles, device).data)
+    transport = stksim.SimulatedTransport(board)
+    programmer = stk.AutoProgrammer('sim', transport=transport)
+    programmer.sign_on()
+    programmer.enter_progmode_isp()
+    programmer.check_signature()
+    frames = transport.frames
+    result = self.catalog.identify(programmer)
+    return result, transport.frames - frames
+
+  def testDof(self):
+    result, frames = self.identify('dof')
+    self.assertEqual(result['name'], 'dof')
+    self.assertEqual(result['pagesRead'], 3)
+    self.assertEqual(frames, 6)
+
+  def testOutfull(self):
+    result, frames = self.identify('outfull')
+    self.assertEqual(result['name'], 'outfull')
+    self.assertEqual(result['pagesRead'], 3)
+    self.assertEqual(frames, 6)
+
+  def testIdenticalImagesAllMatch(self):
+    result, frames = self.identify('full')
+    self.assertEqual(result['name'], None)
+    self.assertEqual(result['matches'],
+        ['BaroboFirmware_201304241609', 'full', 'hex2'])
+
+  def testUSBBoard(self):
+    result, frames = self.identify('usb')
+    self.assertEqual(result['name'], 'usb')
+    self.assertEqual(result['matches'], ['usb'])
+
+  def testBlankBoard(self):
+    result, frames = self.identify(None)
+    self.assertEqual(result['name'], None)
+    self.assertEqual(result['matches'], [])
+
+  def testCorruptConfirmationPageIsNotAMatch(self):
+    device = stk.ATMEGA128RFA1
+    image = stk.composeImages(self.catalog.images['dof']['hexfiles'], device)
+    pagesRead = []
+    def identify(board):
+      programmer = stk.AutoProgrammer('sim',
+          transport=stksim.SimulatedTransport(board))
+      readFlash = programmer.readFlash
+      def spy(size=None, startaddr=0, **kwargs):
+        pagesRead.append(startaddr)
+        return readFlash(size, startaddr, **kwargs)
+      programmer.readFlash = spy
+      programmer.sign_on()
+      programmer.enter_progmode_isp()
+      programmer.check_signature()
+      return self.catalog.identify(programmer)
+    board = stksim.SimulatedBoard(device)
+    board.load(image.data)
+    self.assertEqual(identify(board)['name'], 'dof')
+    # The last page read only confirms the match, so corrupting it must
+    # stop the board matching
+    board.flash[pagesRead[-1]] ^= 0x01
+    result = identify(board)
+    self.assertEqual(result['name'], None)
+    self.assertEqual(result['matches'], [])
+
+if __name__ == '__main__':
+  unittest.main()
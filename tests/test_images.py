@@ -0,0 +1,93 @@
+"""
+Tests for composing hex files into flash images.
+
+  python -m unittest discover
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import pystk500v2 as stk
+
+class ComposeImagesTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def writeHex(self, name, *chunks):
+    """Write (address, data) chunks to a hex file, returning its name."""
+    filename = os.path.join(self.dir, name)
+    with open(filename, 'w') as f:
+      writer = stk.IHexWriter(f, skipBlank=False)
+      for address, data in chunks:
+        writer.write(address, data)
+      writer.close()
+    return filename
+
+  def pattern(self, start, end):
+    return bytearray((i*7 + 3) & 0xff for i in range(start, end))
+
+  def testThreeAgreeingOverlaps(self):
+    a = self.writeHex('a.hex', (0, self.pattern(0, 100)))
+    b = self.writeHex('b.hex', (50, self.pattern(50, 150)))
+    c = self.writeHex('c.hex', (60, self.pattern(60, 70)))
+    image = stk.composeImages([a, b, c])
+    self.assertEqual(image.data, self.pattern(0, 150))
+    self.assertEqual([(s, e) for s, e, f in image.segments], [(0, 100), (100, 150)])
+
+  def testOverlapAcrossSeveralEarlierSegments(self):
+    a = self.writeHex('a.hex', (0, self.pattern(0, 40)), (80, self.pattern(80, 120)))
+    b = self.writeHex('b.hex', (20, self.pattern(20, 60)))
+    c = self.writeHex('c.hex', (30, self.pattern(30, 100)))
+    image = stk.composeImages([a, b, c])
+    self.assertEqual(image.data, self.pattern(0, 120))
+
+  def testExtendedAddressRecordsAreNotData(self):
+    a = self.writeHex('a.hex', (0x1e000, self.pattern(0, 0x20)))
+    image = stk.composeImages([a])
+    self.assertEqual([(s, e) for s, e, f in image.segments], [(0x1e000, 0x1e020)])
+
+  def testConflictingOverlap(self):
+    a = self.writeHex('a.hex', (0, self.pattern(0, 100)))
+    b = self.writeHex('b.hex', (50, self.pattern(50, 150)))
+    bad = self.pattern(60, 70)
+    bad[5] ^= 0xff
+    c = self.writeHex('c.hex', (60, bad))
+    with self.assertRaises(stk.ImageError) as context:
+      stk.composeImages([a, b, c])
+    self.assertIn('a.hex and', str(context.exception))
+    self.assertIn('0x00041', str(context.exception))
+
+  def testPagesSkipBlank(self):
+    a = self.writeHex('a.hex', (0, self.pattern(0, 0x10)),
+        (0x300, self.pattern(0x300, 0x310)))
+    image = stk.composeImages([a])
+    self.assertEqual([address for address, data in image.pages], [0, 0x300])
+    self.assertEqual(len(image), 0x310)
+
+  def testFlashSize(self):
+    a = self.writeHex('a.hex', (0x8000, bytearray(16)))
+    with self.assertRaises(stk.ImageError):
+      stk.composeImages([a], stk.ATMEGA32U4)
+
+  def testBootSection(self):
+    boot = self.writeHex('boot.hex', (0x7000, self.pattern(0, 0x20)))
+    app = self.writeHex('app.hex', (0, self.pattern(0, 0x20)))
+    stk.composeImages([boot, app], stk.ATMEGA32U4)
+    intruder = self.writeHex('intruder.hex', (0x7100, bytearray(4)))
+    with self.assertRaises(stk.ImageError):
+      stk.composeImages([boot, app, intruder], stk.ATMEGA32U4)
+
+  def testMatchesHexFile(self):
+    # Below 64k, where HexFile needs no extended address records
+    chunks = [(0, self.pattern(0, 0x180)), (0x2000, self.pattern(0, 0x40))]
+    a = self.writeHex('a.hex', *chunks)
+    h = stk.HexFile()
+    h.fromIHexFile(a)
+    self.assertEqual(stk.composeImages([a]).data, h.data)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,53 @@
+"""
+Tests for the line capacity simulator.
+
+  python -m unittest discover
+"""
+
+import unittest
+import linesim
+
+class FakeRunLog():
+  def __init__(self, runs):
+    self.runs = runs
+
+  def runPhases(self, since=0):
+    return self.runs
+
+class TimingsTest(unittest.TestCase):
+  def testDongleWaitIsNotServiceTime(self):
+    runLog = FakeRunLog([
+        ('passed', 'test', {'write' : 20.0, 'verify' : 10.0,
+          'test_wait' : 40.0, 'test' : 5.0}),
+        # Logged before the wait for a dongle was a separate phase
+        ('passed', 'test', {'write' : 20.0, 'verify' : 10.0, 'test' : 45.0}),
+        ('failed', 'test', {'write' : 20.0, 'verify' : 10.0,
+          'test_wait' : 0.0, 'test' : 6.0}),
+        ('failed', 'write', {'write' : 3.0}),
+        ])
+    timings = linesim.Timings.fromRunLog(runLog)
+    self.assertEqual(timings.flash, [30.0, 30.0, 30.0])
+    self.assertEqual(timings.test, [5.0, 6.0])
+    self.assertEqual(timings.flashFailRate, 0.25)
+    self.assertEqual(timings.testFailRate, 0.5)
+
+class LineModelTest(unittest.TestCase):
+  def testFlashingPastTheEndOfTheShiftIsNotCounted(self):
+    timings = linesim.Timings(flash=[3600.0], test=[5.0])
+    model = linesim.LineModel(timings, jigs=2, loadTime=0.0, seed=1)
+    result = model.run(hours=0.5)
+    self.assertTrue(result['utilisation']['jigs'] <= 1.0)
+    self.assertEqual(result['counts']['passed'], 0)
+
+  def testSlowTestMakesDonglesTheBottleneck(self):
+    timings = linesim.Timings(flash=[30.0], test=[60.0])
+    result = linesim.LineModel(timings, jigs=2, boardsPerDongle=1,
+        seed=1).run(hours=1.0)
+    self.assertEqual(result['bottleneck'], 'dongles')
+    timings = linesim.Timings(flash=[30.0], test=[5.0])
+    result = linesim.LineModel(timings, jigs=2, boardsPerDongle=1,
+        seed=1).run(hours=1.0)
+    self.assertNotEqual(result['bottleneck'], 'dongles')
+
+if __name__ == '__main__':
+  unittest.main()
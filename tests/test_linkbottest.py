@@ -0,0 +1,68 @@
+"""
+Tests for the board test routine, run against FakeLinkbots.
+
+  python -m unittest discover
+"""
+
+import random
+import threading
+import time
+import unittest
+import linkbottest
+
+class AccelerometerCheckTest(unittest.TestCase):
+  def setUp(self):
+    random.seed(1)
+    self.check = linkbottest.AccelerometerCheck()
+
+  def testQuietLevelBoardPassesOnOneSample(self):
+    result = self.check.run(linkbottest.FakeLinkbot('TEST', latency=0))
+    self.assertEqual(result['samples'], 1)
+
+  def testNoisyLevelBoardsPass(self):
+    for i in range(500):
+      self.check.run(linkbottest.FakeLinkbot('TEST', latency=0, noise=0.05))
+
+  def testTiltedBoardFails(self):
+    mybot = linkbottest.FakeLinkbot('TEST', latency=0, accel=(0.5, 0, 0.85))
+    try:
+      self.check.run(mybot)
+    except linkbottest.LinkbotTestError as e:
+      self.assertTrue('over 3 samples' in str(e))
+    else:
+      self.fail('LinkbotTestError not raised')
+
+class TestSchedulerTest(unittest.TestCase):
+  def runTests(self, scheduler, count):
+    """Run count tests, returning the most that ran at once."""
+    lock = threading.Lock()
+    running = [0, 0]
+    def testFunc(serialID, dongle=None, confirm=None):
+      with lock:
+        running[0] += 1
+        running[1] = max(running)
+      time.sleep(0.1)
+      with lock:
+        running[0] -= 1
+    scheduler.testFunc = testFunc
+    try:
+      jobs = [scheduler.submit('B{0:03}'.format(i)) for i in range(count)]
+      for job in jobs:
+        job.result(timeout=10)
+    finally:
+      scheduler.shutdown()
+    return running[1]
+
+  def testDongleServesSeveralBoards(self):
+    scheduler = linkbottest.TestScheduler(maxConcurrent=8)
+    scheduler.addDongle(linkbottest.FakeDongle(maxBoards=3))
+    self.assertEqual(self.runTests(scheduler, 9), 3)
+
+  def testBoardsPerDongleOverridesTheDongle(self):
+    scheduler = linkbottest.TestScheduler(boardsPerDongle=1, maxConcurrent=8)
+    scheduler.addDongle(linkbottest.FakeDongle(maxBoards=3))
+    scheduler.addDongle(linkbottest.FakeDongle(maxBoards=3))
+    self.assertEqual(self.runTests(scheduler, 6), 2)
+
+if __name__ == '__main__':
+  unittest.main()
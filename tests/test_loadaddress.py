@@ -0,0 +1,51 @@
+"""
+Tests for skipping redundant LOAD_ADDRESS commands, run against the
+simulated programmer in stksim.
+
+  python -m unittest discover
+"""
+
+import unittest
+import pystk500v2 as stk
+import stksim
+
+class LoadAddressTest(unittest.TestCase):
+  def setUp(self):
+    self.board = stksim.SimulatedBoard(stk.ATMEGA128RFA1)
+    self.transport = stksim.SimulatedTransport(self.board)
+    self.programmer = stk.AutoProgrammer('sim', transport=self.transport)
+    self.programmer.sign_on()
+    self.programmer.enter_progmode_isp()
+    self.programmer.check_signature()
+
+  def loads(self):
+    return self.transport.count(stk.STK500.CMD_LOAD_ADDRESS)
+
+  def testContiguousReadsLoadTheAddressOnce(self):
+    self.board.load(bytearray(range(256))*8)
+    data = self.programmer.readFlash(0x800, blocksize=0x100)
+    self.assertEqual(data, bytearray(range(256))*8)
+    self.assertEqual(self.loads(), 1)
+    self.assertEqual(self.transport.count(stk.STK500.CMD_READ_FLASH_ISP), 8)
+    self.assertEqual(self.programmer.commandsSaved, 0)
+    # Carrying on from where the last read stopped needs no new address
+    self.programmer.readFlash(0x100, startaddr=0x800)
+    self.assertEqual(self.loads(), 1)
+    self.assertEqual(self.programmer.commandsSaved, 1)
+
+  def testOtherCommandsForgetTheAddress(self):
+    self.programmer.readFlash(0x100)
+    self.programmer.chip_erase_isp()
+    self.programmer.readFlash(0x100, startaddr=0x100)
+    self.assertEqual(self.loads(), 2)
+
+  def testEEPROMIsByteAddressed(self):
+    self.board.eeprom[0x10:0x20] = bytearray(range(16))
+    self.assertEqual(self.programmer.readEEPROM(8, startaddr=0x10),
+        bytearray(range(8)))
+    self.assertEqual(self.programmer.readEEPROM(8, startaddr=0x18),
+        bytearray(range(8, 16)))
+    self.assertEqual(self.loads(), 1)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,51 @@
+"""
+Tests for the flash-and-test pipeline.
+
+  python -m unittest discover
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import linkbottest
+import pipeline
+import productiondb
+
+class PipelineTimingTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.runLog = productiondb.RunLog(os.path.join(self.dir, 'production.db'))
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def testDongleWaitIsNotTestTime(self):
+    def testFunc(serialID, dongle=None, confirm=None):
+      time.sleep(0.2)
+    scheduler = linkbottest.TestScheduler(testFunc)
+    scheduler.addDongle(linkbottest.FakeDongle(maxBoards=1))
+    p = pipeline.FlashTestPipeline(scheduler.run,
+        testExecutor=scheduler.executor, runLog=self.runLog, jig='jig')
+    try:
+      records = [p.test(serialID) for serialID in ('AAAA', 'BBBB', 'CCCC')]
+      deadline = time.time() + 10
+      while not all(r.done() for r in records) and time.time() < deadline:
+        time.sleep(0.05)
+    finally:
+      scheduler.shutdown()
+    runs = self.runLog.runPhases()
+    self.assertEqual(len(runs), 3)
+    waits = []
+    for outcome, stage, phases in runs:
+      self.assertEqual(outcome, 'passed')
+      self.assertTrue(0.15 < phases['test'] < 0.35, phases)
+      waits.append(phases['test_wait'])
+    # The boards queued for the one dongle slot waited for the ones before them
+    waits.sort()
+    self.assertTrue(waits[0] < 0.1, waits)
+    self.assertTrue(waits[2] > 0.3, waits)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,70 @@
+"""
+Tests for the pool of open programmers, run against the simulated
+programmer in stksim.
+
+  python -m unittest discover
+"""
+
+import os
+import time
+import unittest
+import pystk500v2 as stk
+import stksim
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BOARDS = {}
+
+class SimProgrammer(stk.AutoProgrammer):
+  def __init__(self, port):
+    stk.AutoProgrammer.__init__(self, port,
+        transport=stksim.SimulatedTransport(BOARDS[port], port))
+
+class Sim32U4Programmer(SimProgrammer):
+  DEVICE = stk.ATMEGA32U4
+
+class ProgrammerPoolTest(unittest.TestCase):
+  def setUp(self):
+    for port in ('sim0', 'sim1'):
+      BOARDS[port] = stksim.SimulatedBoard(stk.ATMEGA32U4)
+    self.pool = stk.ProgrammerPool(SimProgrammer)
+    self.executor = stk.JobExecutor(numWorkers=2)
+
+  def tearDown(self):
+    self.executor.shutdown()
+    self.pool.closeAll()
+
+  def testProgrammerIsKept(self):
+    programmer = self.pool.acquire('sim0')
+    self.assertTrue(self.pool.acquire('sim0') is programmer)
+    self.assertEqual(programmer.ser.count(stk.STK500.CMD_SIGN_ON), 1)
+    self.assertEqual(self.pool.ports(), ['sim0'])
+
+  def testClassSwitchWaitsForQueuedJobs(self):
+    programmer = self.pool.acquire('sim0')
+    hexfiles = [os.path.join(REPO, 'usb.hex')]
+    # Hold the port so that the job stays queued behind it
+    with programmer.lock:
+      job = programmer.submitProgramAll(self.executor, hexfiles=hexfiles)
+      self.assertTrue(programmer.isProgramming())
+      start = time.time()
+      self.assertRaises(stk.ProgrammerBusy, self.pool.acquire, 'sim0',
+          Sim32U4Programmer)
+      # Other ports are not held up
+      self.pool.acquire('sim1')
+      self.assertTrue(time.time() - start < 1.0)
+    job.result(timeout=10)
+    self.assertFalse(programmer.isProgramming())
+    other = self.pool.acquire('sim0', Sim32U4Programmer)
+    self.assertTrue(other is not programmer)
+    self.assertTrue(programmer.ser.closed)
+
+  def testDeadProgrammerIsReplaced(self):
+    programmer = self.pool.acquire('sim0')
+    programmer.ser.silentAfter = programmer.ser.frames
+    other = self.pool.acquire('sim0')
+    self.assertTrue(other is not programmer)
+    self.assertTrue(programmer.ser.closed)
+
+if __name__ == '__main__':
+  unittest.main()
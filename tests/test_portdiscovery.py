@@ -0,0 +1,51 @@
+"""
+Tests for programmer discovery and jig bindings.
+
+  python -m unittest discover
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import portdiscovery
+
+def programmer(device, serialNumber):
+  return portdiscovery.PortInfo(device, vid=0x1ffb, pid=0x0081,
+      serialNumber=serialNumber)
+
+class JigBindingTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.bindingsFile = os.path.join(self.dir, 'jigs.json')
+    self.attached = [programmer('/dev/ttyACM0', 'A1'),
+        programmer('/dev/ttyACM2', 'B2')]
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def discovery(self):
+    return portdiscovery.PortDiscovery(self.bindingsFile,
+        enumerator=lambda: list(self.attached))
+
+  def testJigFollowsRepluggedProgrammer(self):
+    discovery = self.discovery()
+    self.assertEqual(sorted(discovery.autoBind()), ['Jig 1', 'Jig 2'])
+    jig = discovery.jigForPort('/dev/ttyACM0')
+    self.assertTrue(jig is not None)
+    # Replugged, the programmer comes back on another port
+    self.attached[0] = programmer('/dev/ttyACM3', 'A1')
+    discovery.refresh()
+    self.assertEqual(discovery.portForJig(jig), '/dev/ttyACM3')
+    self.assertEqual(discovery.jigForPort('/dev/ttyACM3'), jig)
+    self.assertEqual(discovery.jigForPort('/dev/ttyACM0'), None)
+
+  def testBindingsPersist(self):
+    discovery = self.discovery()
+    discovery.autoBind()
+    jigs = discovery.jigs()
+    self.assertEqual(self.discovery().jigs(), jigs)
+    self.assertEqual(self.discovery().autoBind(), [])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,56 @@
+"""
+Tests for the serial ID allocator.
+
+  python -m unittest discover
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import productiondb
+
+class SerialIDAllocatorTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.database = os.path.join(self.dir, 'production.db')
+    self.allocator = productiondb.SerialIDAllocator(self.database)
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def testImportedIDsAreNotHandedOut(self):
+    # The first IDs the allocator would have handed out
+    first = [self.allocator.encode((seq * self.allocator.STRIDE) %
+      self.allocator.size) for seq in range(1, 6)]
+    self.assertEqual(self.allocator.importExisting(first[:3]), 3)
+    reserved = [self.allocator.reserve() for i in range(2)]
+    self.assertEqual(reserved, first[3:5])
+    self.assertEqual(self.allocator.lookup(first[0])['state'], 'assigned')
+
+  def testImportMarksReleasedIDsUsed(self):
+    serialID = self.allocator.reserve()
+    self.allocator.release(serialID)
+    self.assertEqual(self.allocator.importExisting([serialID.lower()]), 1)
+    self.assertEqual(self.allocator.lookup(serialID)['state'], 'assigned')
+    self.assertNotEqual(self.allocator.reserve(), serialID)
+    # Importing again changes nothing
+    self.assertEqual(self.allocator.importExisting([serialID]), 0)
+
+  def testImportRejectsInvalidIDs(self):
+    self.assertRaises(ValueError, self.allocator.importExisting,
+        ['ABCD', 'AB-D'])
+    self.assertEqual(self.allocator.lookup('ABCD'), None)
+
+  def testExpireReservations(self):
+    old = self.allocator.reserve()
+    self.allocator.conn.execute(
+        'UPDATE serial_ids SET reserved_at = 0 WHERE serial_id = ?', (old,))
+    recent = self.allocator.reserve()
+    self.allocator.expireReservations()
+    self.assertEqual(self.allocator.lookup(old)['state'], 'released')
+    self.assertEqual(self.allocator.lookup(recent)['state'], 'reserved')
+    self.assertEqual(self.allocator.reserve(), old)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,75 @@
+"""
+Tests for programming boards from their device profiles, run against the
+simulated programmer in stksim.
+
+  python -m unittest discover
+"""
+
+import os
+import unittest
+import pystk500v2 as stk
+import stksim
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def repoFiles(names):
+  return [os.path.join(REPO, name) for name in names]
+
+class DeviceProfileTest(unittest.TestCase):
+  def programmer(self, device, **kwargs):
+    self.board = stksim.SimulatedBoard(device)
+    self.transport = stksim.SimulatedTransport(self.board, **kwargs)
+    return stk.AutoProgrammer('sim', transport=self.transport)
+
+  def image(self, device):
+    return stk.composeImages(repoFiles(device.hexfiles), device)
+
+  def testMainboard(self):
+    device = stk.ATMEGA128RFA1
+    programmer = self.programmer(device)
+    programmer.programAll(repoFiles(device.hexfiles), serialID='ABCD')
+    image = self.image(device)
+    self.assertEqual(self.board.flash[:len(image.data)], image.data)
+    self.assertEqual(self.board.eeprom[0x412:0x416], bytearray(b'ABCD'))
+    self.assertEqual(self.board.eeprom[0x420:0x423], bytearray([2, 0, 0]))
+    self.assertEqual(self.board.fuses,
+        {'hfuse' : 0xd8, 'lfuse' : 0xef, 'efuse' : 0xff})
+    self.assertFalse(self.board.progmode)
+    stats = programmer.runStats()
+    self.assertEqual(stats['device'], 'atmega128rfa1')
+    self.assertEqual(stats['repairs'], 0)
+
+  def testUSBBoardStoresNoSerialID(self):
+    device = stk.ATMEGA32U4
+    programmer = self.programmer(device)
+    programmer.programAll(repoFiles(device.hexfiles), serialID='ABCD')
+    image = self.image(device)
+    self.assertEqual(self.board.flash[:len(image.data)], image.data)
+    self.assertEqual(self.board.eeprom, bytearray(b'\xff'*device.eepromSize))
+    self.assertEqual(programmer.runStats()['device'], 'atmega32u4')
+    self.assertEqual(self.board.fuses['efuse'], 0xff)
+
+  def testWrongSignature(self):
+    self.board = stksim.SimulatedBoard(stk.ATMEGA32U4)
+    programmer = stk.ATmega128rfa1Programmer('sim',
+        transport=stksim.SimulatedTransport(self.board))
+    programmer.sign_on()
+    programmer.enter_progmode_isp()
+    self.assertRaises(IOError, programmer.check_signature)
+
+  def testAutoDetectSwitchesDevice(self):
+    for device in (stk.ATMEGA32U4, stk.ATMEGA128RFA1):
+      board = stksim.SimulatedBoard(device)
+      programmer = stk.AutoProgrammer('sim',
+          transport=stksim.SimulatedTransport(board))
+      programmer.sign_on()
+      programmer.enter_progmode_isp()
+      self.assertTrue(programmer.check_signature() is device)
+      self.assertEqual(programmer.PAGESIZE, device.pageSize)
+
+  def testProfileByName(self):
+    self.assertTrue(stk.profileByName('atmega32u4') is stk.ATMEGA32U4)
+    self.assertRaises(KeyError, stk.profileByName, 'atmega8')
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,63 @@
+"""
+Tests for verifying flash and repairing bad pages, run against the
+simulated programmer in stksim.
+
+  python -m unittest discover
+"""
+
+import os
+import unittest
+import pystk500v2 as stk
+import stksim
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def repoFiles(names):
+  return [os.path.join(REPO, name) for name in names]
+
+class DiffPagesTest(unittest.TestCase):
+  def testRanges(self):
+    expected = bytearray(0x400)
+    actual = bytearray(expected)
+    actual[0x10] = 1
+    actual[0x11] = 1
+    actual[0x305] = 1
+    pages, ranges = stk.diffPages(expected, actual, 0x100)
+    self.assertEqual(pages, [0x000, 0x300])
+    self.assertEqual(ranges, [(0x10, 0x12), (0x305, 0x306)])
+
+class RepairTest(unittest.TestCase):
+  def setUp(self):
+    self.device = stk.ATMEGA128RFA1
+    self.board = stksim.SimulatedBoard(self.device)
+    self.transport = stksim.SimulatedTransport(self.board)
+    self.programmer = stk.AutoProgrammer('sim', transport=self.transport)
+    self.hexfiles = repoFiles(self.device.hexfiles)
+    self.image = stk.composeImages(self.hexfiles, self.device)
+    self.address = next(i for i, b in enumerate(self.image.data) if b != 0xff)
+
+  def testRepairInPlace(self):
+    self.board.flaky.add(self.address)
+    self.programmer.programAll(self.hexfiles, serialID='ABCD')
+    self.assertEqual(self.board.flash[:len(self.image.data)], self.image.data)
+    self.assertEqual(self.programmer.repairs, 1)
+    phases = [name for name, seconds in self.programmer.phaseTimes]
+    self.assertEqual(phases.count('verify'), 1)
+    self.assertEqual(phases.count('repair'), 1)
+    # Only the bad page was written again, without another chip erase
+    self.assertEqual(self.transport.count(stk.STK500.CMD_CHIP_ERASE_ISP), 1)
+
+  def testStuckByteFailsVerify(self):
+    self.board.stuck.add(self.address)
+    try:
+      self.programmer.programAll(self.hexfiles, serialID='ABCD')
+    except stk.VerifyError as e:
+      self.assertEqual(e.pages,
+          [self.address - self.address % self.device.pageSize])
+    else:
+      self.fail('VerifyError not raised')
+    # In place repair failed, so the chip was erased and programmed again
+    self.assertEqual(self.transport.count(stk.STK500.CMD_CHIP_ERASE_ISP), 2)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,48 @@
+"""
+Tests for the programming daemon.
+
+  python -m unittest discover
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import stkdaemon
+
+class DaemonDatabaseTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.daemon = stkdaemon.ProgrammingDaemon(
+        os.path.join(self.dir, 'production.db'))
+
+  def tearDown(self):
+    self.daemon.close()
+    shutil.rmtree(self.dir)
+
+  def testConcurrentReserveAndRecord(self):
+    errors = []
+    def reserve():
+      try:
+        for i in range(100):
+          self.daemon.serialIDs.reserve(jig='jig')
+      except Exception as e:
+        errors.append(e)
+    def record():
+      try:
+        for i in range(100):
+          self.daemon.runLog.record(0, 1, 'flashed', jig='jig',
+              phases=[('write', 1.0)])
+      except Exception as e:
+        errors.append(e)
+    threads = [threading.Thread(target=f) for f in (reserve, record)*3]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    self.assertEqual(errors, [])
+    self.assertEqual(len(self.daemon.runLog.history(limit=1000)), 300)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,61 @@
+"""
+Tests for recording and replaying programmer sessions, run against the
+simulated programmer in stksim.
+
+  python -m unittest discover
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import pystk500v2 as stk
+import stksim
+import stktransport
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def repoFiles(names):
+  return [os.path.join(REPO, name) for name in names]
+
+class RecordReplayTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.hexfiles = repoFiles(stk.ATMEGA32U4.hexfiles)
+    self.filename = os.path.join(self.dir, 'session.stk.gz')
+    board = stksim.SimulatedBoard(stk.ATMEGA32U4)
+    transport = stktransport.RecordingTransport(
+        stksim.SimulatedTransport(board), self.filename)
+    programmer = stk.AutoProgrammer('sim', transport=transport)
+    programmer.programAll(self.hexfiles)
+    programmer.close()
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def testReplayProgramAll(self):
+    replay = stktransport.ReplayTransport(self.filename, timescale=0)
+    programmer = stk.AutoProgrammer('replay', transport=replay)
+    programmer.programAll(self.hexfiles)
+    self.assertEqual(replay.remaining(), 0)
+
+  def testDifferentWriteIsCaught(self):
+    replay = stktransport.ReplayTransport(self.filename, timescale=0)
+    programmer = stk.AutoProgrammer('replay', transport=replay)
+    programmer.sign_on()
+    self.assertRaises(stktransport.ReplayError, programmer.chip_erase_isp)
+
+  def testBenchmark(self):
+    results = stktransport.benchmark(self.filename, runs=2)
+    frames = len(list(stktransport.replayFrames(
+      stktransport.load(self.filename))))
+    self.assertEqual([r[2] for r in results], [frames, frames])
+
+  def testNotARecording(self):
+    filename = os.path.join(self.dir, 'junk.stk')
+    with open(filename, 'wb') as f:
+      f.write(b'junk')
+    self.assertRaises(stktransport.ReplayError, stktransport.load, filename)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,54 @@
+"""
+Tests for the wire log kept for post-mortems on failed boards.
+
+  python -m unittest discover
+"""
+
+import os
+import unittest
+import pystk500v2 as stk
+import stksim
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def repoFiles(names):
+  return [os.path.join(REPO, name) for name in names]
+
+class WireLogTest(unittest.TestCase):
+  def testKeepsTheLastFrames(self):
+    log = stk.WireLog(numFrames=4, frameSize=8)
+    for i in range(10):
+      log.add(stk.WireLog.SENT, bytearray([i]*3))
+    entries = log.entries()
+    self.assertEqual([e[3] for e in entries],
+        [bytearray([i]*3) for i in range(6, 10)])
+
+  def testTruncatesLongFrames(self):
+    log = stk.WireLog(numFrames=4, frameSize=8)
+    log.add(stk.WireLog.RECEIVED, bytearray(range(20)))
+    timestamp, direction, length, data = log.entries()[0]
+    self.assertEqual(length, 20)
+    self.assertEqual(data, bytearray(range(8)))
+    self.assertTrue(log.format().endswith('... (20 bytes)'))
+
+  def testTimeoutDumpsWireLog(self):
+    device = stk.ATMEGA32U4
+    board = stksim.SimulatedBoard(device)
+    programmer = stk.AutoProgrammer('sim',
+        transport=stksim.SimulatedTransport(board, silentAfter=5))
+    executor = stk.JobExecutor(numWorkers=1)
+    try:
+      job = programmer.submitProgramAll(executor,
+          hexfiles=repoFiles(device.hexfiles))
+      error = job.exception(timeout=30)
+    finally:
+      executor.shutdown()
+    self.assertTrue(isinstance(error, IOError))
+    lines = job.stats['wireLog'].splitlines()
+    self.assertTrue(lines[0].startswith('Wire log'))
+    # Five answered frames and the one that timed out
+    self.assertEqual(len(lines), 1 + 2*6)
+    self.assertTrue(lines[-1].endswith('< (nothing)'))
+
+if __name__ == '__main__':
+  unittest.main()